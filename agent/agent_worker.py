@@ -1,63 +1,99 @@
 #!/usr/bin/env python3
 """
 Subprocess worker entrypoint for agent tasks.
-Reads input JSON, runs agent, writes output JSON, exits with proper code.
+Receives the input over the server channel (ipc.py), or reads input JSON when run standalone,
+runs agent, reports heartbeats / progress / result, exits with proper code.
 """
 import sys
 import os
 import json
+import signal
 import argparse
 from pathlib import Path
 
 from .run_agent import run_agent
+from .trace import WORKER_TRACE_FILE, open_trace, write_event, complete_event, now_us
+from . import budget, executor, ipc, sampler
+
+
+def _kernel_pids() -> list[int]:
+    kernel = executor._kernel
+    return [kernel.pid] if kernel is not None and kernel.is_alive() else []
 
 
 def main():
     parser = argparse.ArgumentParser(description="Agent worker subprocess")
     parser.add_argument("--input", required=True, help="Input JSON file path")
     parser.add_argument("--output", required=True, help="Output JSON file path")
+    parser.add_argument("--resume", action="store_true", help="Resume from the last checkpoint in the task spool")
     args = parser.parse_args()
     
     input_path = Path(args.input)
     output_path = Path(args.output)
+    channel = ipc.connect()
     
     try:
-        # Read input
-        with open(input_path, "r") as f:
-            data = json.load(f)
+        # Read input: from the server channel, the spool file when run standalone
+        if channel is not None:
+            data = channel.recv()
+            if data is None or data.get("type") != "input":
+                raise RuntimeError("No task input on the server channel")
+            ipc.start_heartbeat()
+        else:
+            with open(input_path, "r") as f:
+                data = json.load(f)
         
         task_id = data["task_id"]
         task = data["task"]
+        resume = args.resume or data.get("resume", False)
+
+        # Budgets of this run; SIGTERM (cancel) winds the task down at the next step / iteration
+        budget.start(data.get("budget"))
+        signal.signal(signal.SIGTERM, budget.cancel)
+
+        # On-demand stack sampling (SIGUSR1 from the server), forwarded to the python kernel
+        request_path = input_path.resolve().parent / sampler.PROFILE_REQUEST_FILE
+        os.environ["AGENT_PROFILE_REQUEST"] = str(request_path)
+        sampler.install(request_path, "worker", forward_pids=_kernel_pids)
+
+        # Timeline: worker startup is measured from the moment the server spawned the process
+        open_trace(input_path.resolve().parent / WORKER_TRACE_FILE, f"worker {task_id[:8]}")
+        if data.get("spawned_at_us"):
+            write_event(complete_event("worker_startup", "worker", data["spawned_at_us"], now_us()))
         
         # Change to work directory for agent file operations
         work_dir = Path(__file__).parent.parent / "work" / task_id
         work_dir.mkdir(exist_ok=True)
         os.chdir(work_dir)
         
-        # Run agent
-        result = run_agent(task)
-        
-        # Write success output
-        with open(output_path, "w") as f:
-            json.dump({
-                "status": "completed",
-                "result": result
-            }, f)
+        # Run agent, checkpoints go to the task spool (next to input.json)
+        checkpoint_dir = input_path.resolve().parent / "checkpoint"
+        result = run_agent(task, checkpoint_dir=checkpoint_dir, resume=resume, task_id=task_id)
         
+        stopped = budget.stopped_reason()
+        _report(output_path, {
+            "status": "cancelled" if stopped == "cancelled" else "completed",
+            "result": result,
+            "stopped": stopped,
+            "usage": budget.usage(),
+        }, channel)
         sys.exit(0)
     
     except Exception as e:
-        # Write failure output
+        _report(output_path, {"status": "failed", "error": str(e) or type(e).__name__, "error_type": type(e).__name__},
+                channel)
+        sys.exit(1)
+
+
+def _report(output_path: Path, output: dict, channel) -> None:
+    """Final result to the server channel; output.json as audit trail (or the only copy, standalone)."""
+    ipc.send("result", **output)
+    if channel is None or ipc.spool_audit():
         try:
             with open(output_path, "w") as f:
-                json.dump({
-                    "status": "failed",
-                    "error": str(e)
-                }, f)
-        except:
+                json.dump(output, f)
+        except OSError:
             pass  # Can't write output, exit anyway
-        
-        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+"""
+Long-lived bash process of a task.
+
+Blocks are written to a script file and sourced into the same shell, so `cd`, exported
+variables and activated venvs survive between blocks. Command boundaries are marked by a
+per-command sentinel printed to stdout (with exit code and cwd) and to stderr.
+"""
+import os
+import time
+import uuid
+import codecs
+import shlex
+import shutil
+import signal
+import tempfile
+import selectors
+import subprocess
+from pathlib import Path
+
+from .capture import BoundedCapture
+
+
+class BashTimeout(Exception):
+    pass
+
+
+class _SentinelStream:
+    """Feeds decoded pipe data into a capture until the sentinel token shows up."""
+
+    def __init__(self, capture: BoundedCapture, token: str, needs_newline: bool):
+        self.capture = capture
+        self.token = token
+        self.needs_newline = needs_newline  # stdout sentinel is followed by "<rc> <pwd>\n"
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.buffer = ""
+        self.trailer = None  # text after the token, once complete
+        self.eof = False
+
+    @property
+    def done(self) -> bool:
+        return self.trailer is not None or self.eof
+
+    def feed(self, chunk: bytes) -> None:
+        if not chunk:
+            self.eof = True
+            self.buffer += self.decoder.decode(b"", final=True)
+        else:
+            self.buffer += self.decoder.decode(chunk)
+
+        idx = self.buffer.find(self.token)
+        if idx == -1:
+            safe = len(self.buffer) if self.eof else _partial_token_start(self.buffer, self.token)
+            self.capture.write(self.buffer[:safe])
+            self.buffer = self.buffer[safe:]
+            return
+
+        self.capture.write(self.buffer[:idx])
+        self.buffer = self.buffer[idx:]
+        rest = self.buffer[len(self.token):]
+        if not self.needs_newline:
+            self.trailer = rest
+        elif "\n" in rest:
+            self.trailer = rest.split("\n", 1)[0]
+
+    def flush(self) -> None:
+        """Hand over held back text (possible partial token), used when the command is abandoned."""
+        if self.trailer is None:
+            self.capture.write(self.buffer)
+            self.buffer = ""
+
+
+def _partial_token_start(buffer: str, token: str) -> int:
+    """Index where a suffix of `buffer` that may be the beginning of `token` starts."""
+    start = max(0, len(buffer) - len(token) + 1)
+    idx = buffer.find(token[0], start)
+    while idx != -1:
+        if token.startswith(buffer[idx:]):
+            return idx
+        idx = buffer.find(token[0], idx + 1)
+    return len(buffer)
+
+
+class BashSession:
+    """One bash process per task, commands run with a per-command timeout."""
+
+    def __init__(self, cwd: str | None = None, init: str = ""):
+        self.cwd = cwd or os.getcwd()
+        self.init = init  # shell code run at every (re)start, e.g. function definitions
+        self.proc: subprocess.Popen | None = None
+        self.state_dir = Path(tempfile.mkdtemp(prefix="bash_session_"))
+        self.state_file = self.state_dir / "exports.sh"
+        self.script_file = self.state_dir / "block.sh"
+        self.restarts = 0
+
+    @property
+    def pid(self) -> int | None:
+        return self.proc.pid if self.proc else None
+
+    def is_alive(self) -> bool:
+        return self.proc is not None and self.proc.poll() is None
+
+    def cpu_time(self) -> float:
+        """CPU seconds used by the shell and the commands it waited for (utime + stime + cutime + cstime)."""
+        if not self.is_alive():
+            return 0.0
+        try:
+            with open(f"/proc/{self.proc.pid}/stat", "rb") as f:
+                fields = f.read().decode(errors="replace").rsplit(")", 1)[1].split()
+        except OSError:
+            return 0.0
+        return sum(int(ticks) for ticks in fields[11:15]) / os.sysconf("SC_CLK_TCK")
+
+    def start(self) -> None:
+        self.proc = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=self.cwd,
+        )
+        # Restore what the previous shell (if any) exported
+        self._send(f"[ -f {shlex.quote(str(self.state_file))} ] && . {shlex.quote(str(self.state_file))}\n")
+        if self.init:
+            self._send(self.init.strip() + "\n")
+
+    def _send(self, text: str) -> None:
+        self.proc.stdin.write(text.encode())
+        self.proc.stdin.flush()
+
+    def close(self) -> None:
+        if self.proc is not None:
+            self._kill()
+        shutil.rmtree(self.state_dir, ignore_errors=True)
+
+    def _kill(self) -> None:
+        # bash shares the worker's process group, so kill its process tree explicitly.
+        # bash goes first: it must not run the rest of the command line once its child dies
+        for pid in [self.proc.pid, *_descendants(self.proc.pid)]:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.proc.wait()
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                pipe.close()
+            except Exception:
+                pass
+        self.proc = None
+
+    def restart(self) -> None:
+        if self.proc is not None:
+            self._kill()
+        self.start()
+        self.restarts += 1
+
+    def run(self, code: str, stdout: BoundedCapture, stderr: BoundedCapture, timeout: float | None = None) -> int:
+        """Run `code` in the session, stream its output into the captures, return the exit code."""
+        if self.proc is None:
+            self.start()
+        elif not self.is_alive():
+            self.restart()
+
+        token = f"__BASH_DONE_{uuid.uuid4().hex}__"
+        self.script_file.write_text(code + "\n", encoding="utf-8")
+        script = shlex.quote(str(self.script_file))
+        state = shlex.quote(str(self.state_file))
+        self._send(
+            f". {script} < /dev/null\n"
+            f"__rc=$?; export -p > {state}.tmp && mv {state}.tmp {state}; printf '%s %d %s\\n' {token} \"$__rc\" \"$PWD\"; printf '%s' {token} >&2\n"
+        )
+
+        stdout_stream = _SentinelStream(stdout, token, needs_newline=True)
+        streams = {
+            self.proc.stdout: stdout_stream,
+            self.proc.stderr: _SentinelStream(stderr, token, needs_newline=False),
+        }
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        with selectors.DefaultSelector() as selector:
+            for pipe in streams:
+                selector.register(pipe, selectors.EVENT_READ)
+            while not all(s.done for s in streams.values()):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    for stream in streams.values():
+                        stream.flush()
+                    self.restart()
+                    raise BashTimeout(f"Command timed out after {timeout} seconds")
+                for key, _ in selector.select(remaining):
+                    stream = streams[key.fileobj]
+                    stream.feed(os.read(key.fd, 65536))
+                    if stream.done:
+                        selector.unregister(key.fileobj)
+
+        trailer = stdout_stream.trailer
+        if trailer is None:
+            # shell exited inside the block (`exit`, `set -e` ...): start a new one with restored state
+            returncode = self.proc.wait()
+            self.restart()
+            return returncode
+
+        rc, _, pwd = trailer.lstrip().partition(" ")
+        self.cwd = pwd or self.cwd
+        return int(rc)
+
+
+def _descendants(pid: int) -> list[int]:
+    """All live descendants of `pid`, found by scanning /proc."""
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "rb") as f:
+                stat = f.read().decode(errors="replace")
+        except OSError:
+            continue
+        ppid = int(stat.rsplit(")", 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+
+    result, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
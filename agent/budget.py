@@ -0,0 +1,88 @@
+"""
+Per-task budgets, checked by the worker at step and iteration boundaries.
+
+A budget limits one worker run: wall-clock seconds, LLM tokens, LLM cost (as reported by
+OpenRouter) and the step / iteration counts. When a limit is reached, or the task is
+cancelled (SIGTERM from the server), `exceeded()` returns the reason and the agent winds
+down: no new LLM calls or code blocks, the results of completed steps are returned.
+"""
+import time
+
+from pydantic import BaseModel
+
+
+class TaskBudget(BaseModel):
+    max_seconds: float | None = None  # wall-clock time of a run
+    max_tokens: int | None = None  # prompt + completion tokens of all LLM calls
+    max_cost_usd: float | None = None  # LLM cost reported by OpenRouter
+    max_steps: int | None = None  # plan steps (default MAX_TOTAL_STEPS)
+    max_iterations_per_step: int | None = None  # LLM turns per step (default MAX_ITERATIONS_PER_STEP)
+
+
+_budget = TaskBudget()
+_started = time.monotonic()
+_tokens = 0
+_cost = 0.0
+_cancelled = False
+_stopped: str | None = None
+
+
+def start(budget: dict | None) -> None:
+    """Begin a run under `budget` (TaskBudget fields, None for no limits)."""
+    global _budget, _started, _tokens, _cost, _cancelled, _stopped
+    _budget = TaskBudget.model_validate(budget or {})
+    _started = time.monotonic()
+    _tokens = 0
+    _cost = 0.0
+    _cancelled = False
+    _stopped = None
+
+
+def cancel(*_) -> None:
+    """Wind the task down at the next boundary (signal handler compatible)."""
+    global _cancelled
+    _cancelled = True
+
+
+def record_usage(tokens: int, cost: float | None = None) -> None:
+    global _tokens, _cost
+    _tokens += tokens
+    _cost += cost or 0.0
+
+
+def usage() -> dict:
+    return {"seconds": round(time.monotonic() - _started, 1), "tokens": _tokens, "cost_usd": round(_cost, 6)}
+
+
+def exceeded() -> str | None:
+    """Why the task must stop now, None while it is within budget."""
+    if _cancelled:
+        return "cancelled"
+    elapsed = time.monotonic() - _started
+    if _budget.max_seconds is not None and elapsed >= _budget.max_seconds:
+        return f"time budget of {_budget.max_seconds:g}s exhausted"
+    if _budget.max_tokens is not None and _tokens >= _budget.max_tokens:
+        return f"token budget of {_budget.max_tokens} exhausted"
+    if _budget.max_cost_usd is not None and _cost >= _budget.max_cost_usd:
+        return f"cost budget of ${_budget.max_cost_usd:g} exhausted"
+    return None
+
+
+def mark_stopped(reason: str) -> None:
+    """The agent wound down early for `reason` (reported with the result)."""
+    global _stopped
+    _stopped = reason
+
+
+def stopped_reason() -> str | None:
+    return _stopped
+
+
+def max_steps(default: int) -> int:
+    return min(default, _budget.max_steps) if _budget.max_steps is not None else default
+
+
+def max_iterations_per_step(default: int) -> int:
+    if _budget.max_iterations_per_step is None:
+        return default
+    return min(default, _budget.max_iterations_per_step)
@@ -0,0 +1,100 @@
+"""Bounded capture of code output: keeps head and tail in memory, streams full output to a file."""
+import io
+from collections import deque
+from pathlib import Path
+
+OUTPUT_HEAD_CHARS = 8_000
+OUTPUT_TAIL_CHARS = 8_000
+
+
+class BoundedCapture(io.TextIOBase):
+    """
+    Text stream for redirect_stdout and the bash session output.
+
+    Memory is bounded by `head_chars + tail_chars`: the first characters are kept as is,
+    the last ones in a ring buffer of chunks, everything in between is elided.
+    If `spill_path` is set, the complete output is streamed there (file is created on first write).
+    """
+
+    def __init__(self, spill_path: Path | None = None, head_chars: int = OUTPUT_HEAD_CHARS, tail_chars: int = OUTPUT_TAIL_CHARS):
+        self.spill_path = Path(spill_path) if spill_path else None
+        self.head_chars = head_chars
+        self.tail_chars = tail_chars
+        self._head: list[str] = []
+        self._head_len = 0
+        self._tail: deque[str] = deque()
+        self._tail_len = 0
+        self._spill_file = None
+        self.total_chars = 0
+        self.total_lines = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, s: str) -> int:
+        n = len(s)
+        if not n:
+            return 0
+        self.total_chars += n
+        self.total_lines += s.count("\n")
+        self._spill(s)
+
+        room = self.head_chars - self._head_len
+        if room > 0:
+            self._head.append(s[:room])
+            self._head_len += min(room, n)
+            s = s[room:]
+
+        if s:
+            s = s[-self.tail_chars:]  # a huge chunk only ever shows its end
+            self._tail.append(s)
+            self._tail_len += len(s)
+            # drop whole chunks that are entirely outside the tail window
+            while self._tail and self._tail_len - len(self._tail[0]) >= self.tail_chars:
+                self._tail_len -= len(self._tail.popleft())
+        return n
+
+    def _spill(self, s: str) -> None:
+        if self.spill_path is None:
+            return
+        if self._spill_file is None:
+            self.spill_path.parent.mkdir(parents=True, exist_ok=True)
+            self._spill_file = self.spill_path.open("w", encoding="utf-8", errors="replace")
+        self._spill_file.write(s)
+
+    def flush(self) -> None:
+        if self._spill_file is not None:
+            self._spill_file.flush()
+
+    def close(self) -> None:
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+        super().close()
+
+    @property
+    def truncated(self) -> bool:
+        return self.total_chars > self.head_chars + self.tail_chars
+
+    def getvalue(self) -> str:
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self.truncated:
+            return head + tail
+        tail = tail[-self.tail_chars:]
+        elided = self.total_chars - len(head) - len(tail)
+        marker = f"\n[... {elided} characters elided ({self.total_lines} lines in total)"
+        if self.spill_path is not None:
+            marker += f", full output: {self.spill_path}"
+        return head + marker + " ...]\n" + tail
+
+    def stats(self) -> dict:
+        shown = min(self.total_chars, self.head_chars + self.tail_chars)
+        return {
+            "total_chars": self.total_chars,
+            "total_lines": self.total_lines,
+            "elided_chars": self.total_chars - shown,
+            "truncated": self.truncated,
+            "spill_path": str(self.spill_path) if self.spill_path and self.total_chars else None,
+        }
+
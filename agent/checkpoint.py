@@ -0,0 +1,99 @@
+"""
+Per-step checkpoints of a task: agent state (plan, completed steps, digest) and PERSISTENT_GLOBALS.
+
+Layout of a checkpoint directory (inside the task spool):
+    state.json              - agent state, written atomically
+    globals/manifest.json   - per variable: pickled / module / unpicklable (with reason)
+    globals/<name>.pkl      - pickled value
+"""
+import json
+import os
+import pickle
+import shutil
+import types
+from pathlib import Path
+
+from .executor import PERSISTENT_GLOBALS
+
+STATE_FILE = "state.json"
+GLOBALS_DIR = "globals"
+
+
+def _write_json_atomic(path: Path, data: dict) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def save_state(checkpoint_dir: Path, state: dict) -> None:
+    checkpoint_dir = Path(checkpoint_dir)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    _write_json_atomic(checkpoint_dir / STATE_FILE, state)
+
+
+def load_state(checkpoint_dir: Path) -> dict | None:
+    path = Path(checkpoint_dir) / STATE_FILE
+    if not path.exists():
+        return None
+    with path.open("r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def dump_globals(checkpoint_dir: str) -> dict:
+    """Runs in the kernel process. Serializes PERSISTENT_GLOBALS, returns the manifest."""
+    target = Path(checkpoint_dir) / GLOBALS_DIR
+    staging = target.with_name(GLOBALS_DIR + ".new")
+    shutil.rmtree(staging, ignore_errors=True)
+    staging.mkdir(parents=True)
+
+    manifest = {}
+    for name, value in list(PERSISTENT_GLOBALS.items()):
+        if name.startswith("__"):
+            continue
+        if isinstance(value, types.ModuleType):
+            manifest[name] = {"kind": "module", "module": value.__name__}
+            continue
+        try:
+            with (staging / f"{name}.pkl").open("wb") as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            manifest[name] = {"kind": "pickled", "type": type(value).__name__}
+        except Exception as e:
+            (staging / f"{name}.pkl").unlink(missing_ok=True)
+            manifest[name] = {"kind": "unpicklable", "type": type(value).__name__, "error": f"{type(e).__name__}: {e}"}
+
+    _write_json_atomic(staging / "manifest.json", manifest)
+    # swap in the new snapshot, the previous one stays valid until this point
+    previous = target.with_name(GLOBALS_DIR + ".old")
+    shutil.rmtree(previous, ignore_errors=True)
+    if target.exists():
+        os.replace(target, previous)
+    os.replace(staging, target)
+    shutil.rmtree(previous, ignore_errors=True)
+    return manifest
+
+
+def load_globals(checkpoint_dir: str) -> dict:
+    """Runs in the kernel process. Restores PERSISTENT_GLOBALS, returns {name: reason} of what was not restored."""
+    import importlib
+
+    source = Path(checkpoint_dir) / GLOBALS_DIR
+    manifest_path = source / "manifest.json"
+    if not manifest_path.exists():
+        return {}
+    with manifest_path.open("r", encoding="utf-8") as f:
+        manifest = json.load(f)
+
+    missing = {}
+    for name, entry in manifest.items():
+        try:
+            if entry["kind"] == "module":
+                PERSISTENT_GLOBALS[name] = importlib.import_module(entry["module"])
+            elif entry["kind"] == "pickled":
+                with (source / f"{name}.pkl").open("rb") as f:
+                    PERSISTENT_GLOBALS[name] = pickle.load(f)
+            else:
+                missing[name] = f"not serializable ({entry['type']}): {entry['error']}"
+        except Exception as e:
+            missing[name] = f"restore failed: {type(e).__name__}: {e}"
+    return missing
@@ -1,63 +1,275 @@
 import os
-import io
+import time
+import atexit
+import threading
 import traceback
-from contextlib import redirect_stdout, redirect_stderr
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager, redirect_stdout, redirect_stderr
+from typing import Optional
 from pydantic import BaseModel
-import subprocess
 
+from .kernel import PythonKernel, ForkedKernel, KernelTimeout, KernelCrashed
+from .capture import BoundedCapture
+from .bash_session import BashSession, BashTimeout
+from .packages import SHELL_INIT
+from . import ipc, limits
+
+# Task namespace. It lives in the kernel subprocess: in the worker process this dict stays empty,
+# use `get_globals` / `call_in_kernel` to read it.
 PERSISTENT_GLOBALS = {
     "__builtins__": __builtins__,
 }
 
+PYTHON_TIMEOUT = 300  # wall-clock seconds per python block
+PYTHON_CPU_TIME_LIMIT = 300  # CPU seconds per python block
+BASH_TIMEOUT = 60
+CALL_GRACE = 60  # beyond its timeout a kernel call / bash block may take to interrupt or restart (heartbeats)
+
+# Opt-in per-block profiling (RSS delta, CPU time, top allocations), set by the server per task
+PROFILING = os.environ.get("AGENT_PROFILING", "") == "1"
+PROFILE_TOP_ALLOCATIONS = 5
+
+_kernel: PythonKernel | None = None
+_bash_session: BashSession | None = None
+_attempt = threading.local()  # kernel / bash session of a parallel step attempt, see `attempt_context`
+
+
 class CodeResponse(BaseModel):
     stdout: str
     stderr: str
     globals: dict = None
+    output_stats: dict = None  # {"stdout": BoundedCapture.stats(), "stderr": ...}
+    profile: Optional[dict] = None  # set when PROFILING is on
+    failed: bool = False  # exception, non-zero exit status, timeout or crash
+
+
+def _make_captures(spill_prefix: Path | None) -> tuple[BoundedCapture, BoundedCapture]:
+    """stdout/stderr captures; full output goes to `<spill_prefix>.stdout.txt` / `.stderr.txt`."""
+    if spill_prefix is None:
+        return BoundedCapture(), BoundedCapture()
+    spill_prefix = Path(spill_prefix)
+    return (
+        BoundedCapture(spill_prefix.with_name(spill_prefix.name + ".stdout.txt")),
+        BoundedCapture(spill_prefix.with_name(spill_prefix.name + ".stderr.txt")),
+    )
+
+
+def _close_captures(stdout_capture: BoundedCapture, stderr_capture: BoundedCapture) -> dict:
+    stats = {"stdout": stdout_capture.stats(), "stderr": stderr_capture.stats()}
+    stdout_capture.close()
+    stderr_capture.close()
+    return stats
+
+
+def get_kernel() -> PythonKernel:
+    global _kernel
+    kernel = getattr(_attempt, "kernel", None)
+    if kernel is not None:
+        return kernel
+    if _kernel is None:
+        _kernel = PythonKernel()
+    return _kernel
+
+
+def get_bash_session() -> BashSession:
+    global _bash_session
+    session = getattr(_attempt, "bash_session", None)
+    if session is not None:
+        return session
+    if _bash_session is None:
+        _bash_session = BashSession(cwd=os.getcwd(), init=SHELL_INIT)
+        atexit.register(_bash_session.close)
+    return _bash_session
+
+
+def call_in_kernel(func, *args, timeout: float | None = PYTHON_TIMEOUT):
+    """Run module-level `func(*args)` in the kernel process, where it can use PERSISTENT_GLOBALS directly."""
+    if timeout is None:
+        return get_kernel().call(func, *args, timeout=timeout)
+    with ipc.bounded(timeout + CALL_GRACE):
+        return get_kernel().call(func, *args, timeout=timeout)
+
+
+def interrupt_kernel() -> None:
+    """Interrupt the running python block, variables are kept."""
+    get_kernel().interrupt()
+
+
+def reset_kernel() -> None:
+    """Restart the kernel with an empty namespace."""
+    get_kernel().restart()
+
+
+def fork_kernel() -> ForkedKernel:
+    """Copy of the kernel with the current namespace (copy-on-write), for a parallel attempt."""
+    return get_kernel().fork()
+
+
+@contextmanager
+def attempt_context(kernel: ForkedKernel, bash_session: BashSession):
+    """Route this thread's python / bash blocks to an attempt's own kernel and shell."""
+    _attempt.kernel, _attempt.bash_session = kernel, bash_session
+    try:
+        yield
+    finally:
+        _attempt.kernel = _attempt.bash_session = None
+
+
+def adopt_attempt(kernel: ForkedKernel, bash_session: BashSession) -> None:
+    """Make an attempt's kernel and shell the task's; the previous ones are stopped."""
+    global _kernel, _bash_session
+    previous_kernel, _kernel = _kernel, kernel
+    kernel.adopted = True
+    if previous_kernel is not None:
+        previous_kernel.stop()
+    previous_session, _bash_session = _bash_session, bash_session
+    atexit.register(bash_session.close)
+    if previous_session is not None:
+        previous_session.close()
+
+
+def _get_globals(names) -> dict:
+    return {name: PERSISTENT_GLOBALS[name] for name in names if name in PERSISTENT_GLOBALS}
+
 
-def execute_python(code: str):
-    stdout_capture = io.StringIO()
-    stderr_capture = io.StringIO()
+def get_globals(*names: str) -> dict:
+    """Fetch (picklable) values of the given variables from the task namespace."""
+    return call_in_kernel(_get_globals, names)
+
+
+def _execute_python_local(code: str, spill_prefix: Path | None = None) -> CodeResponse:
+    stdout_capture, stderr_capture = _make_captures(spill_prefix)
+    stderr = ""
+    failed = False
     
     try:
         with redirect_stdout(stdout_capture), redirect_stderr(stderr_capture):
             exec(code, PERSISTENT_GLOBALS)
-        
-        return CodeResponse(
-            stdout=stdout_capture.getvalue(),
-            stderr="",
-            globals=PERSISTENT_GLOBALS,
-        )
+    except BaseException as e:  # also KeyboardInterrupt (timeout) and CpuTimeExceeded
+        stderr_capture.write(traceback.format_exc())
+        stderr = stderr_capture.getvalue()
+        failed = True
+
+    stdout = stdout_capture.getvalue()
+    return CodeResponse(
+        stdout=stdout,
+        stderr=stderr,
+        output_stats=_close_captures(stdout_capture, stderr_capture),
+        failed=failed,
+    )
+
+
+def current_rss() -> int:
+    """Resident set size of this process in bytes, 0 where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def _execute_python_profiled(code: str, spill_prefix: Path | None = None) -> CodeResponse:
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+    tracemalloc.clear_traces()
+    tracemalloc.reset_peak()
+    rss_before = current_rss()
+    cpu_before = time.process_time()
+    wall_before = time.monotonic()
+
+    response = _execute_python_local(code, spill_prefix)
+
+    cpu_seconds = time.process_time() - cpu_before
+    wall_seconds = time.monotonic() - wall_before
+    traced, traced_peak = tracemalloc.get_traced_memory()
+    # allocations made by the block and still alive, by source line
+    top = tracemalloc.take_snapshot().statistics("lineno")[:PROFILE_TOP_ALLOCATIONS]
+    rss_after = current_rss()
+    response.profile = {
+        "wall_seconds": round(wall_seconds, 3),
+        "cpu_seconds": round(cpu_seconds, 3),
+        "rss_before": rss_before,
+        "rss_after": rss_after,
+        "rss_delta": rss_after - rss_before,
+        "traced_bytes": traced,
+        "traced_peak_bytes": traced_peak,
+        "top_allocations": [
+            {"where": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}", "bytes": stat.size, "count": stat.count}
+            for stat in top
+        ],
+    }
+    return response
+
+
+def _report_limit(stderr: str, exit_code: int | None = None) -> None:
+    """Tell the server when the kernel ran into a resource limit; the task itself goes on."""
+    hit = limits.check_kernel(stderr, exit_code)
+    if hit is not None:
+        ipc.send("limit", reason=hit[0], detail=hit[1])
+
+
+def execute_python(
+    code: str,
+    spill_prefix: Path | None = None,
+    timeout: float = PYTHON_TIMEOUT,
+    cpu_time_limit: float = PYTHON_CPU_TIME_LIMIT,
+) -> CodeResponse:
+    run = _execute_python_profiled if PROFILING else _execute_python_local
+    try:
+        with ipc.bounded(timeout + CALL_GRACE):
+            response = get_kernel().call(run, code, spill_prefix, timeout=timeout, cpu_time_limit=cpu_time_limit)
+        if response.stderr:
+            _report_limit(response.stderr)
+        return response
+    except KernelTimeout as e:
+        if e.result is not None:
+            return e.result.model_copy(update={"stderr": f"{e}. Variables are kept.\n{e.result.stderr}", "failed": True})
+        return CodeResponse(stdout="", stderr=str(e), failed=True)
+    except KernelCrashed as e:
+        _report_limit("", e.exit_code)
+        return CodeResponse(stdout="", stderr=f"{e}. Re-create the variables you need.", failed=True)
     except Exception as e:
-        return CodeResponse(
-            stdout=stdout_capture.getvalue(),
-            stderr=traceback.format_exc(),
-            globals=PERSISTENT_GLOBALS,
-        )
+        return CodeResponse(stdout="", stderr=f"Python execution error: {e}", failed=True)
 
 
-def execute_bash(code: str) -> CodeResponse:
+def execute_bash(code: str, spill_prefix: Path | None = None) -> CodeResponse:
+    stdout_capture, stderr_capture = _make_captures(spill_prefix)
+    session = get_bash_session()
     try:
-        result = subprocess.run(
-            ['bash', '-c', code],
-            capture_output=True,
-            text=True,
-            cwd=os.getcwd(),  # Use current working directory
-            timeout=60,
-        )
+        cpu_before = session.cpu_time() if PROFILING else 0.0
+        wall_before = time.monotonic()
+        with ipc.bounded(BASH_TIMEOUT + CALL_GRACE):
+            returncode = session.run(code, stdout_capture, stderr_capture, timeout=BASH_TIMEOUT)
+        profile = None
+        if PROFILING:
+            profile = {
+                "wall_seconds": round(time.monotonic() - wall_before, 3),
+                "cpu_seconds": round(max(0.0, session.cpu_time() - cpu_before), 3),  # 0 if the shell was restarted
+                "returncode": returncode,
+            }
         return CodeResponse(
-            stdout=result.stdout,
-            stderr=result.stderr if result.returncode != 0 else "",
+            stdout=stdout_capture.getvalue(),
+            stderr=stderr_capture.getvalue() if returncode != 0 else "",
             globals=PERSISTENT_GLOBALS,
+            output_stats=_close_captures(stdout_capture, stderr_capture),
+            profile=profile,
+            failed=returncode != 0,
         )
-    except subprocess.TimeoutExpired:
+    except BashTimeout as e:
         return CodeResponse(
-            stdout="",
-            stderr="Command timed out after 60 seconds",
+            stdout=stdout_capture.getvalue(),
+            stderr=f"{e}. Bash session restarted: cwd and exported variables are kept, other shell state is lost.\n"
+                   f"{stderr_capture.getvalue()}",
             globals=PERSISTENT_GLOBALS,
+            output_stats=_close_captures(stdout_capture, stderr_capture),
+            failed=True,
         )
     except Exception as e:
+        _close_captures(stdout_capture, stderr_capture)
         return CodeResponse(
             stdout="",
             stderr=f"Bash execution error: {str(e)}",
             globals=PERSISTENT_GLOBALS,
-        )
\ No newline at end of file
+            failed=True,
+        )
@@ -0,0 +1,169 @@
+"""
+Framed message channel between the server and a worker process.
+
+The server creates a socketpair per worker and passes one end to it (`pass_fds`, the fd
+number in AGENT_IPC_FD). Messages are JSON objects with a "type", each sent as a 4-byte
+big-endian length followed by the UTF-8 body:
+
+    server -> worker:  input      task_id, task, resume, profile, spawned_at_us
+    worker -> server:  heartbeat  every HEARTBEAT_INTERVAL seconds while the worker makes progress
+                       progress   phase ("planned", "step", "decision") and details
+                       partial    result of a finished step
+                       limit      reason, detail: the kernel ran into a resource limit (limits.py)
+                       result     status ("completed" / "failed"), result or error
+
+Spool files (input.json / output.json) are only written as an audit trail (SPOOL_AUDIT).
+
+Heartbeats come from a thread, so they only go out while the main loop makes progress:
+it sent another message, or finished a call, within PROGRESS_TIMEOUT seconds, or it is
+inside a call with its own time limit (`bounded`: LLM request, code block). A worker
+deadlocked elsewhere goes silent and the server kills it.
+"""
+import json
+import os
+import socket
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+IPC_FD_ENV = "AGENT_IPC_FD"
+SPOOL_AUDIT_ENV = "AGENT_SPOOL_AUDIT"
+HEARTBEAT_INTERVAL = 5  # seconds between worker heartbeats
+PROGRESS_TIMEOUT = 120  # seconds without progress (outside bounded calls) before heartbeats stop
+MAX_FRAME_BYTES = 64 * 1024 * 1024
+
+_HEADER = struct.Struct(">I")
+
+
+class FrameTooLarge(ValueError):
+    """A message over MAX_FRAME_BYTES; it was skipped, the channel stays usable."""
+
+
+class Channel:
+    """One end of a framed stream socket; `send` is thread-safe, `recv` is for one reader."""
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._send_lock = threading.Lock()
+
+    def send(self, message: dict) -> None:
+        body = json.dumps(message, ensure_ascii=False, default=str).encode("utf-8")
+        with self._send_lock:
+            self.sock.sendall(_HEADER.pack(len(body)) + body)
+
+    def recv(self) -> dict | None:
+        """Next message, None once the other end is closed."""
+        header = self._recv_exact(_HEADER.size)
+        if header is None:
+            return None
+        (length,) = _HEADER.unpack(header)
+        if length > MAX_FRAME_BYTES:
+            if not self._discard(length):
+                return None
+            raise FrameTooLarge(f"IPC frame too large: {length} bytes, skipped")
+        body = self._recv_exact(length)
+        if body is None:
+            return None
+        return json.loads(body)
+
+    def _recv_exact(self, n: int) -> bytes | None:
+        buf = bytearray()
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                return None
+            buf += chunk
+        return bytes(buf)
+
+    def _discard(self, n: int) -> bool:
+        while n > 0:
+            chunk = self.sock.recv(min(n, 1024 * 1024))
+            if not chunk:
+                return False
+            n -= len(chunk)
+        return True
+
+    def close(self) -> None:
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def channel_pair() -> tuple[Channel, socket.socket]:
+    """Server end as a Channel, and the socket to hand to the worker."""
+    server_end, worker_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    worker_end.set_inheritable(True)
+    return Channel(server_end), worker_end
+
+
+# --- worker side ---
+_channel: Channel | None = None
+_heartbeat_stop = threading.Event()
+_progress_at = time.monotonic()
+_bounded: dict[int, float] = {}  # thread -> monotonic deadline of its bounded call
+
+
+def connect() -> Channel | None:
+    """Channel inherited from the server, None when the worker runs standalone."""
+    global _channel
+    fd = os.environ.pop(IPC_FD_ENV, None)  # not inherited by the kernel or bash
+    if fd is None:
+        return None
+    _channel = Channel(socket.socket(fileno=int(fd)))
+    return _channel
+
+
+def send(message_type: str, **fields) -> None:
+    """Send a message to the server; a no-op without a channel, never raises."""
+    global _channel
+    if message_type != "heartbeat":
+        progress()
+    if _channel is None:
+        return
+    try:
+        _channel.send({"type": message_type, **fields})
+    except OSError as e:
+        print(f"⚠️ IPC channel to server lost: {e}")
+        _channel = None
+
+
+def progress() -> None:
+    """The main loop moved on."""
+    global _progress_at
+    _progress_at = time.monotonic()
+
+
+@contextmanager
+def bounded(seconds: float):
+    """The calling thread is inside a call that ends within `seconds`; heartbeats go on meanwhile."""
+    thread = threading.get_ident()
+    previous = _bounded.get(thread)
+    _bounded[thread] = time.monotonic() + seconds
+    try:
+        yield
+    finally:
+        if previous is None:
+            _bounded.pop(thread, None)
+        else:
+            _bounded[thread] = previous
+        progress()
+
+
+def _making_progress() -> bool:
+    now = time.monotonic()
+    return now - _progress_at < PROGRESS_TIMEOUT or any(deadline > now for deadline in list(_bounded.values()))
+
+
+def start_heartbeat(interval: float = HEARTBEAT_INTERVAL) -> None:
+    def _beat():
+        while _channel is not None and not _heartbeat_stop.wait(interval):
+            if _making_progress():
+                send("heartbeat")
+
+    threading.Thread(target=_beat, name="ipc-heartbeat", daemon=True).start()
+
+
+def spool_audit() -> bool:
+    return os.environ.get(SPOOL_AUDIT_ENV, "1") == "1"
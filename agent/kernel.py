@@ -0,0 +1,354 @@
+"""
+Out-of-process python kernel.
+
+The kernel is a child process of the task worker which owns the task namespace
+(`PERSISTENT_GLOBALS`). The worker sends it functions to run, so agent code can be
+interrupted on a wall-clock timeout (SIGINT, namespace is kept), stopped on a CPU
+time limit, or killed and restarted if it does not respond or crashes.
+
+`PythonKernel.fork` makes a copy-on-write copy of a kernel, namespace included (parallel
+step attempts). The copy is a child of the kernel; the worker talks to it over a socket
+it passed to the kernel. The worker becomes a child subreaper when it first forks, so copies
+outliving their kernel (an adopted attempt) are re-parented to the worker and reaped by it.
+"""
+import os
+import time
+import atexit
+import ctypes
+import pickle
+import signal
+import socket
+import traceback
+import multiprocessing
+from multiprocessing import reduction
+from multiprocessing.connection import Connection
+
+from . import sampler
+
+INTERRUPT_GRACE = 5  # seconds to wait for the kernel to react to SIGINT before killing it
+FORK_TIMEOUT = 30  # seconds for the kernel to fork a copy
+PR_SET_CHILD_SUBREAPER = 36
+
+# kernel process side
+_main_conn = None  # connection to the worker
+_forks: set[int] = set()  # pids of forked copies, reaped by this kernel
+
+# worker process side
+_subreaper = False  # set up on the first fork
+
+
+class KernelError(Exception):
+    """Kernel could not complete the call."""
+
+
+class KernelTimeout(KernelError):
+    """Call exceeded its wall-clock limit. `result` is set if the kernel survived the interrupt."""
+
+    def __init__(self, message: str, result=None, restarted: bool = False):
+        super().__init__(message)
+        self.result = result
+        self.restarted = restarted
+
+
+class KernelCrashed(KernelError):
+    """Kernel process died during the call, it was restarted with an empty namespace.
+
+    `exit_code` is the dead kernel's (negative: killed by that signal), None if unknown.
+    """
+
+    def __init__(self, message: str, exit_code: int | None = None):
+        super().__init__(message)
+        self.exit_code = exit_code
+
+
+class CpuTimeExceeded(BaseException):
+    """Raised inside the kernel when a call uses more CPU time than allowed.
+
+    BaseException, so agent code with a broad `except Exception` cannot swallow it.
+    """
+
+
+def _on_cpu_time_exceeded(signum, frame):
+    raise CpuTimeExceeded("CPU time limit exceeded")
+
+
+def _send_uninterrupted(conn, message) -> None:
+    # A late SIGINT must not tear a half-written message; it is delivered (and ignored) after the send
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGINT})
+    try:
+        conn.send(message)
+    finally:
+        try:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGINT})
+        except KeyboardInterrupt:
+            pass
+
+
+def _send_reply(conn, reply) -> None:
+    try:
+        _send_uninterrupted(conn, reply)
+    except (TypeError, AttributeError, ValueError, pickle.PicklingError):
+        _send_uninterrupted(conn, ("error", traceback.format_exc()))  # result is not picklable
+
+
+def _reap_forks() -> None:
+    for pid in list(_forks):
+        try:
+            if os.waitpid(pid, os.WNOHANG)[0]:
+                _forks.discard(pid)
+        except ChildProcessError:
+            _forks.discard(pid)
+
+
+def _become_subreaper() -> None:
+    """Orphaned descendants are re-parented to this process instead of init."""
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.prctl(PR_SET_CHILD_SUBREAPER, 1, 0, 0, 0) != 0:
+        raise OSError(ctypes.get_errno(), "prctl(PR_SET_CHILD_SUBREAPER) failed")
+
+
+def _fork() -> int:
+    """Runs in the kernel: fork a copy serving the connection the worker sends next; returns its pid."""
+    global _forks
+    fd = reduction.recv_handle(_main_conn)
+    _reap_forks()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            _main_conn.close()  # the copy only serves its own connection
+            _forks = set()
+            _kernel_main(Connection(fd))
+        finally:
+            os._exit(0)
+    os.close(fd)
+    _forks.add(pid)
+    return pid
+
+
+def _kernel_main(conn) -> None:
+    global _main_conn
+    _main_conn = conn
+    signal.signal(signal.SIGPROF, _on_cpu_time_exceeded)
+    if os.environ.get("AGENT_PROFILE_REQUEST"):
+        sampler.install(os.environ["AGENT_PROFILE_REQUEST"], "kernel")
+
+    while True:
+        reply = None  # set once a call is received: the worker waits for exactly one reply
+        try:
+            try:
+                message = conn.recv()
+            except EOFError:
+                break  # worker is gone
+
+            func, args, cpu_time_limit = message
+            reply = ("error", "KeyboardInterrupt: interrupted before the call started")
+            if _forks:
+                _reap_forks()  # copies stopped since the last call
+            try:
+                if cpu_time_limit:
+                    signal.setitimer(signal.ITIMER_PROF, cpu_time_limit)
+                reply = ("ok", func(*args))
+            except BaseException:
+                reply = ("error", traceback.format_exc())
+            finally:
+                signal.setitimer(signal.ITIMER_PROF, 0)
+
+            _send_reply(conn, reply)
+            reply = None
+        except (KeyboardInterrupt, CpuTimeExceeded):
+            # the signal landed after the call ended (e.g. in the `finally`): its reply is still
+            # owed, without it the worker would restart the kernel and lose the namespace
+            if reply is not None:
+                _send_reply(conn, reply)
+
+
+class PythonKernel:
+    """Worker-side handle of the kernel subprocess."""
+
+    def __init__(self):
+        self.process = None
+        self.conn = None
+        self.restarts = 0
+        # not a daemon process (it forks attempt copies), so stop it before multiprocessing joins it
+        atexit.register(self.stop)
+
+    @property
+    def pid(self) -> int | None:
+        return self.process.pid if self.process else None
+
+    def is_alive(self) -> bool:
+        return self.process is not None and self.process.is_alive()
+
+    def start(self) -> None:
+        ctx = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_kernel_main, args=(child_conn,), name="python-kernel")
+        # the kernel inherits a blocked SIGUSR1 and unblocks it once its sampler handler is installed
+        mask = signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+        try:
+            self.process.start()
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        child_conn.close()
+        self.conn = parent_conn
+
+    def stop(self) -> None:
+        if self.process is None:
+            return
+        try:
+            if self.process.is_alive():
+                self.process.kill()
+            # is_alive reaps; not join, which waits on a sentinel pipe that forked copies keep open
+            deadline = time.monotonic() + 1
+            while self.process.is_alive() and time.monotonic() < deadline:
+                time.sleep(0.01)
+            self.conn.close()
+        except Exception:
+            pass  # never started or already gone
+        self.process = None
+        self.conn = None
+
+    def restart(self) -> None:
+        self.stop()
+        self.start()
+        self.restarts += 1
+        print(f"⚠️ Python kernel restarted (restart #{self.restarts})")
+
+    def interrupt(self) -> None:
+        """SIGINT the kernel: the running call raises KeyboardInterrupt, the namespace is kept."""
+        if self.is_alive():
+            os.kill(self.process.pid, signal.SIGINT)
+
+    def call(self, func, *args, timeout: float | None = None, cpu_time_limit: float | None = None):
+        """Run `func(*args)` inside the kernel and return its result."""
+        if self.process is None:
+            self.start()
+        elif not self.is_alive():
+            self.restart()  # crashed between calls
+
+        try:
+            self.conn.send((func, args, cpu_time_limit))
+            if self.conn.poll(timeout):
+                return self._receive()
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            exit_code = self._exit_code()
+            self.restart()
+            raise KernelCrashed("Python kernel process died, all variables were lost", exit_code)
+
+        # Wall-clock limit: try a soft interrupt first, kill the kernel if it does not react
+        self.interrupt()
+        message = f"Execution interrupted after {timeout} seconds"
+        try:
+            if self.conn.poll(INTERRUPT_GRACE):
+                raise KernelTimeout(message, result=self._receive())
+        except KernelError as e:
+            if isinstance(e, KernelTimeout):
+                raise
+            raise KernelTimeout(f"{message}\n{e}")  # the call itself did not survive the interrupt
+        except (EOFError, BrokenPipeError, ConnectionResetError):
+            pass
+
+        self.restart()
+        raise KernelTimeout(
+            f"Execution did not stop {INTERRUPT_GRACE} seconds after interrupt, kernel restarted, all variables were lost",
+            restarted=True,
+        )
+
+    def _exit_code(self, wait: float = 1) -> int | None:
+        """Exit code of a kernel that closed its connection, once it is reaped."""
+        deadline = time.monotonic() + wait
+        while self.process.is_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return self.process.exitcode
+
+    def _receive(self):
+        status, value = self.conn.recv()
+        if status == "error":
+            raise KernelError(value)
+        return value
+
+    def fork(self) -> "ForkedKernel":
+        """Copy of this kernel with its current namespace."""
+        global _subreaper
+        if not _subreaper:
+            try:
+                _become_subreaper()
+            except (OSError, AttributeError) as e:
+                print(f"⚠️ Forked kernels are reaped by init: {e}")
+            _subreaper = True
+        if self.process is None:
+            self.start()
+        elif not self.is_alive():
+            self.restart()
+        ours, theirs = socket.socketpair()
+        try:
+            self.conn.send((_fork, (), None))
+            reduction.send_handle(self.conn, theirs.fileno(), self.process.pid)
+            if not self.conn.poll(FORK_TIMEOUT):
+                raise KernelError("Kernel did not fork in time")
+            pid = self._receive()
+        except BaseException:
+            ours.close()
+            raise
+        finally:
+            theirs.close()
+        return ForkedKernel(pid, Connection(ours.detach()))
+
+
+class _ForkedProcess:
+    """Process handle of a forked kernel: a child of the kernel, or of the worker once the kernel is gone."""
+
+    def __init__(self, pid: int):
+        self.pid = pid
+        self.reaped = False
+        self.exitcode = None  # known if the worker reaped it
+
+    def _reap(self) -> bool:
+        """Reap the copy if it is the worker's child and has exited; True once it is gone."""
+        if self.reaped:
+            return True
+        try:
+            pid, wait_status = os.waitpid(self.pid, os.WNOHANG)
+            if pid:
+                self.reaped, self.exitcode = True, os.waitstatus_to_exitcode(wait_status)
+        except ChildProcessError:
+            self.reaped = _process_state(self.pid) in (None, "Z", "X")  # still the kernel's child
+        return self.reaped
+
+    def is_alive(self) -> bool:
+        return not self._reap()
+
+    def kill(self) -> None:
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+
+def _process_state(pid: int) -> str | None:
+    """State letter from /proc (Z for a zombie), None if there is no such process."""
+    try:
+        with open(f"/proc/{pid}/stat", "rb") as f:
+            stat = f.read()
+    except OSError:
+        return None
+    return stat[stat.rfind(b")") + 2:].split()[0].decode()
+
+
+class ForkedKernel(PythonKernel):
+    """Kernel copy made by `PythonKernel.fork`.
+
+    A copy cannot be re-created, so it never restarts while it belongs to an attempt;
+    once `adopted` as the task kernel it restarts like any kernel (fresh namespace).
+    """
+
+    def __init__(self, pid: int, conn):
+        super().__init__()
+        self.process = _ForkedProcess(pid)
+        self.conn = conn
+        self.adopted = False
+
+    def start(self) -> None:
+        if not self.adopted:
+            raise KernelCrashed("Attempt kernel is gone")
+        super().start()
@@ -0,0 +1,182 @@
+"""
+Per-worker resource limits and accounting.
+
+Set on the worker right after spawn (prlimit) and inherited by its kernel and shell, each
+process holding its own allowance:
+
+    memory_mb      RLIMIT_AS, address space (allocations fail with MemoryError)
+    cpu_seconds    RLIMIT_CPU, CPU time (SIGXCPU, SIGKILL CPU_KILL_GRACE seconds later)
+    file_size_mb   RLIMIT_FSIZE, largest file written (writes fail with EFBIG)
+
+Checked for the task as a whole by the server every LIMIT_CHECK_INTERVAL seconds:
+
+    max_processes  processes in the worker's process group
+    disk_mb        bytes under the task work directory
+
+Server defaults come from the environment (0 = unlimited); a task can ask for lower limits,
+never higher. After exit the worker's rusage (wait4) is stored with the task. The worker
+reports limits its kernel runs into (`check_kernel`) while the task goes on.
+"""
+import os
+import errno
+import resource
+import signal
+from pathlib import Path
+
+from pydantic import BaseModel
+
+from .task_storage import dir_size
+
+LIMIT_CHECK_INTERVAL = 10  # seconds between process count / disk quota checks
+CPU_KILL_GRACE = 5  # hard RLIMIT_CPU above the soft one
+MB = 1024 * 1024
+
+# failure_reason of a task whose worker exceeded a limit
+MEMORY_LIMIT = "memory_limit"
+CPU_LIMIT = "cpu_limit"
+FILE_SIZE_LIMIT = "file_size_limit"
+PROCESS_LIMIT = "process_limit"
+DISK_QUOTA = "disk_quota"
+
+
+class ResourceLimits(BaseModel):
+    memory_mb: int | None = None
+    cpu_seconds: int | None = None
+    file_size_mb: int | None = None
+    max_processes: int | None = None
+    disk_mb: int | None = None
+
+
+def _env_limit(name: str, default: int) -> int | None:
+    value = int(os.environ.get(name, default))
+    return value if value > 0 else None
+
+
+DEFAULT_LIMITS = ResourceLimits(
+    memory_mb=_env_limit("AGENT_LIMIT_MEMORY_MB", 8192),
+    cpu_seconds=_env_limit("AGENT_LIMIT_CPU_SECONDS", 7200),
+    file_size_mb=_env_limit("AGENT_LIMIT_FILE_SIZE_MB", 2048),
+    max_processes=_env_limit("AGENT_LIMIT_PROCESSES", 256),
+    disk_mb=_env_limit("AGENT_LIMIT_DISK_MB", 10240),
+)
+
+
+def effective(requested: dict | None) -> dict:
+    """Limits of a task: the requested ones, capped by the server defaults."""
+    requested = ResourceLimits.model_validate(requested or {})
+    limits = {}
+    for name, default in DEFAULT_LIMITS.model_dump().items():
+        values = [v for v in (default, getattr(requested, name)) if v is not None]
+        limits[name] = min(values) if values else None
+    return limits
+
+
+def _set(pid: int, limit: int, soft: int, hard: int | None = None) -> None:
+    _, current_hard = resource.prlimit(pid, limit)
+    hard = soft if hard is None else hard
+    if current_hard != resource.RLIM_INFINITY:
+        soft, hard = min(soft, current_hard), min(hard, current_hard)
+    resource.prlimit(pid, limit, (soft, hard))
+
+
+def apply(pid: int, limits: dict) -> None:
+    """Set the per-process limits on a freshly spawned worker."""
+    try:
+        if limits.get("memory_mb"):
+            _set(pid, resource.RLIMIT_AS, limits["memory_mb"] * MB)
+        if limits.get("cpu_seconds"):
+            _set(pid, resource.RLIMIT_CPU, limits["cpu_seconds"], limits["cpu_seconds"] + CPU_KILL_GRACE)
+        if limits.get("file_size_mb"):
+            _set(pid, resource.RLIMIT_FSIZE, limits["file_size_mb"] * MB)
+    except (OSError, ValueError) as e:
+        print(f"⚠️ Resource limits not applied to PID={pid}: {e}")
+
+
+def count_processes(pgid: int) -> int:
+    count = 0
+    for entry in os.scandir("/proc"):
+        if not entry.name.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry.name}/stat", "rb") as f:
+                stat = f.read()
+        except OSError:
+            continue  # exited
+        fields = stat[stat.rfind(b")") + 2:].split()  # state, ppid, pgrp, ...
+        if int(fields[2]) == pgid:
+            count += 1
+    return count
+
+
+def check_running(limits: dict, pgid: int, work_dir: Path) -> tuple[str, str] | None:
+    """(failure reason, detail) if a running task is over its process or disk limit."""
+    if limits.get("max_processes"):
+        processes = count_processes(pgid)
+        if processes > limits["max_processes"]:
+            return PROCESS_LIMIT, f"{processes} processes, limit {limits['max_processes']}"
+    if limits.get("disk_mb") and work_dir.is_dir():
+        used = dir_size(work_dir)
+        if used > limits["disk_mb"] * MB:
+            return DISK_QUOTA, f"{used / MB:.0f} MB in the work directory, quota {limits['disk_mb']} MB"
+    return None
+
+
+def check_exited(limits: dict, exit_code: int, rusage: dict | None, error: str) -> tuple[str, str] | None:
+    """(failure reason, detail) if a failed worker ran into one of its per-process limits.
+
+    `error` is the worker's exception as "Type: message" (or the last stderr line).
+    """
+    cpu = (rusage or {}).get("cpu_seconds", 0)
+    if exit_code == -signal.SIGXCPU or (limits.get("cpu_seconds") and exit_code == -signal.SIGKILL
+                                        and cpu >= limits["cpu_seconds"]):
+        if not limits.get("cpu_seconds"):
+            return CPU_LIMIT, "CPU time limit exceeded"  # set by the process itself
+        return CPU_LIMIT, f"CPU time limit of {limits['cpu_seconds']}s exceeded"
+    if limits.get("file_size_mb") and (exit_code == -signal.SIGXFSZ or f"[Errno {errno.EFBIG}]" in error):
+        return FILE_SIZE_LIMIT, f"file size limit of {limits['file_size_mb']} MB exceeded"
+    # address space runs out for thread stacks too; numpy & co. raise MemoryError subclasses
+    if limits.get("memory_mb") and (error.split(":", 1)[0].endswith("MemoryError") or "can't start new thread" in error):
+        return MEMORY_LIMIT, f"memory limit of {limits['memory_mb']} MB exceeded"
+    return None
+
+
+def process_limits() -> dict:
+    """Per-process limits this process runs under (set on the worker, inherited by its kernel)."""
+    def _get(limit, unit):
+        soft, _ = resource.getrlimit(limit)
+        return None if soft == resource.RLIM_INFINITY else soft // unit
+    return {
+        "memory_mb": _get(resource.RLIMIT_AS, MB),
+        "cpu_seconds": _get(resource.RLIMIT_CPU, 1),
+        "file_size_mb": _get(resource.RLIMIT_FSIZE, MB),
+    }
+
+
+def check_kernel(stderr: str, exit_code: int | None = None) -> tuple[str, str] | None:
+    """(failure reason, detail) if a python block failed on, or its kernel died of, a per-process limit."""
+    lines = stderr.strip().splitlines()
+    return check_exited(process_limits(), exit_code or 0, None, lines[-1] if lines else "")
+
+
+def last_line(path: Path, size: int = 4096) -> str:
+    try:
+        with open(path, "rb") as f:
+            f.seek(max(0, os.fstat(f.fileno()).st_size - size))
+            lines = f.read().decode("utf-8", "replace").strip().splitlines()
+    except OSError:
+        return ""
+    return lines[-1] if lines else ""
+
+
+def rusage_summary(ru) -> dict:
+    """Accounting of a reaped worker (and the children it waited for: kernel, shell)."""
+    return {
+        "cpu_seconds": round(ru.ru_utime + ru.ru_stime, 3),
+        "user_seconds": round(ru.ru_utime, 3),
+        "system_seconds": round(ru.ru_stime, 3),
+        "max_rss_mb": round(ru.ru_maxrss / 1024, 1),  # ru_maxrss is in KB on Linux
+        "block_reads": ru.ru_inblock,
+        "block_writes": ru.ru_oublock,
+        "voluntary_switches": ru.ru_nvcsw,
+        "involuntary_switches": ru.ru_nivcsw,
+    }
@@ -0,0 +1,123 @@
+"""
+Release of dead variables between steps.
+
+A variable is live while a remaining step of the plan lists it in `input_variables`.
+After each step, large dead variables are removed from PERSISTENT_GLOBALS. They are
+pickled into a spill directory first, so a replan that needs them again gets them back.
+`release_variables` / `restore_variables` run in the kernel process (see `call_in_kernel`).
+A spill file outlives its restore until a globals checkpoint holds the variable again
+(`discard_spilled`), so a resume from an older checkpoint can still restore it.
+"""
+import gc
+import itertools
+import pickle
+import sys
+import types
+from pathlib import Path
+
+from .executor import PERSISTENT_GLOBALS, current_rss
+
+LIVENESS_MIN_BYTES = 16 * 1024 * 1024  # smaller variables are not worth releasing
+LIVENESS_SPILL = True  # pickle released variables so they can be restored
+LIVENESS_SCOPE = "declared"  # "declared": outputs of completed steps only; "all": every global
+LIVENESS_KEEP = {"final_answer", "step_status"}
+
+_SIZE_SAMPLE = 100  # elements measured per container, the rest is extrapolated
+
+
+def estimate_size(value) -> int:
+    """Approximate memory held by `value` in bytes, cheap for large containers."""
+    memory_usage = getattr(value, "memory_usage", None)  # pandas DataFrame / Series
+    if callable(memory_usage) and hasattr(value, "shape"):
+        try:
+            usage = memory_usage(deep=False)
+            return int(usage.sum() if hasattr(usage, "sum") else usage)
+        except Exception:
+            pass
+    nbytes = getattr(value, "nbytes", None)  # numpy arrays
+    if isinstance(nbytes, int):
+        return nbytes
+
+    size = sys.getsizeof(value, 0)
+    if isinstance(value, (str, bytes, bytearray)):
+        return size
+    if isinstance(value, dict):
+        items = list(itertools.islice(value.items(), _SIZE_SAMPLE))
+        sample = sum(sys.getsizeof(k, 0) + sys.getsizeof(v, 0) for k, v in items)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        items = list(itertools.islice(value, _SIZE_SAMPLE))
+        sample = sum(sys.getsizeof(v, 0) for v in items)
+    else:
+        return size
+    if items:
+        size += sample * len(value) // len(items)
+    return size
+
+
+def _releasable(name: str, value) -> bool:
+    return not (
+        name.startswith("_")
+        or name in LIVENESS_KEEP
+        or isinstance(value, (types.ModuleType, types.FunctionType, type))
+    )
+
+
+def release_variables(candidates: list[str] | None, live: list[str], spill_dir: str | None,
+                      min_bytes: int = LIVENESS_MIN_BYTES) -> dict:
+    """Runs in the kernel process. Drops large variables not in `live`.
+
+    `candidates` limits which globals may go (None: any global). A variable that should be
+    spilled but cannot be pickled is kept. Returns {"released": {name: bytes}, "kept": {name: reason},
+    "rss_freed": bytes}.
+    """
+    live = set(live)
+    names = list(PERSISTENT_GLOBALS) if candidates is None else candidates
+    released, kept = {}, {}
+    value = None
+    rss_before = current_rss()
+
+    for name in names:
+        if name in live or name not in PERSISTENT_GLOBALS:
+            continue
+        value = PERSISTENT_GLOBALS[name]
+        if not _releasable(name, value):
+            continue
+        size = estimate_size(value)
+        if size < min_bytes:
+            continue
+        if spill_dir is not None:
+            path = Path(spill_dir) / f"{name}.pkl"
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with path.open("wb") as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception as e:
+                path.unlink(missing_ok=True)
+                kept[name] = f"not serializable: {type(e).__name__}: {e}"
+                continue
+        del PERSISTENT_GLOBALS[name]
+        released[name] = size
+
+    value = None
+    if released:
+        gc.collect()
+    return {"released": released, "kept": kept, "rss_freed": max(0, rss_before - current_rss())}
+
+
+def restore_variables(names: list[str], spill_dir: str) -> list[str]:
+    """Runs in the kernel process. Loads spilled variables that are missing from PERSISTENT_GLOBALS."""
+    restored = []
+    for name in names:
+        path = Path(spill_dir) / f"{name}.pkl"
+        if name in PERSISTENT_GLOBALS or not path.exists():
+            continue
+        with path.open("rb") as f:
+            PERSISTENT_GLOBALS[name] = pickle.load(f)
+        restored.append(name)
+    return restored
+
+
+def discard_spilled(names, spill_dir: str) -> None:
+    """Deletes the spill files of `names`, once a globals checkpoint holds them."""
+    for name in names:
+        (Path(spill_dir) / f"{name}.pkl").unlink(missing_ok=True)
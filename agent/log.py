@@ -1,36 +1,144 @@
 import json
+import time
+import atexit
+import queue
+import threading
+import uuid
 from datetime import datetime
 from pathlib import Path
 
 from .plan import Plan
 
+LOG_FLUSH_INTERVAL = 0.5  # seconds between batched writes
+TEXT_LOGS = True  # human-readable plan.txt / messages.txt / reasoning.txt next to events.jsonl
+EVENTS_FILE = "events.jsonl"
+LOGS_DIR = Path(__file__).resolve().parent.parent / "logs"
 
-def _init_log_dir() -> Path:
-    base = Path(__file__).resolve().parent.parent / "logs" / datetime.now().strftime("%Y%m%d_%H%M%S")
+
+class LogWriter:
+    """Background writer: log calls enqueue events, a thread writes them in batches.
+
+    Every event goes to `<log dir>/events.jsonl` as one JSON line; with TEXT_LOGS the
+    text rendering is appended to the event's own file as well. Each file is opened once
+    per batch.
+    """
+
+    def __init__(self, flush_interval: float = LOG_FLUSH_INTERVAL, text_logs: bool = TEXT_LOGS):
+        self.flush_interval = flush_interval
+        self.text_logs = text_logs
+        self.events_path: Path | None = None
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._created_dirs: set[Path] = set()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def emit(self, path: Path, kind: str, content: str, role: str | None = None) -> None:
+        self._queue.put({"ts": time.time(), "kind": kind, "path": str(path), "role": role, "content": content})
+
+    def flush(self, timeout: float | None = 10) -> None:
+        """Block until everything emitted so far is written."""
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(timeout)
+
+    def _run(self) -> None:
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                self._write([item for item in batch if not isinstance(item, threading.Event)])
+            except Exception as e:
+                print(f"⚠️ Log write failed: {e}")
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+
+    def _open(self, path: Path):
+        if path.parent not in self._created_dirs:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._created_dirs.add(path.parent)
+        return path.open("a", encoding="utf-8")
+
+    def _write(self, events: list[dict]) -> None:
+        if not events:
+            return
+        if self.events_path is not None:
+            with self._open(self.events_path) as f:
+                f.write("".join(json.dumps(event, ensure_ascii=False) + "\n" for event in events))
+        if not self.text_logs:
+            return
+        by_path: dict[str, list[str]] = {}
+        for event in events:
+            by_path.setdefault(event["path"], []).append(_render_text(event))
+        for path, chunks in by_path.items():
+            with self._open(Path(path)) as f:
+                f.write("".join(chunks))
+
+
+def _render_text(event: dict) -> str:
+    content = event["content"]
+    if event["kind"] == "step":
+        separator = "=" * 80
+        return f"\n{separator}\n[{event['role'].upper()}]\n{separator}\n{content}\n\n"
+    if event["kind"] == "reasoning":
+        return content + f"\n\n{'~' * 80}\n\n"
+    return content.rstrip() + "\n\n"
+
+
+_writer: LogWriter | None = None
+_writer_lock = threading.Lock()
+
+
+def _get_writer() -> LogWriter:
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = LogWriter()
+            atexit.register(_writer.flush)
+    return _writer
+
+
+def flush_logs() -> None:
+    """Write out pending log events (step boundaries, end of task)."""
+    if _writer is not None:
+        _writer.flush()
+
+
+def _init_log_dir(task_id: str | None = None) -> Path:
+    """Log root of a task, `logs/<task_id>`; timestamped (plus a random suffix) without a task id."""
+    name = task_id or f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+    return _use_log_dir(LOGS_DIR / name)
+
+
+def _use_log_dir(base: Path) -> Path:
+    """Make `base` the task log directory (new task or resumed one)."""
     base.mkdir(parents=True, exist_ok=True)
+    _get_writer().events_path = base / EVENTS_FILE
     return base
 
 
 def _append_log(path: Path, content: str) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("a", encoding="utf-8") as log_file:
-        log_file.write(content.rstrip() + "\n\n")
+    _get_writer().emit(path, "log", content)
 
 
 def _append_step_log(path: Path, role: str, content: str) -> None:
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("a", encoding="utf-8") as log_file:
-        separator = "=" * 80
-        log_file.write(f"\n{separator}\n[{role.upper()}]\n{separator}\n{content}\n\n")
+    if path is None:
+        return
+    _get_writer().emit(path, "step", content, role=role)
 
 
 def _append_reasoning(path: Path, reasoning: str) -> None:
-    if not reasoning:
+    if not reasoning or path is None:
         return
-    path.parent.mkdir(parents=True, exist_ok=True)
-    with path.open("a", encoding="utf-8") as f:
-        separator = "~" * 80
-        f.write(reasoning + f"\n\n{separator}\n\n")
+    _get_writer().emit(path, "reasoning", reasoning)
 
 
 def _format_plan(plan: Plan, start_step: int = 1) -> str:
@@ -40,12 +148,14 @@ def _format_plan(plan: Plan, start_step: int = 1) -> str:
         lines.append(f"\n{separator}")
         lines.append(f"Step {idx}: {step.step_description}")
         lines.append(separator)
-        
+
         def _serialize_vars(vars_list):
             if isinstance(vars_list, dict):
                 return json.dumps(vars_list, indent=4, ensure_ascii=False)
             return json.dumps([v.model_dump() for v in vars_list], indent=4, ensure_ascii=False)
-        
+
         lines.append(f"input_variables: {_serialize_vars(step.input_variables)}")
         lines.append(f"output_variables: {_serialize_vars(step.output_variables)}")
-    return "\n".join(lines)
\ No newline at end of file
+        if step.parallel_safe:
+            lines.append("parallel_safe: true")
+    return "\n".join(lines)
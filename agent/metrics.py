@@ -0,0 +1,284 @@
+"""
+Prometheus metrics of the agent server.
+
+Metrics live in the server process and are rendered by `/metrics` in the text exposition
+format. Every update is O(1) under one lock. Workers do not share memory with the server,
+they `report()` observations as datagrams to a Unix socket the server reads
+(`MetricsReceiver`); a lost datagram loses one observation, never blocks a worker.
+
+With several server processes each one periodically writes a snapshot of its values to a
+shared directory (`write_snapshot`); `/metrics`, answered by whichever process gets the
+request, adds the snapshots of the other live processes on this host to its own values
+(`read_snapshots`), so a scrape sees the whole server.
+"""
+import copy
+import json
+import os
+import socket
+import threading
+from pathlib import Path
+
+METRICS_SOCKET_ENV = "AGENT_METRICS_SOCKET"
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+TASK_BUCKETS = (10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200)
+STEP_BUCKETS = (1, 2, 3, 5, 8, 12, 20, 30)
+
+_lock = threading.Lock()
+REGISTRY: dict[str, "_Metric"] = {}
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: tuple = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._values: dict[tuple, object] = {}
+        REGISTRY[name] = self
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def render(self, others: list[dict] = ()) -> list[str]:
+        """Exposition lines; `others` are snapshots of other server processes added to this one's values."""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with _lock:
+            values = copy.deepcopy(self._values)
+        for snapshot in others:
+            for key, value in snapshot.get(self.name, []):
+                key = tuple(key)
+                values[key] = self._merge(values[key], value) if key in values else value
+        for key, value in sorted(values.items()):
+            lines.extend(self._render_value(key, value))
+        return lines
+
+    def _merge(self, value, other):
+        return value + other
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {value}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), merge: str = "sum"):
+        super().__init__(name, help_text, labels)
+        self.merge = merge  # across server processes: "sum", or "max" for a value every process sees whole
+
+    def _merge(self, value, other):
+        return max(value, other) if self.merge == "max" else value + other
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels) -> None:
+        with _lock:
+            self._values[self._key(labels)] = value
+
+    def get(self, **labels) -> float:
+        with _lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with _lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0, 0.0]  # bucket counts, count, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += 1
+            state[2] += value
+
+    def _merge(self, value, other):
+        return [[a + b for a, b in zip(value[0], other[0])], value[1] + other[1], value[2] + other[2]]
+
+    def _render_value(self, key: tuple, value) -> list[str]:
+        counts, count, total = value
+        lines, cumulative = [], 0
+        for bound, bucket_count in zip(self.buckets, counts):
+            cumulative += bucket_count
+            le = 'le="%s"' % bound
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+        le = 'le="+Inf"'
+        lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {count}")
+        lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {total}")
+        return lines
+
+
+# --- server side ---
+QUEUE_DEPTH = Gauge("agent_queue_depth", "Tasks waiting for a worker", merge="max")  # shared queue
+TASKS_RUNNING = Gauge("agent_tasks_running", "Tasks with a running worker")
+QUEUE_WAIT = Histogram("agent_queue_wait_seconds", "Time from submit (or resume) to worker spawn")
+SPAWN_LATENCY = Histogram("agent_spawn_seconds", "Time to spawn a worker process")
+TASKS_FINISHED = Counter("agent_tasks_finished_total", "Finished tasks", ("outcome",))
+DEDUP_HITS = Counter("agent_dedup_hits_total", "Submissions answered by an existing task", ("kind",))
+LIMIT_VIOLATIONS = Counter("agent_limit_violations_total", "Workers that exceeded a resource limit", ("limit",))
+TASK_DURATION = Histogram("agent_task_duration_seconds", "Worker run time by outcome", ("outcome",), TASK_BUCKETS)
+
+# --- reported by workers ---
+STEPS_PER_TASK = Histogram("agent_steps_per_task", "Completed plan steps per task run", (), STEP_BUCKETS)
+LLM_LATENCY = Histogram("agent_llm_call_seconds", "LLM call latency", ("model", "role"))
+LLM_TOKENS = Counter("agent_llm_tokens_total", "LLM tokens", ("model", "role", "kind"))
+LLM_ERRORS = Counter("agent_llm_errors_total", "Failed LLM calls", ("model", "role"))
+LLM_ESCALATIONS = Counter("agent_llm_escalations_total", "Agent turns moved up the model cascade", ("reason",))
+EXEC_BLOCK = Histogram("agent_exec_block_seconds", "Duration of executed code blocks", ("type",))
+
+
+def render(others: list[dict] = ()) -> str:
+    lines = []
+    for metric in list(REGISTRY.values()):
+        lines.extend(metric.render(others))
+    return "\n".join(lines) + "\n"
+
+
+def snapshot_path(directory: Path) -> Path:
+    """Snapshot file of this server process."""
+    return Path(directory) / f"{socket.gethostname()}.{os.getpid()}.json"
+
+
+def write_snapshot(path: Path) -> None:
+    """Store this process's values for the other server processes' `/metrics`."""
+    with _lock:
+        data = json.dumps({
+            name: [[list(key), value] for key, value in metric._values.items()]
+            for name, metric in REGISTRY.items()
+        })
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(data)
+    os.replace(tmp, path)
+
+
+def read_snapshots(own: Path) -> list[dict]:
+    """Snapshots of the other live server processes on this host; those of exited ones are removed."""
+    snapshots = []
+    for path in own.parent.glob(f"{socket.gethostname()}.*.json"):
+        if path == own:
+            continue
+        try:
+            os.kill(int(path.name.rsplit(".", 2)[1]), 0)
+        except ProcessLookupError:
+            path.unlink(missing_ok=True)
+            continue
+        except PermissionError:
+            pass  # alive
+        except ValueError:
+            continue
+        try:
+            snapshots.append(json.loads(path.read_text()))
+        except (OSError, ValueError):
+            continue  # being replaced
+    return snapshots
+
+
+def apply(message: dict) -> None:
+    """Apply one reported observation: {"metric", "op": "inc"|"observe"|"set", "value", "labels"}."""
+    metric = REGISTRY.get(message.get("metric"))
+    op = message.get("op")
+    labels = message.get("labels") or {}
+    value = float(message.get("value", 1))
+    if isinstance(metric, Histogram) and op == "observe":
+        metric.observe(value, **labels)
+    elif isinstance(metric, (Counter, Gauge)) and op == "inc":
+        metric.inc(value, **labels)
+    elif isinstance(metric, Gauge) and op == "set":
+        metric.set(value, **labels)
+
+
+class MetricsReceiver:
+    """Server side of the worker channel: a Unix datagram socket read by a daemon thread."""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.sock: socket.socket | None = None
+        self.thread: threading.Thread | None = None
+
+    def start(self) -> None:
+        self.path.unlink(missing_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(str(self.path))
+        self.sock.settimeout(1.0)
+        self.thread = threading.Thread(target=self._run, name="metrics-receiver", daemon=True)
+        self.thread.start()
+
+    def _run(self) -> None:
+        sock = self.sock
+        while self.sock is not None:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                continue
+            except OSError:
+                return  # closed
+            try:
+                apply(json.loads(data))
+            except Exception:
+                continue  # malformed report
+
+    def stop(self) -> None:
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.path.unlink(missing_ok=True)
+
+
+# --- worker side ---
+_sender: socket.socket | None = None
+_sender_lock = threading.Lock()
+
+
+def report(metric: str, op: str, value: float = 1, **labels) -> None:
+    """Send an observation to the server; a no-op outside a worker, never raises."""
+    global _sender
+    path = os.environ.get(METRICS_SOCKET_ENV)
+    if not path:
+        return
+    message = json.dumps({"metric": metric, "op": op, "value": value, "labels": labels}).encode()
+    try:
+        with _sender_lock:
+            if _sender is None:
+                _sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+                _sender.setblocking(False)
+            _sender.sendto(message, path)
+    except OSError:
+        pass  # server gone or socket buffer full: drop
@@ -0,0 +1,229 @@
+"""
+Package installs through a local wheelhouse shared by all tasks.
+
+`pip install` / `python -m pip install` in the task bash session are routed here (see
+`SHELL_INIT`). A requirement is installed from the wheelhouse without touching the index
+when it can be; otherwise its wheels (and its dependencies' wheels) are first downloaded
+into the wheelhouse, so the next task gets them locally. Concurrent installs of the same
+package wait for each other (flock per package), and the install into the shared venv is
+serialized. With AGENT_PIP_OFFLINE=1 only the wheelhouse is used.
+
+Python blocks are scanned for imports before they run; missing modules that a wheel in
+the wheelhouse provides are installed in the background (wheelhouse only, never the index).
+
+Runs as a script (`python packages.py install ...`), so no package-relative imports here.
+"""
+import ast
+import fcntl
+import importlib.util
+import os
+import re
+import shlex
+import subprocess
+import sys
+import threading
+import zipfile
+from contextlib import contextmanager
+from pathlib import Path
+
+WHEELHOUSE_DIR = Path(os.environ.get("AGENT_WHEELHOUSE", "/app/wheelhouse"))
+PIP_OFFLINE = os.environ.get("AGENT_PIP_OFFLINE", "") == "1"
+PREINSTALL_WAIT = 60  # seconds a python block waits for the background installs of its imports
+
+# Options that change what pip installs or where from: such commands go to pip unchanged
+_PASSTHROUGH_OPTIONS = ("-r", "--requirement", "-e", "--editable", "-i", "--index-url", "--extra-index-url",
+                        "-c", "--constraint", "-t", "--target", "--prefix", "--root", "--user")
+_FLAG_OPTIONS = ("-q", "--quiet", "-v", "--verbose", "--no-cache-dir", "--no-input", "--disable-pip-version-check")
+_UPGRADE_OPTIONS = ("-U", "--upgrade", "--force-reinstall")
+_NAME_RE = re.compile(r"^([A-Za-z0-9][A-Za-z0-9._-]*)")
+
+_SCRIPT = Path(__file__).resolve()
+_SCRIPT_ARG = shlex.quote(str(_SCRIPT))
+SHELL_INIT = f"""
+pip() {{ if [ "$1" = install ]; then shift; command python {_SCRIPT_ARG} install "$@"; else command pip "$@"; fi; }}
+pip3() {{ pip "$@"; }}
+python() {{ if [ "$1" = -m ] && [ "$2" = pip ] && [ "$3" = install ]; then shift 3; command python {_SCRIPT_ARG} install "$@"; else command python "$@"; fi; }}
+python3() {{ python "$@"; }}
+"""
+
+_preinstalls: dict[str, threading.Thread] = {}  # project -> background install
+_preinstalls_lock = threading.Lock()
+_preinstall_failed: set[str] = set()  # projects the wheelhouse could not install, not tried again by this worker
+_wheel_modules: tuple[float, dict[str, str]] = (-1.0, {})  # (wheelhouse mtime, module -> project)
+
+
+def canonical_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+@contextmanager
+def _flock(name: str):
+    lock_dir = WHEELHOUSE_DIR / ".locks"
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    with open(lock_dir / f"{name}.lock", "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _pip(*args: str, quiet: bool = False) -> int:
+    cmd = [sys.executable, "-m", "pip", *args]
+    if quiet:
+        return subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode
+    return subprocess.run(cmd).returncode
+
+
+def _install_local(requirements: list[str], flags: list[str], quiet: bool = False) -> int:
+    # one install at a time into the shared venv
+    with _flock("__venv__"):
+        return _pip("install", "--no-index", "--find-links", str(WHEELHOUSE_DIR), *flags, *requirements, quiet=quiet)
+
+
+def install(args: list[str], wheelhouse_only: bool = False) -> int:
+    """`pip install <args>` through the wheelhouse, returns pip's exit code."""
+    if any(arg.split("=", 1)[0] in _PASSTHROUGH_OPTIONS for arg in args):
+        return _pip("install", "--find-links", str(WHEELHOUSE_DIR), *(["--no-index"] if PIP_OFFLINE else []), *args)
+
+    flags = [arg for arg in args if arg in _FLAG_OPTIONS or arg in _UPGRADE_OPTIONS]
+    requirements = [arg for arg in args if not arg.startswith("-")]
+    unknown = [arg for arg in args if arg.startswith("-") and arg not in flags]
+    if unknown or not requirements:
+        return _pip("install", *args)
+
+    offline = PIP_OFFLINE or wheelhouse_only
+    # an upgrade asks for the newest release: the wheelhouse may only hold an older one
+    upgrade = any(flag in _UPGRADE_OPTIONS for flag in flags)
+    names = []
+    for requirement in requirements:
+        match = _NAME_RE.match(requirement)
+        if match is None:  # paths, URLs
+            return _pip("install", *args)
+        names.append(canonical_name(match.group(1)))
+
+    WHEELHOUSE_DIR.mkdir(parents=True, exist_ok=True)
+    returncode = 0
+    # per-package lock: a second task installing the same package waits and then finds it local
+    for name, requirement in sorted(zip(names, requirements)):
+        with _flock(name):
+            if (offline or not upgrade) and _install_local([requirement], flags, quiet=True) == 0:
+                if not wheelhouse_only:
+                    print(f"{requirement}: installed or already present, served from the local wheelhouse")
+                continue
+            if offline:
+                if not wheelhouse_only:
+                    print(f"ERROR: {requirement} is not available in the local wheelhouse (offline mode)", file=sys.stderr)
+                returncode = 1
+                continue
+            # fetch wheels of the package and its dependencies into the wheelhouse, then install from there
+            if _pip("wheel", "--wheel-dir", str(WHEELHOUSE_DIR), "--find-links", str(WHEELHOUSE_DIR),
+                    *[f for f in flags if f in _FLAG_OPTIONS], requirement) == 0:
+                returncode = _install_local([requirement], flags) or returncode
+            else:
+                returncode = _pip("install", *flags, requirement) or returncode
+    return returncode
+
+
+def wheelhouse_modules() -> dict[str, str]:
+    """Top-level importable module -> project, for every wheel in the wheelhouse."""
+    global _wheel_modules
+    try:
+        mtime = WHEELHOUSE_DIR.stat().st_mtime
+    except OSError:
+        return {}
+    if mtime == _wheel_modules[0]:
+        return _wheel_modules[1]
+
+    modules = {}
+    for wheel in sorted(WHEELHOUSE_DIR.glob("*.whl")):
+        project = canonical_name(wheel.name.split("-", 1)[0])
+        try:
+            with zipfile.ZipFile(wheel) as zf:
+                names = zf.namelist()
+        except (OSError, zipfile.BadZipFile):
+            continue
+        for name in names:
+            top = name.split("/", 1)[0]
+            if top.endswith((".dist-info", ".data")):
+                continue
+            top = top.removesuffix(".py").split(".", 1)[0]
+            if top.isidentifier():
+                modules.setdefault(top, project)
+    _wheel_modules = (mtime, modules)
+    return modules
+
+
+def missing_imports(code: str) -> set[str]:
+    """Top-level modules imported by `code` that are not importable here."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return set()
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split(".", 1)[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split(".", 1)[0])
+    missing = set()
+    for name in names - set(sys.stdlib_module_names):
+        try:
+            if importlib.util.find_spec(name) is None:
+                missing.add(name)
+        except (ImportError, ValueError):
+            missing.add(name)
+    return missing
+
+
+def preinstall_imports(code: str) -> list[threading.Thread]:
+    """Start background installs (wheelhouse only) for the missing imports of `code`."""
+    modules = missing_imports(code)
+    if not modules:
+        return []
+    available = wheelhouse_modules()
+    threads = []
+    with _preinstalls_lock:
+        for project, thread in list(_preinstalls.items()):
+            if not thread.is_alive():
+                del _preinstalls[project]  # done; failed ones are in _preinstall_failed
+        for module in sorted(modules):
+            project = available.get(module)
+            if project is None or project in _preinstall_failed:
+                continue
+            thread = _preinstalls.get(project)
+            if thread is None:
+                thread = threading.Thread(
+                    target=_pip_script_install, args=(project,), name=f"preinstall-{project}", daemon=True,
+                )
+                _preinstalls[project] = thread
+                thread.start()
+            threads.append(thread)
+    return threads
+
+
+def _pip_script_install(project: str) -> None:
+    result = subprocess.run([sys.executable, str(_SCRIPT), "install", "--wheelhouse-only", project],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if result.returncode != 0:
+        with _preinstalls_lock:
+            _preinstall_failed.add(project)
+
+
+def wait_for_preinstalls(threads: list[threading.Thread], timeout: float = PREINSTALL_WAIT) -> None:
+    for thread in threads:
+        thread.join(timeout)
+
+
+def main(argv: list[str]) -> int:
+    if not argv or argv[0] != "install":
+        print("usage: packages.py install [--wheelhouse-only] <pip install arguments>", file=sys.stderr)
+        return 2
+    args = argv[1:]
+    wheelhouse_only = "--wheelhouse-only" in args
+    args = [arg for arg in args if arg != "--wheelhouse-only"]
+    return install(args, wheelhouse_only=wheelhouse_only)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
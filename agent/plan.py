@@ -1,8 +1,14 @@
 import json
 from typing import List, Optional, Literal
 from pydantic import BaseModel, Field
-from .utils import llm_structured, LLM_MODEL_PLAN, LLM_MODEL_DECISION, LLM_MODEL_REPLAN
-from .prompt_plan import PLAN_PROMPT, DECISION_PROMPT, REPLAN_REMAINING_PROMPT
+from .utils import llm_structured, LLM_MODEL_PLAN, LLM_MODEL_DECISION, LLM_MODEL_REPLAN, LLM_MODEL_SUMMARY
+from .prompt_plan import PLAN_PROMPT, DECISION_PROMPT, REPLAN_REMAINING_PROMPT, SUMMARIZE_STEPS_PROMPT
+
+# Completed steps digest: recent steps are kept verbatim, older ones are folded into a rolling summary
+KEEP_RECENT_STEPS = 3
+COMPLETED_STEPS_TOKEN_BUDGET = 4_000  # whole digest (summary + verbatim steps)
+SUMMARY_TOKEN_BUDGET = 1_000
+RESULT_TOKEN_LIMIT = 1_000  # single verbatim step result
 
 
 class StepVariable(BaseModel):
@@ -25,11 +31,20 @@ class PlanStep(BaseModel):
         description="Output variables and their dtypes",
     )
 
+    parallel_safe: bool = Field(
+        False,
+        description="True only if the step just computes variables: no files written or changed, no external side effects (may run as several concurrent attempts)",
+    )
+
 
 class Plan(BaseModel):
     steps: List[PlanStep] = Field(default_factory=list, description="List of steps to execute")
 
 
+class StepsSummary(BaseModel):
+    summary: str = Field(..., description="Updated summary of all completed steps folded so far")
+
+
 class AfterStepDecision(BaseModel):
     next_action: Literal["continue", "abort", "replan_remaining_steps", "task_completed"] = Field(
         ..., description="What to do next"
@@ -42,7 +57,7 @@ class AfterStepDecision(BaseModel):
 
 def create_plan(task: str) -> Plan:
     prompt = PLAN_PROMPT.format(task=task)
-    plan = llm_structured(prompt, Plan, model=LLM_MODEL_PLAN)
+    plan = llm_structured(prompt, Plan, model=LLM_MODEL_PLAN, role="plan")
     check_plan(plan)
     return plan
 
@@ -50,13 +65,14 @@ def make_after_step_decision(
     task: str,
     completed_steps: List[tuple[PlanStep, str]],
     remaining_steps: List[PlanStep],
+    digest: Optional["CompletedStepsDigest"] = None,
 ) -> AfterStepDecision:
     prompt = DECISION_PROMPT.format(
         task=task,
-        completed_steps=format_completed_steps(completed_steps),
+        completed_steps=format_completed_steps(completed_steps, digest),
         remaining_steps=format_remaining_steps(remaining_steps),
     )
-    return llm_structured(prompt, AfterStepDecision, model=LLM_MODEL_DECISION)
+    return llm_structured(prompt, AfterStepDecision, model=LLM_MODEL_DECISION, role="decision")
 
 
 def replan_remaining(
@@ -64,21 +80,34 @@ def replan_remaining(
     completed_steps: List[tuple[PlanStep, str]],
     remaining_steps: List[PlanStep],
     after_step_decision: AfterStepDecision,
+    digest: Optional["CompletedStepsDigest"] = None,
 ) -> Plan:
     prompt = REPLAN_REMAINING_PROMPT.format(
         task=task,
-        completed_steps=format_completed_steps(completed_steps),
+        completed_steps=format_completed_steps(completed_steps, digest),
         remaining_steps=format_remaining_steps(remaining_steps),
         reasons_for_replan_remaining_steps=after_step_decision.reasons_for_replan_remaining_steps,
     )
-    plan = llm_structured(prompt, Plan, model=LLM_MODEL_REPLAN)
+    plan = llm_structured(prompt, Plan, model=LLM_MODEL_REPLAN, role="replan")
     check_plan(plan)
     return plan
 
 
-def format_completed_steps(completed_steps: List[tuple[PlanStep, str]]) -> str:
+def format_completed_steps(
+    completed_steps: List[tuple[PlanStep, str]],
+    digest: Optional["CompletedStepsDigest"] = None,
+    start_step: int = 1,
+) -> str:
     lines = []
-    for i, (step, result) in enumerate(completed_steps, 1):
+    start = 0
+    if digest is not None and digest.summarized_count:
+        start = digest.summarized_count
+        lines.append(f"Steps 1-{start} (summary): {digest.summary}")
+        lines.append("")
+
+    for i, (step, result) in enumerate(completed_steps[start:], start_step + start):
+        if digest is not None:
+            result = digest.clip_result(result)
         lines.append(f"Step {i}: {step.step_description}")
         
         if step.input_variables:
@@ -101,6 +130,102 @@ def format_completed_steps(completed_steps: List[tuple[PlanStep, str]]) -> str:
     return "\n".join(lines).rstrip()
 
 
+def estimate_tokens(text: str) -> int:
+    """Rough token count (~4 characters per token), good enough for prompt budgeting."""
+    return len(text) // 4 + 1
+
+
+def _clip_text(text: str, max_tokens: int) -> str:
+    max_chars = max_tokens * 4
+    if len(text) <= max_chars:
+        return text
+    half = max_chars // 2
+    return f"{text[:half]}\n[... {len(text) - 2 * half} characters omitted ...]\n{text[-half:]}"
+
+
+def summarize_completed_steps(
+    task: str,
+    summary: str,
+    new_steps: List[tuple[PlanStep, str]],
+    first_step_number: int,
+    max_tokens: int = SUMMARY_TOKEN_BUDGET,
+    result_token_limit: int = RESULT_TOKEN_LIMIT,
+) -> str:
+    """Fold `new_steps` into the existing `summary` of earlier steps (each result clipped to `result_token_limit`)."""
+    clipped = [(step, _clip_text(str(result), result_token_limit)) for step, result in new_steps]
+    steps_text = format_completed_steps(clipped, start_step=first_step_number)
+    prompt = SUMMARIZE_STEPS_PROMPT.format(
+        task=task,
+        summary=summary or "(empty)",
+        steps=steps_text,
+        max_words=max_tokens * 3 // 4,
+    )
+    try:
+        new_summary = llm_structured(prompt, StepsSummary, model=LLM_MODEL_SUMMARY, role="summary").summary
+    except Exception as e:
+        # Deterministic fallback: keep one clipped line per step
+        print(f"⚠️ Steps summarization failed, using plain compression: {e}")
+        compact = [
+            f"Step {i}: {step.step_description} -> {_clip_text(result, 100)}"
+            for i, (step, result) in enumerate(new_steps, first_step_number)
+        ]
+        new_summary = "\n".join(filter(None, [summary, *compact]))
+    return _clip_text(new_summary.strip(), max_tokens)
+
+
+class CompletedStepsDigest:
+    """
+    Bounded-size view of completed steps for decision, replan and step prompts.
+
+    The most recent steps are rendered verbatim; older steps are folded into a
+    cached summary which is updated incrementally (only newly evicted steps are
+    sent to the LLM) so the history stays within `token_budget`.
+    """
+
+    def __init__(
+        self,
+        task: str,
+        keep_recent: int = KEEP_RECENT_STEPS,
+        token_budget: int = COMPLETED_STEPS_TOKEN_BUDGET,
+        summary_token_budget: int = SUMMARY_TOKEN_BUDGET,
+        result_token_limit: int = RESULT_TOKEN_LIMIT,
+    ):
+        self.task = task
+        self.keep_recent = keep_recent
+        self.token_budget = token_budget
+        self.summary_token_budget = summary_token_budget
+        self.result_token_limit = result_token_limit
+        self.summary = ""
+        self.summarized_count = 0  # number of leading steps covered by `summary`
+
+    def clip_result(self, result: str) -> str:
+        return _clip_text(str(result), self.result_token_limit)
+
+    def update(self, completed_steps: List[tuple[PlanStep, str]]) -> None:
+        """Evict steps from the verbatim window into the summary until the digest fits the budget."""
+        target = max(self.summarized_count, len(completed_steps) - self.keep_recent)
+        verbatim_budget = self.token_budget - self.summary_token_budget
+        # Always keep the last step verbatim, it is the one the next decision is about
+        while target < len(completed_steps) - 1:
+            verbatim = [(step, self.clip_result(result)) for step, result in completed_steps[target:]]
+            if estimate_tokens(format_completed_steps(verbatim)) <= verbatim_budget:
+                break
+            target += 1
+
+        if target <= self.summarized_count:
+            return
+
+        self.summary = summarize_completed_steps(
+            task=self.task,
+            summary=self.summary,
+            new_steps=completed_steps[self.summarized_count:target],
+            first_step_number=self.summarized_count + 1,
+            max_tokens=self.summary_token_budget,
+            result_token_limit=self.result_token_limit,
+        )
+        self.summarized_count = target
+
+
 def format_remaining_steps(remaining_steps: List[PlanStep]) -> str:
     lines = []
     for i, step in enumerate(remaining_steps, 1):
@@ -125,6 +250,15 @@ def format_remaining_steps(remaining_steps: List[PlanStep]) -> str:
     return "\n".join(lines).rstrip()
 
 
+def variables_consumed_by(steps: List[PlanStep]) -> set[tuple[str, str]]:
+    """(name, dtype) of every input variable of the given steps."""
+    return {
+        (v.variable_name, v.variable_data_type)
+        for step in steps
+        for v in step.input_variables
+    }
+
+
 def check_plan(plan: Plan):
     """
     Validate plan consistency:
@@ -147,55 +281,33 @@ def check_plan(plan: Plan):
             f"First step should not require inputs."
         )
     
-    # Build a map of what each step outputs (name, dtype) tuples
-    outputs_by_step = {}
-    for idx, step in enumerate(plan.steps):
-        outputs_by_step[idx] = {
-            (v.variable_name, v.variable_data_type) 
-            for v in step.output_variables
-        }
-    
-    # Check 1: Input variables must be output by previous steps
+    # Check 1: Input variables must be output by previous steps (one pass, outputs so far in a set)
+    produced = set()
     for idx, step in enumerate(plan.steps):
-        if idx == 0:
-            continue  # Skip first step
-        
-        for input_var in step.input_variables:
-            found = False
-            for prev_idx in range(idx):
-                if (input_var.variable_name, input_var.variable_data_type) in outputs_by_step[prev_idx]:
-                    found = True
-                    break
-            
-            if not found:
-                warnings.append(
-                    f"⚠️ Step {idx + 1} requires input '{input_var.variable_name}' "
-                    f"({input_var.variable_data_type}), but no previous step produces it."
-                )
-    
+        if idx > 0:  # Skip first step
+            for input_var in step.input_variables:
+                if (input_var.variable_name, input_var.variable_data_type) not in produced:
+                    warnings.append(
+                        f"⚠️ Step {idx + 1} requires input '{input_var.variable_name}' "
+                        f"({input_var.variable_data_type}), but no previous step produces it."
+                    )
+        produced.update((v.variable_name, v.variable_data_type) for v in step.output_variables)
+
     # Check 3: Output variables should be consumed by subsequent steps
-    for idx, step in enumerate(plan.steps):
-        # Skip last step - its outputs are final results
-        if idx == len(plan.steps) - 1:
-            continue
-        
-        for output_var in step.output_variables:
-            consumed = False
-            for next_idx in range(idx + 1, len(plan.steps)):
-                next_step = plan.steps[next_idx]
-                for input_var in next_step.input_variables:
-                    if (input_var.variable_name == output_var.variable_name and 
-                        input_var.variable_data_type == output_var.variable_data_type):
-                        consumed = True
-                        break
-                if consumed:
-                    break
-            
-            if not consumed:
-                warnings.append(
-                    f"⚠️ Step {idx + 1} outputs '{output_var.variable_name}' "
-                    f"({output_var.variable_data_type}), but it's not used by any subsequent step."
-                )
+    # (backwards pass, inputs of the later steps accumulated; the last step's outputs are final results)
+    unused = []
+    consumed_later = set()
+    for idx in range(len(plan.steps) - 1, -1, -1):
+        step = plan.steps[idx]
+        if idx < len(plan.steps) - 1:
+            unused.extend(
+                f"⚠️ Step {idx + 1} outputs '{output_var.variable_name}' "
+                f"({output_var.variable_data_type}), but it's not used by any subsequent step."
+                for output_var in reversed(step.output_variables)
+                if (output_var.variable_name, output_var.variable_data_type) not in consumed_later
+            )
+        consumed_later |= variables_consumed_by([step])
+    warnings.extend(reversed(unused))
     
     # Log all warnings
     if warnings:
@@ -0,0 +1,89 @@
+"""
+Per-step resource profile of a task (opt-in, see `executor.PROFILING`).
+
+Every `run_step` iteration appends a record to `<step folder>/profile.jsonl`: LLM and wall
+time, the per-block profiles from the executor, kernel RSS and the largest variables in
+PERSISTENT_GLOBALS. Per-step totals are kept in `profile.json` of the task spool, which
+the server returns in `/status/{task_id}`.
+"""
+import json
+import os
+from pathlib import Path
+
+from .executor import PERSISTENT_GLOBALS, current_rss
+from .liveness import estimate_size
+
+PROFILE_LARGEST_GLOBALS = 5
+
+_summary_path: Path | None = None
+_summary: dict = {"peak_rss": 0, "steps": {}}
+
+
+def kernel_snapshot(top_n: int = PROFILE_LARGEST_GLOBALS) -> dict:
+    """Runs in the kernel process. RSS and the largest task variables by estimated size."""
+    sizes = []
+    for name, value in list(PERSISTENT_GLOBALS.items()):
+        if name.startswith("__"):
+            continue
+        try:
+            sizes.append((estimate_size(value), name, type(value).__name__))
+        except Exception:
+            continue
+    sizes.sort(reverse=True)
+    return {
+        "rss": current_rss(),
+        "largest_globals": [{"name": name, "type": type_name, "bytes": size} for size, name, type_name in sizes[:top_n]],
+    }
+
+
+def set_summary_path(path: Path | None) -> None:
+    """Where the task summary is written; keeps what a previous run (resume) recorded."""
+    global _summary_path, _summary
+    _summary_path = Path(path) if path else None
+    if _summary_path and _summary_path.exists():
+        try:
+            with _summary_path.open("r", encoding="utf-8") as f:
+                _summary = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+
+def record_iteration(step_folder: Path | None, step_index: int, record: dict) -> None:
+    """Append an iteration record to the step log and fold it into the task summary."""
+    if step_folder is not None:
+        step_folder.mkdir(parents=True, exist_ok=True)
+        with (step_folder / "profile.jsonl").open("a", encoding="utf-8") as f:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    step = _summary["steps"].setdefault(str(step_index), {
+        "iterations": 0,
+        "wall_seconds": 0.0,
+        "llm_seconds": 0.0,
+        "python_cpu_seconds": 0.0,
+        "bash_cpu_seconds": 0.0,
+        "peak_rss": 0,
+    })
+    step["iterations"] += 1
+    step["wall_seconds"] = round(step["wall_seconds"] + record["wall_seconds"], 3)
+    step["llm_seconds"] = round(step["llm_seconds"] + record["llm_seconds"], 3)
+    for block in record["blocks"]:
+        key = "python_cpu_seconds" if block["type"] == "python" else "bash_cpu_seconds"
+        step[key] = round(step[key] + block.get("cpu_seconds", 0.0), 3)
+        step["peak_rss"] = max(step["peak_rss"], block.get("rss_after", 0))
+    step["peak_rss"] = max(step["peak_rss"], record["kernel"]["rss"])
+    step["rss_end"] = record["kernel"]["rss"]
+    step["largest_globals"] = record["kernel"]["largest_globals"]
+    _summary["peak_rss"] = max(_summary["peak_rss"], step["peak_rss"])
+    _write_summary()
+
+
+def _write_summary() -> None:
+    if _summary_path is None:
+        return
+    try:
+        tmp = _summary_path.with_suffix(".json.tmp")
+        with tmp.open("w", encoding="utf-8") as f:
+            json.dump(_summary, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, _summary_path)
+    except OSError as e:
+        print(f"⚠️ Cannot write profile summary: {e}")
@@ -8,7 +8,7 @@ You solve task by writing Python code snippets and bash code snippets.
 # RULES:
 1. You can write valid python code snippets. And I will execute them for you.
 2. You can add comments alongside code to describe your thinking and logic.
-3. Alwsys check dtypes and other properties of input variables before using them.
+3. Alwsys check dtypes and other properties of input variables before using them (a summary of each input variable is given with the step, inspect only what it does not show).
 4. Use print to see the code execution result. You should insert them in the code manually.
 5. Solve task step by step. Make small code snippets and more iterations. Quick feedback loop is extremely important.
 6. Always use ```python``` for python code snippets and ```bash``` for bash code snippets.
@@ -40,6 +40,7 @@ grep "rabbit" wiki.md
 - python code execution
 - debian bash shell (direct shell bash execution)
 - bash can be multiline commands (any number of lines of bash commands)
+- all bash blocks run in one persistent shell session: `cd`, exported variables and activated venvs are kept between blocks
 - you are in docker container as user 1000
 - you should use venv for python packages installation (venv is created, PATH is already set correctly)
 - Python package installation: Use bash to run `python -m pip install package_name` (it uses venv automatically)
@@ -78,13 +79,15 @@ or
 step_status = 'failed'
 final_answer = "description of why step is impossible to complete and we should abort the step"
 ```
+If you already verified the result, you can also set `step_status` and `final_answer` at the end of the block that sets the output variables:
+the step is accepted immediately when all output variables are set and have correct data types, otherwise you will be asked to confirm.
 If task is `completed` - you should set all output variables to the correct values and data types (you can not use `None` values).
 If task is `failed` - output variables are not required to be set.
 
 """.strip()
 
 
-def build_step_user_first_msg_prompt(task, current_step, completed_steps):
+def build_step_user_first_msg_prompt(task, current_step, completed_steps, digest=None, variable_summaries=None):
     parts = []
 
     parts.append("## Global Task (only for general understanding of main goal. DO NOT TRY TO SOLVE THE TASK HERE!)")
@@ -92,7 +95,12 @@ def build_step_user_first_msg_prompt(task, current_step, completed_steps):
 
     if completed_steps:
         parts.append("\n## Previous Steps Completed")
-        for i, (step, result) in enumerate(completed_steps, 1):
+        start = digest.summarized_count if digest is not None else 0
+        if start:
+            parts.append(f"\n### Steps 1-{start} (summary)\n{digest.summary}")
+        for i, (step, result) in enumerate(completed_steps[start:], start + 1):
+            if digest is not None:
+                result = digest.clip_result(result)
             parts.append(f"\n### Step {i}\n{step.step_description}\n**Result:** {result}")
 
     parts.extend([
@@ -117,6 +125,9 @@ def build_step_user_first_msg_prompt(task, current_step, completed_steps):
                 dtype = getattr(var, "variable_data_type", "")
                 desc = getattr(var, "variable_description", "")
                 parts.append(f"- {name} ({dtype}): {desc}")
+                summary = (variable_summaries or {}).get(name)
+                if summary:
+                    parts.append("  current value: " + summary.replace("\n", "\n  "))
         parts.append("")
 
     # Output variables
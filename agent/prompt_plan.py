@@ -27,6 +27,7 @@ Create plan to achieve the following task:
 - first step could not have input_variables (no previous steps to set variables)
 - last step could not have output_variables (no next steps to use variables)
 - all output variables should be used in the next steps. Do not create unused variables
+- parallel_safe: true only for steps that just compute variables in python: no files written, moved or deleted, no network writes or other side effects
 
 # Steps could use the following tools:
 - python code execution
@@ -104,3 +105,29 @@ Important:
 - sometimes you need to completely re-think the plan.
 
 """.strip()
+
+
+SUMMARIZE_STEPS_PROMPT = f"""
+current date: {datetime.datetime.now().strftime("%Y-%m-%d")}
+
+You are compressing the history of already completed steps of a task.
+The summary replaces the full step descriptions and results in later prompts.
+
+## Original Task
+{{task}}
+
+## Existing summary of earlier steps (may be empty)
+{{summary}}
+
+## Newly completed steps to fold into the summary
+{{steps}}
+
+## Summarization Rules
+- return one updated summary covering the existing summary AND the new steps.
+- keep every variable name and its data type that was produced, they are still available in python.
+- keep file paths, URLs, numbers, names and other concrete facts from the results.
+- keep failures and their reasons, so they are not repeated.
+- drop narration, reasoning and repeated information.
+- be concise: at most {{max_words}} words.
+
+""".strip()
@@ -0,0 +1,130 @@
+"""
+Model cascade for agent turns.
+
+A step starts on the cheapest tier (fast model, low reasoning effort) and moves up the
+tiers after ESCALATE_AFTER_ERRORS consecutive iterations with execution errors, or when
+its output variables fail validation. Outcomes are recorded per step kind (the leading
+verb of the step description) in a stats file shared by all workers. A kind whose
+steps keep failing on a tier starts above it next time. EXPLORE_RATE of the steps still
+start at the bottom, so a tier that was skipped can earn its place back.
+"""
+import os
+import json
+import fcntl
+import random
+import re
+from pathlib import Path
+
+from .utils import LLM_MODEL_AGENT, LLM_MODEL_AGENT_FAST
+from .log import LOGS_DIR
+from . import metrics
+
+ROUTING = os.environ.get("AGENT_ROUTING", "1") == "1"  # 0: every turn on the top tier
+TIERS = (  # (model, reasoning effort), cheapest first
+    (LLM_MODEL_AGENT_FAST, "low"),
+    (LLM_MODEL_AGENT, "medium"),
+    (LLM_MODEL_AGENT, "xhigh"),
+)
+ESCALATE_AFTER_ERRORS = 2  # consecutive iterations with errors
+MIN_SAMPLES = 5  # outcomes on a tier before they are trusted
+MIN_SUCCESS_RATE = 0.6  # below this a kind starts above the tier
+MAX_SAMPLES = 50  # counts are halved past this, so old outcomes fade
+EXPLORE_RATE = 0.1
+
+STATS_PATH = Path(os.environ.get("AGENT_ROUTING_STATS", LOGS_DIR / "routing_stats.json"))
+
+
+def step_kind(step) -> str:
+    words = re.findall(r"[a-z]+", step.step_description.lower())
+    return words[0] if words else "other"
+
+
+def _tier_key(tier: int) -> str:
+    model, effort = TIERS[tier]
+    return f"{model}:{effort}"
+
+
+def _load_stats() -> dict:
+    try:
+        with STATS_PATH.open("r", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _record(kind: str, outcomes: list[tuple[int, bool]]) -> None:
+    """Add (tier, success) outcomes of one step to the shared stats."""
+    try:
+        STATS_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with STATS_PATH.open("a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                stats = json.loads(f.read() or "{}")
+            except ValueError:
+                stats = {}
+            for tier, success in outcomes:
+                counts = stats.setdefault(kind, {}).setdefault(_tier_key(tier), [0, 0])  # [steps, successes]
+                counts[0] += 1
+                counts[1] += int(success)
+                if counts[0] > MAX_SAMPLES:
+                    counts[0], counts[1] = counts[0] // 2, counts[1] // 2
+            f.seek(0)
+            f.truncate()
+            json.dump(stats, f, indent=1)
+    except OSError as e:
+        print(f"⚠️ Routing stats not saved: {e}")
+
+
+def start_tier(kind: str) -> int:
+    """Lowest tier not proven to fail for this kind of step."""
+    if not ROUTING:
+        return len(TIERS) - 1
+    if random.random() < EXPLORE_RATE:
+        return 0
+    stats = _load_stats().get(kind, {})
+    for tier in range(len(TIERS) - 1):
+        steps, successes = stats.get(_tier_key(tier), (0, 0))
+        if steps < MIN_SAMPLES or successes / steps >= MIN_SUCCESS_RATE:
+            return tier
+    return len(TIERS) - 1
+
+
+class Route:
+    """Model and reasoning effort of one step attempt, escalated as the attempt struggles."""
+
+    def __init__(self, step):
+        self.kind = step_kind(step)
+        self.tier = start_tier(self.kind)
+        self.tried = [self.tier]
+        self.error_streak = 0
+
+    @property
+    def model(self) -> str:
+        return TIERS[self.tier][0]
+
+    @property
+    def effort(self) -> str:
+        return TIERS[self.tier][1]
+
+    def observe(self, errors: bool) -> str | None:
+        """Outcome of an iteration; returns the escalation reason if the tier changed."""
+        self.error_streak = self.error_streak + 1 if errors else 0
+        if self.error_streak >= ESCALATE_AFTER_ERRORS:
+            return self.escalate("errors")
+        return None
+
+    def escalate(self, reason: str) -> str | None:
+        if not ROUTING or self.tier >= len(TIERS) - 1:
+            return None
+        self.tier += 1
+        self.tried.append(self.tier)
+        self.error_streak = 0
+        metrics.report("agent_llm_escalations_total", "inc", reason=reason)
+        return f"{reason}: moved to {self.model} ({self.effort} effort)"
+
+    def finish(self, success: bool) -> None:
+        """Record the outcome: tiers escalated from failed, the last one succeeded or not."""
+        if ROUTING:
+            _record(self.kind, [(tier, False) for tier in self.tried[:-1]] + [(self.tier, success)])
@@ -1,74 +1,234 @@
+from pathlib import Path
+
 from .plan import (
     AfterStepDecision,
+    CompletedStepsDigest,
     Plan,
     PlanStep,
     create_plan,
     make_after_step_decision,
     replan_remaining,
+    variables_consumed_by,
 )
-from .run_step import run_step
-from .executor import execute_python
-from .log import _init_log_dir, _append_log, _format_plan
+from .run_step import run_step, STEP_STOPPED
+from . import executor
+from .executor import execute_python, call_in_kernel
+from .profiling import set_summary_path
+from .trace import span
+from . import budget, ipc, metrics
+from .checkpoint import save_state, load_state, dump_globals, load_globals
+from .liveness import LIVENESS_SCOPE, LIVENESS_SPILL, discard_spilled, release_variables, restore_variables
+from .log import _init_log_dir, _use_log_dir, _append_log, _format_plan, flush_logs
 
 
 MAX_TOTAL_STEPS = 30
 
 
-def run_agent(task: str) -> str:
-    log_dir = _init_log_dir()
-    plan: Plan = create_plan(task)
-    remaining_steps: list[PlanStep] = list(plan.steps)
-    completed_steps: list[tuple[PlanStep, str]] = []
-    _append_log(log_dir / "plan.txt", "Initial plan:\n" + _format_plan(plan))
-
-    for _ in range(MAX_TOTAL_STEPS):
-        if not remaining_steps:
-            break
-
-        current_step = remaining_steps.pop(0)
-        step_number = len(completed_steps) + 1
-        
-        execute_python("final_answer = ''")
-
-        step_result = run_step(
-            task=task,
-            current_step=current_step,
-            completed_steps=completed_steps,
-            log_dir=log_dir,
-            step_index=step_number,
-        )
-        completed_steps.append((current_step, step_result))
+def _save_checkpoint(checkpoint_dir, log_dir, completed_steps, remaining_steps, digest, decision_pending, with_globals,
+                     spill_dir=None):
+    if checkpoint_dir is None:
+        return
+    try:
+        if with_globals:
+            manifest = call_in_kernel(dump_globals, str(checkpoint_dir))
+            unpicklable = [name for name, entry in manifest.items() if entry["kind"] == "unpicklable"]
+            if unpicklable:
+                _append_log(log_dir / "checkpoint.txt", f"Step {len(completed_steps)}: not serializable: {', '.join(unpicklable)}")
+            if spill_dir is not None:
+                # the snapshot holds these now, their spill files are no longer the only copy
+                discard_spilled([name for name, entry in manifest.items() if entry["kind"] == "pickled"], str(spill_dir))
+        save_state(checkpoint_dir, {
+            "log_dir": str(log_dir),
+            "completed_steps": [[step.model_dump(), result] for step, result in completed_steps],
+            "remaining_steps": [step.model_dump() for step in remaining_steps],
+            "digest": {"summary": digest.summary, "summarized_count": digest.summarized_count},
+            "decision_pending": decision_pending,
+        })
+    except Exception as e:
+        # checkpointing must never fail the task
+        print(f"⚠️ Checkpoint after step {len(completed_steps)} failed: {e}")
+
+
+def _release_dead_variables(log_dir, spill_dir, completed_steps, remaining_steps):
+    live = sorted({name for name, _ in variables_consumed_by(remaining_steps)})
+    if LIVENESS_SCOPE == "all":
+        candidates = None
+    else:
+        candidates = sorted({v.variable_name for step, _ in completed_steps for v in step.output_variables})
+    try:
+        freed = call_in_kernel(release_variables, candidates, live, str(spill_dir) if LIVENESS_SPILL else None)
+    except Exception as e:
+        print(f"⚠️ Releasing dead variables after step {len(completed_steps)} failed: {e}")
+        return
+    if not freed["released"] and not freed["kept"]:
+        return
+    lines = [f"After step {len(completed_steps)}: RSS freed {freed['rss_freed'] / 2**20:.1f} MB"]
+    lines += [f"  - released {name} (~{size / 2**20:.1f} MB)" for name, size in freed["released"].items()]
+    lines += [f"  - kept {name}: {reason}" for name, reason in freed["kept"].items()]
+    _append_log(log_dir / "memory.txt", "\n".join(lines))
+
+
+def _restore_step_inputs(log_dir, spill_dir, step, step_number):
+    if not LIVENESS_SPILL:
+        return
+    names = [v.variable_name for v in step.input_variables]
+    try:
+        restored = call_in_kernel(restore_variables, names, str(spill_dir))
+    except Exception as e:
+        print(f"⚠️ Restoring spilled variables for step {step_number} failed: {e}")
+        return
+    if restored:
+        _append_log(log_dir / "memory.txt", f"Before step {step_number}: restored {', '.join(restored)}")
+
+
+def _wind_down(log_dir, completed_steps, reason: str, incomplete=None) -> str:
+    """Stop early (budget exhausted or cancelled): the results of the completed steps.
 
-        decision: AfterStepDecision = make_after_step_decision(
-            task=task,
-            completed_steps=completed_steps,
-            remaining_steps=remaining_steps,
+    `incomplete` is the (step, result) of a step cut off mid-way, listed apart from the completed ones.
+    """
+    budget.mark_stopped(reason)
+    ipc.send("progress", phase="stopped", reason=reason, usage=budget.usage())
+    _append_log(log_dir / "plan.txt", f"Stopped after step {len(completed_steps)}: {reason}")
+    if not completed_steps:
+        lines = [f"Stopped ({reason}) before any step was completed."]
+    else:
+        lines = [f"Stopped ({reason}) after {len(completed_steps)} steps. Results of completed steps:"]
+    for idx, (step, result) in enumerate(completed_steps, 1):
+        lines.append(f"Step {idx}: {step.step_description}\n{result}")
+    if incomplete is not None:
+        step, result = incomplete
+        lines.append(f"Step {len(completed_steps) + 1} (incomplete): {step.step_description}\n{result}")
+    return "\n\n".join(lines)
+
+
+def _finish(completed_steps, result: str) -> str:
+    metrics.report("agent_steps_per_task", "observe", len(completed_steps))
+    return result
+
+
+def run_agent(task: str, checkpoint_dir: Path | None = None, resume: bool = False, task_id: str | None = None) -> str:
+    state = load_state(checkpoint_dir) if (resume and checkpoint_dir) else None
+    digest = CompletedStepsDigest(task)
+
+    if state:
+        log_dir = _use_log_dir(Path(state["log_dir"]))
+        completed_steps: list[tuple[PlanStep, str]] = [
+            (PlanStep.model_validate(step), result) for step, result in state["completed_steps"]
+        ]
+        remaining_steps: list[PlanStep] = [PlanStep.model_validate(step) for step in state["remaining_steps"]]
+        digest.summary = state["digest"]["summary"]
+        digest.summarized_count = state["digest"]["summarized_count"]
+        missing = call_in_kernel(load_globals, str(checkpoint_dir))
+        _append_log(
+            log_dir / "plan.txt",
+            f"Resumed after step {len(completed_steps)}. Remaining plan:\n"
+            + _format_plan(Plan(steps=remaining_steps), start_step=len(completed_steps) + 1)
+            + ("\nNot restored variables:\n" + "\n".join(f"  - {k}: {v}" for k, v in missing.items()) if missing else ""),
         )
+        decision_pending = state["decision_pending"]
+    else:
+        log_dir = _init_log_dir(task_id)
+        with span("create_plan", "plan"):
+            plan: Plan = create_plan(task)
+        remaining_steps = list(plan.steps)
+        completed_steps = []
+        ipc.send("progress", phase="planned", total_steps=len(remaining_steps))
+        _append_log(log_dir / "plan.txt", "Initial plan:\n" + _format_plan(plan))
+        decision_pending = False
+        _save_checkpoint(checkpoint_dir, log_dir, completed_steps, remaining_steps, digest,
+                         decision_pending=False, with_globals=False)
+
+    spill_dir = (checkpoint_dir.parent if checkpoint_dir else log_dir) / "spill"
+    if executor.PROFILING:
+        set_summary_path((checkpoint_dir.parent if checkpoint_dir else log_dir) / "profile.json")
+
+    for _ in range(budget.max_steps(MAX_TOTAL_STEPS) - len(completed_steps) + decision_pending):
+        stop_reason = budget.exceeded()
+        if stop_reason:
+            return _finish(completed_steps, _wind_down(log_dir, completed_steps, stop_reason))
+
+        if not decision_pending:
+            if not remaining_steps:
+                break
+
+            current_step = remaining_steps.pop(0)
+            step_number = len(completed_steps) + 1
+            _restore_step_inputs(log_dir, spill_dir, current_step, step_number)
+
+            execute_python("final_answer = ''")
+            ipc.send("progress", phase="step", step=step_number, description=current_step.step_description,
+                     remaining_steps=len(remaining_steps))
+
+            with span("run_step", "step", step=step_number, description=current_step.step_description[:200]):
+                step_result = run_step(
+                    task=task,
+                    current_step=current_step,
+                    completed_steps=completed_steps,
+                    log_dir=log_dir,
+                    step_index=step_number,
+                    digest=digest,
+                )
+            if step_result.startswith(STEP_STOPPED):
+                # not completed: a resume runs it again from the checkpoint before it
+                remaining_steps.insert(0, current_step)
+                stop_reason = budget.exceeded() or "stopped"
+                return _finish(completed_steps, _wind_down(log_dir, completed_steps, stop_reason,
+                                                           incomplete=(current_step, step_result)))
+            completed_steps.append((current_step, step_result))
+            ipc.send("partial", step=step_number, description=current_step.step_description, result=step_result)
+            flush_logs()
+            digest.update(completed_steps)
+            _save_checkpoint(checkpoint_dir, log_dir, completed_steps, remaining_steps, digest,
+                             decision_pending=True, with_globals=True, spill_dir=spill_dir)
+            stop_reason = budget.exceeded()
+            if stop_reason:
+                return _finish(completed_steps, _wind_down(log_dir, completed_steps, stop_reason))
+        decision_pending = False
+        step_number = len(completed_steps)
+
+        with span("decision", "plan", step=step_number) as trace_args:
+            decision: AfterStepDecision = make_after_step_decision(
+                task=task,
+                completed_steps=completed_steps,
+                remaining_steps=remaining_steps,
+                digest=digest,
+            )
+            trace_args["next_action"] = decision.next_action
+        ipc.send("progress", phase="decision", step=step_number, next_action=decision.next_action)
         _append_log(
             log_dir / "decisions.txt",
             f"Decision after step {step_number}:\n{decision.model_dump_json(indent=2)}",
         )
 
         if decision.next_action == "abort":
-            return decision.abort_reason or "Aborted by decision"
+            return _finish(completed_steps, decision.abort_reason or "Aborted by decision")
 
         if decision.next_action == 'task_completed':
-            return decision.task_completed_reason
+            return _finish(completed_steps, decision.task_completed_reason)
 
         if decision.next_action == "replan_remaining_steps":
-            plan = replan_remaining(
-                task=task,
-                completed_steps=completed_steps,
-                remaining_steps=remaining_steps,
-                after_step_decision=decision,
-            )
+            with span("replan", "plan", step=step_number):
+                plan = replan_remaining(
+                    task=task,
+                    completed_steps=completed_steps,
+                    remaining_steps=remaining_steps,
+                    after_step_decision=decision,
+                    digest=digest,
+                )
             remaining_steps = list(plan.steps)
             _append_log(
                 log_dir / "plan.txt",
                 f"Replan after step {step_number}:\n" + _format_plan(plan, start_step=step_number + 1),
             )
 
+        _release_dead_variables(log_dir, spill_dir, completed_steps, remaining_steps)
+
+        _save_checkpoint(checkpoint_dir, log_dir, completed_steps, remaining_steps, digest,
+                         decision_pending=False, with_globals=False)
+        flush_logs()
+
     if remaining_steps:
-        return "Stopped: exceeded max total steps."
+        reason = f"step limit of {budget.max_steps(MAX_TOTAL_STEPS)} exhausted"
+        return _finish(completed_steps, _wind_down(log_dir, completed_steps, reason))
 
-    return completed_steps[-1][1]
+    return _finish(completed_steps, completed_steps[-1][1])
@@ -1,24 +1,74 @@
+import os
 import ast
+import json
+import time
+import threading
+import importlib
 from pathlib import Path
-from typeguard import check_type
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from .utils import llm, LLM_MODEL_AGENT, check_assigned_variables, format_step_variables
+from .utils import llm, check_assigned_variables, format_step_variables
 from .prompt_agent import STEP_SYSTEM_PROMPT, build_step_user_first_msg_prompt
-from .executor import execute_python, execute_bash, PERSISTENT_GLOBALS
+from . import executor
+from .executor import execute_python, execute_bash, call_in_kernel, get_globals
+from .kernel import KernelError
+from .bash_session import BashSession
+from .profiling import kernel_snapshot, record_iteration
+from .var_summary import summarize_variables
+from .packages import preinstall_imports, wait_for_preinstalls, SHELL_INIT
+from .trace import span, span_per_iteration
+from . import budget, metrics
+from .validate import check_output_variables
+from .routing import Route
 from .log import _append_step_log, _append_reasoning
 
 MAX_ITERATIONS_PER_STEP = 30
+STEP_STOPPED = "Step stopped before completion"  # result of a step cut off by the budget or a cancel
 
-def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) -> str:
+# "auto": a completion set together with other code is accepted right away if the output variables
+#         pass validation (no "are you sure" round-trip), unless the step is risky.
+# "confirm": always ask the model to confirm with a separate two-line block.
+FINALIZATION_POLICY = "auto"
+# Steps whose description mentions one of these always go through the confirmation turn
+RISKY_STEP_KEYWORDS = (
+    "delete", "remove", "rm -", "drop", "overwrite", "truncate",
+    "send", "email", "upload", "publish", "deploy", "payment", "purchase",
+)
+
+
+# Best-of-K (opt-in per task, set by the server): run K attempts of a step concurrently, each in
+# its own copy of the kernel namespace, and keep the first one whose output variables validate.
+# Attempts share the work directory, so only steps the plan marks `parallel_safe` run this way.
+STEP_ATTEMPTS = int(os.environ.get("AGENT_STEP_ATTEMPTS", "1"))
+MAX_STEP_ATTEMPTS = 4
+ATTEMPT_TEMPERATURES = (0.0, 0.4, 0.7, 1.0)  # sampling of attempt i; the first one is the usual greedy run
+
+
+def _is_risky_step(step) -> bool:
+    description = step.step_description.lower()
+    return any(keyword in description for keyword in RISKY_STEP_KEYWORDS)
+
+
+def run_step(task, current_step, completed_steps, log_dir=None, step_index=0, digest=None,
+             finalization_policy=FINALIZATION_POLICY) -> str:
     step_folder = Path(log_dir) / f"step_{step_index}" if log_dir else None
     messages_log = step_folder / "messages.txt" if step_folder else None
-    reasoning_log = step_folder / "reasoning.txt" if step_folder else None
+
+    try:
+        variable_summaries = call_in_kernel(
+            summarize_variables, [var.variable_name for var in current_step.input_variables or []]
+        )
+    except Exception as e:
+        print(f"⚠️ Input variable summaries failed: {e}")
+        variable_summaries = {}
 
     system_prompt = STEP_SYSTEM_PROMPT
     user_prompt = build_step_user_first_msg_prompt(
         task=task,
         current_step=current_step,
         completed_steps=completed_steps,
+        digest=digest,
+        variable_summaries=variable_summaries,
     )
 
     messages = [
@@ -28,8 +78,116 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
     _append_step_log(messages_log, "system", system_prompt)
     _append_step_log(messages_log, "user", user_prompt)
 
-    for _ in range(MAX_ITERATIONS_PER_STEP):
-        llm_response, llm_response_blocks, reasoning = llm(messages, model=LLM_MODEL_AGENT)
+    attempts = min(STEP_ATTEMPTS, MAX_STEP_ATTEMPTS)
+    # side effects must not run K times
+    if attempts > 1 and current_step.parallel_safe and not _is_risky_step(current_step):
+        final_answer = _run_attempts(attempts, current_step, messages, step_folder, step_index, finalization_policy)
+        if final_answer is not None:
+            return final_answer
+    final_answer, _ = _run_iterations(current_step, messages, step_folder, step_index, finalization_policy)
+    return final_answer
+
+
+def _run_attempts(attempts, current_step, messages, step_folder, step_index, finalization_policy) -> str | None:
+    """Best-of-K: concurrent attempts in forked kernels, the first validated one is adopted.
+
+    Attempts share the work directory (files are not isolated, hence only for `parallel_safe`
+    steps), each gets its own bash session. If none validates, the greedy
+    attempt (0) is adopted as if it had run alone. None if the attempts could not be set up.
+    """
+    messages_log = step_folder / "messages.txt" if step_folder else None
+    kernels, sessions = [], []
+    try:
+        for _ in range(attempts):
+            kernels.append(executor.fork_kernel())
+            sessions.append(BashSession(cwd=os.getcwd(), init=SHELL_INIT))
+    except Exception as e:
+        for kernel in kernels:
+            kernel.stop()
+        for session in sessions:
+            session.close()
+        print(f"⚠️ Step {step_index}: attempts not started, running once: {e}")
+        return None
+    cancelled = threading.Event()
+    winner = []  # (attempt, final answer) of the first validated attempt
+    lock = threading.Lock()
+
+    def _attempt(i):
+        with executor.attempt_context(kernels[i], sessions[i]):
+            final_answer, valid = _run_iterations(
+                current_step, list(messages), step_folder / f"attempt_{i}" if step_folder else None,
+                step_index, finalization_policy, temperature=ATTEMPT_TEMPERATURES[i], cancelled=cancelled,
+            )
+        with lock:
+            if valid and not winner:
+                winner.append((i, final_answer))
+                cancelled.set()
+        return final_answer
+
+    pool = ThreadPoolExecutor(max_workers=attempts, thread_name_prefix="step-attempt")
+    futures = [pool.submit(_attempt, i) for i in range(attempts)]
+    pending = set(futures)
+    while pending and not winner:
+        _, pending = wait(pending, return_when=FIRST_COMPLETED)
+    pool.shutdown(wait=False)  # losers notice `cancelled` at their next iteration
+
+    if winner:
+        adopted, final_answer = winner[0]
+    else:
+        adopted = 0
+        error = futures[0].exception()
+        final_answer = f"Step failed: {error}" if error else futures[0].result()
+    executor.adopt_attempt(kernels[adopted], sessions[adopted])
+    for i in range(attempts):
+        if i != adopted:
+            kernels[i].stop()  # a loser busy in its kernel fails right away
+            sessions[i].close()
+    _append_step_log(messages_log, "attempts",
+                     f"{attempts} attempts, attempt {adopted} adopted ({'validated' if winner else 'none validated'})")
+    print(f"✓ Step {step_index}: attempt {adopted} of {attempts} adopted")
+    return final_answer
+
+
+def _validate_outputs(current_step) -> str:
+    """Validation error of the step's output variables; a failed kernel call is reported the same way."""
+    try:
+        return call_in_kernel(check_output_variables, current_step.output_variables)
+    except KernelError as e:  # also KernelTimeout / KernelCrashed
+        return f"Output variables could not be validated: {e}\n"
+
+
+def _kernel_snapshot() -> dict:
+    try:
+        return call_in_kernel(kernel_snapshot)
+    except KernelError as e:
+        return {"error": str(e)}
+
+
+def _log_escalation(messages_log, escalation) -> None:
+    if escalation:
+        _append_step_log(messages_log, "escalated", escalation)
+
+
+def _run_iterations(current_step, messages, step_folder, step_index, finalization_policy,
+                    temperature=0.0, cancelled=None) -> tuple[str, bool]:
+    """LLM / execution loop of one attempt; (final answer, output variables validated)."""
+    messages_log = step_folder / "messages.txt" if step_folder else None
+    reasoning_log = step_folder / "reasoning.txt" if step_folder else None
+
+    route = Route(current_step)
+    max_iterations = budget.max_iterations_per_step(MAX_ITERATIONS_PER_STEP)
+    for iteration in span_per_iteration("step_iteration", "step", max_iterations, step=step_index):
+        stop_reason = budget.exceeded()
+        if stop_reason:
+            _append_step_log(messages_log, "stopped", f"Step stopped: {stop_reason}")
+            return f"{STEP_STOPPED}: {stop_reason}.", False
+        if cancelled is not None and cancelled.is_set():
+            return "Attempt cancelled, another attempt completed the step.", False
+        iteration_start = time.monotonic()
+        llm_response, llm_response_blocks, reasoning = llm(
+            messages, model=route.model, temperature=temperature, reasoning_effort=route.effort)
+        llm_seconds = time.monotonic() - iteration_start
+        block_profiles = []
 
         if not llm_response_blocks:
             continue
@@ -44,19 +202,29 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
                         )
             messages.append({"role": "user", "content": user_msg})
             _append_step_log(messages_log, "user", user_msg)
+            _log_escalation(messages_log, route.observe(errors=True))
             continue
 
+        # missing imports that the wheelhouse has start installing while earlier blocks run
+        preinstalls = {
+            block_idx: preinstall_imports(block.block_text)
+            for block_idx, block in enumerate(llm_response_blocks) if block.block_type == "python"
+        }
+
         pending_text = []
         python_blocks = []
+        had_errors = False
         pair_idx = 0  # numbering for code/result pairs in logs
 
-        for block in llm_response_blocks:
+        for block_idx, block in enumerate(llm_response_blocks):
             if block.block_type == "text":
                 pending_text.append(block.block_text)
                 continue
 
             if block.block_type not in ("python", "bash"):
                 continue
+            if cancelled is not None and cancelled.is_set():
+                break
 
             code_type = block.block_type
             code = block.block_text
@@ -66,17 +234,34 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
             messages.append({"role": "assistant", "content": assistant_msg})
             _append_step_log(messages_log, f"assistant {pair_idx}", assistant_msg)
 
+            spill_prefix = step_folder / "outputs" / f"iter_{iteration}_block_{pair_idx}" if step_folder else None
             if code_type == "python":
-                code_response = execute_python(code)
+                if preinstalls[block_idx]:
+                    with span("wait_preinstall", "exec", modules=len(preinstalls[block_idx])):
+                        wait_for_preinstalls(preinstalls[block_idx])
+                    try:
+                        call_in_kernel(importlib.invalidate_caches)
+                    except KernelError as e:
+                        print(f"⚠️ Import caches not invalidated: {e}")
+                block_start = time.monotonic()
+                with span("execute_python", "exec", step=step_index, iteration=iteration, block=pair_idx):
+                    code_response = execute_python(code, spill_prefix=spill_prefix)
+                metrics.report("agent_exec_block_seconds", "observe", time.monotonic() - block_start, type="python")
                 python_blocks.append(code)
             elif code_type == "bash":
-                code_response = execute_bash(code)
+                block_start = time.monotonic()
+                with span("execute_bash", "exec", step=step_index, iteration=iteration, block=pair_idx):
+                    code_response = execute_bash(code, spill_prefix=spill_prefix)
+                metrics.report("agent_exec_block_seconds", "observe", time.monotonic() - block_start, type="bash")
             else:
                 user_msg = f"Unknown code type: {code_type}"
                 messages.append({"role": "user", "content": user_msg})
                 _append_step_log(messages_log, "user", user_msg)
                 continue
 
+            had_errors = had_errors or code_response.failed
+            if code_response.profile:
+                block_profiles.append({"block": pair_idx, "type": code_type, **code_response.profile})
             result_parts = []
             if code_response.stdout:
                 result_parts.append(f"\n**STDOUT:**\n{code_response.stdout}")
@@ -86,6 +271,11 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
 
             messages.append({"role": "user", "content": block_result})
             _append_step_log(messages_log, f"user {pair_idx}", block_result)
+            truncated = {
+                name: stats for name, stats in (code_response.output_stats or {}).items() if stats["truncated"]
+            }
+            if truncated:
+                _append_step_log(messages_log, f"output truncated {pair_idx}", json.dumps(truncated, indent=2))
             pair_idx += 1
 
         # If only text blocks existed, surface them once
@@ -94,10 +284,28 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
             messages.append({"role": "assistant", "content": text_msg})
             _append_step_log(messages_log, "assistant", text_msg)
 
+        if executor.PROFILING:
+            record_iteration(step_folder, step_index, {
+                "iteration": iteration,
+                "llm_seconds": round(llm_seconds, 3),
+                "wall_seconds": round(time.monotonic() - iteration_start, 3),
+                "blocks": block_profiles,
+                "kernel": _kernel_snapshot(),
+            })
+
+        _log_escalation(messages_log, route.observe(had_errors))
+
         # Was final_answer or step_status assigned in any python block?
         vars_assigned = any(check_assigned_variables(b) for b in python_blocks)
-        final_answer = PERSISTENT_GLOBALS.get('final_answer', '')
-        step_status = PERSISTENT_GLOBALS.get('step_status', '')
+        try:
+            status_vars = get_globals('final_answer', 'step_status')
+        except KernelError as e:  # e.g. a value that cannot be pickled
+            user_msg = f"Could not read `final_answer` / `step_status`: {e}\nBoth must be plain strings."
+            messages.append({"role": "user", "content": user_msg})
+            _append_step_log(messages_log, "user", user_msg)
+            continue
+        final_answer = status_vars.get('final_answer', '')
+        step_status = status_vars.get('step_status', '')
 
         # True only if exactly one python block exists AND it assigns both step_status and final_answer (order doesn't matter)
         twoline_oneblock_code = False
@@ -120,7 +328,17 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
                 pass
 
         if vars_assigned and final_answer and step_status and not twoline_oneblock_code:
-            are_you_sure_msg = (
+            validation_error = ""
+            if (finalization_policy == "auto" and step_status == 'completed'
+                    and not had_errors and not _is_risky_step(current_step)):
+                validation_error = _validate_outputs(current_step)
+                if not validation_error:
+                    _append_step_log(messages_log, "auto-finalized", "Output variables are valid, step accepted without confirmation.")
+                    route.finish(True)
+                    return final_answer, True
+                _log_escalation(messages_log, route.escalate("validation"))
+
+            are_you_sure_msg = validation_error + (
                 'Make sure that the step is completed correctly and you understand the result.\n'
                 'Analyze all the information above, facts and code execution results. You should base you descision on the information above.\n'
                 f'The current step target was: >>>{current_step.step_description}<<<\n'
@@ -137,37 +355,17 @@ def run_step(task, current_step, completed_steps, log_dir=None, step_index=0) ->
 
         if vars_assigned and final_answer and step_status and twoline_oneblock_code:
             if step_status == 'failed':
-                return final_answer
-
-            error_msg = ""
-            for var in current_step.output_variables:
-                name = var.variable_name
-                dtype_str = var.variable_data_type
-                value = PERSISTENT_GLOBALS.get(name, None)
-                if value is None:
-                    error_msg += f'Missing variable: {name}\n'
-                else:
-                    if dtype_str == 'object':
-                        continue
-                    try:
-                        glbs = dict(PERSISTENT_GLOBALS)
-                        if 'pd' in glbs and 'pandas' not in glbs:
-                            glbs['pandas'] = glbs['pd']
-                        if 'np' in glbs and 'numpy' not in glbs:
-                            glbs['numpy'] = glbs['np']
-                        
-                        dtype = eval(dtype_str, glbs)
-                        check_type(value, dtype)
-                    except Exception as e:
-                        error_msg += (f'Error: {name} is {type(value).__name__} but expected literal python type: {dtype_str}\n'
-                                        f'make sure that the variable {dtype_str} class exists verbatim in current python environment.\n'
-                                        f'name of the class should be verbatim {dtype_str}, so re-import it if needed\n'
-                                        f'examples of different imports: import pandas as pd VS import pandas; import numpy as np VS import numpy; etc\n'
-                                        )
+                route.finish(False)
+                return final_answer, False
+
+            error_msg = _validate_outputs(current_step)
             if not error_msg:
-                return final_answer
+                route.finish(True)
+                return final_answer, True
+            _log_escalation(messages_log, route.escalate("validation"))
             
             messages.append({"role": "user", "content": error_msg})
             _append_step_log(messages_log, "user", error_msg)
 
-    return "Max iterations reached without a final answer."
+    route.finish(False)
+    return "Max iterations reached without a final answer.", False
@@ -0,0 +1,106 @@
+"""
+On-demand sampling profiler for worker and kernel processes.
+
+The server writes a request file into the task spool and sends SIGUSR1 to the worker; the
+worker forwards the signal to its python kernel. Each process then samples the stacks of
+all its threads with `sys._current_frames()` for the requested time and writes a
+collapsed-stack file (`frame;frame;frame count` per line, the flamegraph.pl / speedscope
+input format). Pure python, no ptrace, so it works without extra capabilities.
+
+SIGUSR1 terminates a process that has no handler yet, so parents block it while spawning
+and `install` unblocks it once the handler is in place.
+"""
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+PROFILE_REQUEST_FILE = "profile_request.json"
+SAMPLE_INTERVAL = 0.01  # seconds between samples (100 Hz)
+MAX_PROFILE_SECONDS = 60
+
+_request_path: Path | None = None
+_label = ""
+_forward_pids = None
+_active = threading.Lock()  # one sampling run per process at a time
+
+
+def install(request_path: Path, label: str, forward_pids=None) -> None:
+    """Handle SIGUSR1 by sampling this process; `forward_pids()` lists processes to pass the signal on to."""
+    global _request_path, _label, _forward_pids
+    _request_path = Path(request_path)
+    _label = label
+    _forward_pids = forward_pids
+    signal.signal(signal.SIGUSR1, _on_signal)
+    signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGUSR1})
+
+
+def _on_signal(signum, frame) -> None:
+    for pid in (_forward_pids() if _forward_pids else []):
+        try:
+            os.kill(pid, signal.SIGUSR1)
+        except (ProcessLookupError, PermissionError):
+            pass
+    try:
+        with _request_path.open("r", encoding="utf-8") as f:
+            request = json.load(f)
+    except (OSError, ValueError):
+        return
+    if not _active.acquire(blocking=False):
+        return  # already sampling
+    threading.Thread(target=_run, args=(request,), name="stack-sampler", daemon=True).start()
+
+
+def _run(request: dict) -> None:
+    try:
+        seconds = min(float(request.get("seconds", 5)), MAX_PROFILE_SECONDS)
+        stacks = sample_stacks(seconds, SAMPLE_INTERVAL)
+        output = Path(request["output_dir"]) / f"{request['id']}.{_label}.folded"
+        write_folded(output, stacks, prefix=f"{_label} (pid {os.getpid()})")
+    except Exception as e:
+        print(f"⚠️ Stack sampling failed: {e}")
+    finally:
+        _active.release()
+
+
+def _frame_name(frame) -> str:
+    code = frame.f_code
+    filename = code.co_filename
+    if filename == "<string>":
+        filename = "<agent code>"  # blocks run by exec() in the kernel
+    else:
+        filename = "/".join(Path(filename).parts[-2:])
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ",")
+
+
+def sample_stacks(seconds: float, interval: float = SAMPLE_INTERVAL) -> Counter:
+    """Collapsed stacks of all other threads, root first, counted over `seconds`."""
+    own = threading.get_ident()
+    stacks: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None:
+                frames.append(_frame_name(frame))
+                frame = frame.f_back
+            frames.append(f"thread {names.get(ident, ident)}")
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(interval)
+    return stacks
+
+
+def write_folded(path: Path, stacks: Counter, prefix: str = "") -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{prefix + ';' if prefix else ''}{stack} {count}\n")
+    os.replace(tmp, path)
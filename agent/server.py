@@ -2,48 +2,133 @@
 
 import uuid
 import gc
+import math
+import hashlib
+import os
 import sys
+import time
+import queue
+import fcntl
+import signal
+import asyncio
 import threading
+import socket
 import subprocess
 from pathlib import Path
-from collections import deque
-from fastapi import FastAPI
+from contextlib import contextmanager
+from fastapi import FastAPI, Header
+from fastapi.responses import JSONResponse, PlainTextResponse
 from pydantic import BaseModel
 from typing import Optional, Dict
 
-from .executor import PERSISTENT_GLOBALS
+from .log import LOGS_DIR
+from .task_storage import (
+    LOG_READ_MAX_BYTES,
+    RETENTION_INTERVAL,
+    compress_task_logs,
+    enforce_retention,
+    list_log_files,
+    read_log_range,
+)
+from .trace import SERVER_TRACE_FILE, append_events, complete_event, load_trace, now_us
+from .sampler import MAX_PROFILE_SECONDS, PROFILE_REQUEST_FILE
+from .budget import TaskBudget
+from . import limits
+from .limits import LIMIT_CHECK_INTERVAL, ResourceLimits
+from .run_step import MAX_STEP_ATTEMPTS
+from .task_backend import LEASE_SECONDS, NODE_ID, make_backend
+from .ipc import HEARTBEAT_INTERVAL, IPC_FD_ENV, SPOOL_AUDIT_ENV, Channel, FrameTooLarge, channel_pair
+from . import metrics
+from .metrics import (
+    DEDUP_HITS,
+    LIMIT_VIOLATIONS,
+    QUEUE_DEPTH,
+    QUEUE_WAIT,
+    SPAWN_LATENCY,
+    TASK_DURATION,
+    TASKS_FINISHED,
+    TASKS_RUNNING,
+    MetricsReceiver,
+)
 
 app = FastAPI(title="Planning Agent API")
 
-# In-process state (no cross-process Manager)
-tasks_store: Dict[str, dict] = {}  # task_id -> {status, task, result, error, input_path, output_path}
-tasks_lock = threading.Lock()
-pending_queue: deque[str] = deque()  # task_ids waiting to start
-active_processes: Dict[str, subprocess.Popen] = {}  # task_id -> Popen
-active_processes_lock = threading.Lock()
-
 # Spool directory for worker I/O
 SPOOL_DIR = Path("/app/agent_spool")
+
+# Task records and the pending queue: shared by all server processes with the sqlite backend
+# (task_backend.py); each process runs and leases the workers it spawned
+backend = make_backend(SPOOL_DIR / "tasks.db")  # records: {task_id, status, task, result, error, ...}
+LEASE_RENEW_INTERVAL = LEASE_SECONDS / 4
+LEASE_CHECK_INTERVAL = 10  # seconds between scans for expired leases of lost nodes (and shed tasks)
+
+# Admission control: /run answers 429 once the queue is this deep or the estimated wait this long
+MAX_QUEUE_DEPTH = int(os.environ.get("AGENT_MAX_QUEUE_DEPTH", "200"))
+MAX_QUEUE_WAIT = float(os.environ.get("AGENT_MAX_QUEUE_WAIT", "3600"))  # seconds
+THROUGHPUT_WINDOW = 1800  # seconds of finished runs the wait estimate is based on
+DEFAULT_TASK_SECONDS = 300  # assumed run time until enough runs have finished
+MIN_THROUGHPUT_SAMPLES = 5
+
+# Deduplication on /run: identical tasks attach to one in flight or reuse a recent result
+RESULT_REUSE_TTL = float(os.environ.get("AGENT_RESULT_TTL", "3600"))  # seconds a completed result is reused
+IDEMPOTENCY_TTL = 24 * 3600  # seconds an Idempotency-Key maps to its task
+server_started_at = time.time()
+
+# Workers of this process
+active_processes: Dict[str, subprocess.Popen] = {}  # task_id -> Popen
+active_processes_lock = threading.Lock()
+worker_channels: Dict[str, tuple[Channel, threading.Thread]] = {}  # task_id -> (channel, reader), under active_processes_lock
+worker_heartbeats: Dict[str, float] = {}  # task_id -> monotonic time of the last message
+hung_tasks: set[str] = set()  # killed for missing heartbeats, reaped as failed
+stopping: Dict[str, tuple[float, str]] = {}  # task_id -> (monotonic kill time, reason): SIGTERM sent
+time_limits: Dict[str, float] = {}  # task_id -> monotonic time its time budget (plus grace) runs out
+worker_limits: Dict[str, dict] = {}  # task_id -> resource limits of its worker (limits.py)
+worker_rusage: Dict[str, dict] = {}  # task_id -> rusage of the exited worker, until reaped
+limit_violations: Dict[str, tuple[str, str]] = {}  # task_id -> (failure reason, detail): killed over a limit
+lost_leases: set[str] = set()  # killed after their lease passed to another node
+CANCEL_GRACE_SECONDS = 30  # after SIGTERM a worker has this long to return partial results
 MAX_CONCURRENT = 4
+SPOOL_AUDIT = True  # also keep input.json / output.json in the spool (results travel over the worker channel)
+HEARTBEAT_TIMEOUT = 24 * HEARTBEAT_INTERVAL  # a worker silent for this long is hung and gets killed
+
+WORK_DIR = Path(__file__).parent.parent / "work"
 
 # Supervisor thread
 supervisor_thread = None
 supervisor_stop_event = threading.Event()
 
+# Maintenance thread: log compression of finished tasks, retention of task data
+maintenance_thread = None
+maintenance_queue: queue.SimpleQueue = queue.SimpleQueue()  # task_ids whose logs should be compressed
+STORAGE_LOCK_FILE = SPOOL_DIR / "storage.lock"  # flock shared by all server processes
+task_sizes: Dict[str, int] = {}  # bytes on disk of finished tasks, for retention (maintenance thread only)
+
+# Datagram socket workers report metrics to (LLM calls, code blocks, steps)
+METRICS_SOCKET = SPOOL_DIR / f"metrics.{os.getpid()}.sock"
+metrics_receiver = MetricsReceiver(METRICS_SOCKET)
+# Values of this process for /metrics answered by the other server processes
+METRICS_SNAPSHOT = metrics.snapshot_path(SPOOL_DIR / "metrics")
+METRICS_SNAPSHOT_INTERVAL = 5  # seconds
 
-def kill_process_group(proc: subprocess.Popen, timeout_term=2, timeout_kill=1):
-    """Kill a process and its entire process group."""
+
+@contextmanager
+def storage_lock():
+    """A task does not start while its files are compressed or deleted, by any server process."""
+    with open(STORAGE_LOCK_FILE, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def kill_process_group(task_id: str, proc: subprocess.Popen, timeout_term=2, timeout_kill=1):
+    """Kill a process and its entire process group; reaped through _wait_worker, so its rusage is kept."""
     import os
     import signal
     
-    exit_code = proc.poll()
-    if exit_code is not None:
-        # Already finished - reap to avoid zombies
-        try:
-            proc.wait(timeout=0)
-        except Exception:
-            pass
-        return
+    if _wait_worker(task_id, proc):
+        return  # Already finished (and reaped)
     
     try:
         # Get process group ID
@@ -56,11 +141,8 @@ def kill_process_group(proc: subprocess.Popen, timeout_term=2, timeout_kill=1):
             return  # Already dead
         
         # Wait for termination
-        try:
-            proc.wait(timeout=timeout_term)
+        if _wait_exit(task_id, proc, timeout_term):
             return  # Terminated gracefully
-        except subprocess.TimeoutExpired:
-            pass
         
         # Escalate to SIGKILL (force)
         try:
@@ -68,44 +150,65 @@ def kill_process_group(proc: subprocess.Popen, timeout_term=2, timeout_kill=1):
         except ProcessLookupError:
             return  # Already dead
         
-        proc.wait(timeout=timeout_kill)
+        _wait_exit(task_id, proc, timeout_kill)
     except Exception as e:
         # Fallback to single process kill
         try:
             proc.kill()
-            proc.wait(timeout=timeout_kill)
+            _wait_exit(task_id, proc, timeout_kill)
         except:
             pass
 
 
-def start_task_subprocess(task_id: str):
+def _wait_exit(task_id: str, proc: subprocess.Popen, timeout: float) -> bool:
+    """Wait up to `timeout` seconds for a worker to exit; True once it is reaped."""
+    deadline = time.monotonic() + timeout
+    while not _wait_worker(task_id, proc):
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def start_task_subprocess(task_data: dict):
     """
-    Start a subprocess for the given task_id. 
+    Start a subprocess for a task leased by this node.
     Returns the Popen object on success, None on failure.
     Caller must hold active_processes_lock and add proc to active_processes.
     """
     import json
     
-    with tasks_lock:
-        if task_id not in tasks_store:
-            return None
-        task_data = tasks_store[task_id]
-        task = task_data["task"]
+    task_id = task_data["task_id"]
+    task = task_data["task"]
+    resume = task_data.get("resume", False)
+    profile = task_data.get("profile", False)
+    step_attempts = task_data.get("step_attempts", 1)
+    task_limits = task_data.get("limits") or limits.effective(None)
+    queued_at_us = task_data.get("queued_at_us")
     
-    # Create spool directory for this task
+    # Create spool directory for this task. The task is leased (active): maintenance passes waiting
+    # for the lock skip it, one that holds the lock finishes compressing or deleting first.
     task_spool = SPOOL_DIR / task_id
-    task_spool.mkdir(parents=True, exist_ok=True)
+    with storage_lock():
+        task_spool.mkdir(parents=True, exist_ok=True)
     
     input_path = task_spool / "input.json"
     output_path = task_spool / "output.json"
     stdout_path = task_spool / "stdout.log"
     stderr_path = task_spool / "stderr.log"
     
-    # Write input JSON
-    with open(input_path, "w") as f:
-        json.dump({"task_id": task_id, "task": task}, f)
+    # Drop the output of a previous run (resumed tasks), it must not be mistaken for this run's result
+    output_path.unlink(missing_ok=True)
+
+    spawned_at_us = now_us()
+    task_input = {"task_id": task_id, "task": task, "resume": resume, "profile": profile,
+                  "spawned_at_us": spawned_at_us, "budget": task_data.get("budget")}
+    if SPOOL_AUDIT:
+        with open(input_path, "w") as f:
+            json.dump(task_input, f)
     
     # Start subprocess with start_new_session for process group control
+    channel, worker_sock = channel_pair()
     try:
         stdout_log = open(stdout_path, "wb", buffering=0)
         stderr_log = open(stderr_path, "wb", buffering=0)
@@ -115,95 +218,430 @@ def start_task_subprocess(task_id: str):
             start_new_session=True,
             cwd=str(Path(__file__).parent.parent),  # Project root (/app) for module imports
             stdout=stdout_log,
-            stderr=stderr_log
+            stderr=stderr_log,
+            pass_fds=(worker_sock.fileno(),),
+            env={**os.environ, "AGENT_PROFILING": "1" if profile else "0",
+                 "AGENT_STEP_ATTEMPTS": str(step_attempts),
+                 "AGENT_ROUTING_STATS": str(SPOOL_DIR / "routing_stats.json"),
+                 metrics.METRICS_SOCKET_ENV: str(METRICS_SOCKET),
+                 IPC_FD_ENV: str(worker_sock.fileno()),
+                 SPOOL_AUDIT_ENV: "1" if SPOOL_AUDIT else "0"},
         )
+        limits.apply(proc.pid, task_limits)  # before the worker starts its kernel and shell
+        worker_limits[task_id] = task_limits
+        worker_sock.close()
+        channel.send({"type": "input", **task_input})  # buffered by the socket until the worker reads it
+        reader = threading.Thread(target=_read_worker_channel, args=(task_id, channel), daemon=True)
+        reader.start()
+        worker_channels[task_id] = (channel, reader)
+        spawn_done_us = now_us()
+        SPAWN_LATENCY.observe((spawn_done_us - spawned_at_us) / 1e6)
+        TASKS_RUNNING.inc()
         
-        # Update task status to running
-        with tasks_lock:
-            if task_id in tasks_store:
-                tasks_store[task_id]["status"] = "running"
-                tasks_store[task_id]["input_path"] = str(input_path)
-                tasks_store[task_id]["output_path"] = str(output_path)
-                tasks_store[task_id]["stdout_path"] = str(stdout_path)
-                tasks_store[task_id]["stderr_path"] = str(stderr_path)
+        events = [complete_event("spawn", "server", spawned_at_us, spawn_done_us, pid=proc.pid)]
+        if queued_at_us:
+            QUEUE_WAIT.observe((spawned_at_us - queued_at_us) / 1e6)
+            events.insert(0, complete_event("queue_wait", "server", queued_at_us, spawned_at_us, resume=resume))
+        _trace(task_id, events)
+
+        worker_heartbeats[task_id] = time.monotonic()
+        max_seconds = (task_data.get("budget") or {}).get("max_seconds")
+        if max_seconds is not None:
+            # the worker winds down by itself, this catches a run stuck in one LLM call or code block
+            time_limits[task_id] = time.monotonic() + max_seconds + CANCEL_GRACE_SECONDS
+
+        def _started(info):
+            info.pop("final", None)
+            info.pop("failure_reason", None)
+            info.pop("limit_hits", None)
+            info.update(
+                spawned_at_us=spawned_at_us,
+                worker_pid=proc.pid,
+                input_path=str(input_path),
+                output_path=str(output_path),
+                stdout_path=str(stdout_path),
+                stderr_path=str(stderr_path),
+            )
+
+        backend.mutate(task_id, _started, owner=NODE_ID)
         
         print(f"✓ Task {task_id[:8]} started PID={proc.pid}")
         return proc
     except Exception as e:
+        worker_sock.close()
+        channel.close()
         print(f"✗ Task {task_id[:8]} spawn failed: {e}")
-        with tasks_lock:
-            if task_id in tasks_store:
-                tasks_store[task_id]["status"] = "failed"
-                tasks_store[task_id]["error"] = f"Failed to spawn: {e}"
+        TASKS_FINISHED.inc(outcome="failed")
+        backend.mutate(task_id, lambda info: info.update(status="failed", error=f"Failed to spawn: {e}", lease_owner=None),
+                       owner=NODE_ID)
         return None
 
 
+def _trace(task_id: str, events: list[dict]) -> None:
+    try:
+        append_events(SPOOL_DIR / task_id / SERVER_TRACE_FILE, events)
+    except OSError as e:
+        print(f"⚠️ Task {task_id[:8]} trace write failed: {e}")
+
+
+def _read_worker_channel(task_id: str, channel: Channel):
+    """Reader thread of one worker channel: heartbeats, progress, partial and final results."""
+    while True:
+        try:
+            message = channel.recv()
+        except FrameTooLarge as e:
+            # the message is lost (if it was the result, the spool output is used), the channel goes on
+            print(f"⚠️ Task {task_id[:8]} {e}")
+            backend.mutate(task_id, lambda info: info.update(ipc_error=str(e)), owner=NODE_ID)
+            continue
+        except (OSError, ValueError) as e:
+            print(f"⚠️ Task {task_id[:8]} channel error: {e}")
+            return
+        if message is None:
+            return  # worker exited
+        message_type = message.pop("type", None)
+        worker_heartbeats[task_id] = time.monotonic()
+        if message_type == "progress":
+            backend.mutate(task_id, lambda info: info.update(progress=message), owner=NODE_ID)
+        elif message_type == "partial":
+            backend.mutate(task_id, lambda info: info.setdefault("partial_results", []).append(message), owner=NODE_ID)
+        elif message_type == "result":
+            backend.mutate(task_id, lambda info: info.update(final=message), owner=NODE_ID)
+        elif message_type == "limit":
+            LIMIT_VIOLATIONS.inc(limit=message.get("reason", ""))
+            print(f"⚠️ Task {task_id[:8]} kernel hit a limit: {message.get('detail')}")
+            backend.mutate(task_id, lambda info: info.setdefault("limit_hits", []).append(message), owner=NODE_ID)
+
+
+def _apply_output(info: dict, output: dict) -> None:
+    """Store a worker's final output in its task record."""
+    # Clamp status to only valid values
+    status = output.get("status", "")
+    if status not in ("completed", "failed", "cancelled"):
+        info["status"] = "failed"
+        info["error"] = f"Worker returned invalid status: {status}"
+        return
+    info["status"] = status
+    if "result" in output:
+        info["result"] = output["result"]
+    if "error" in output:
+        info["error"] = output["error"]
+    info["stopped"] = output.get("stopped")  # budget exhausted / cancelled: result is partial
+    info["usage"] = output.get("usage")
+
+
 def supervisor_loop():
-    """Supervisor thread that reaps finished processes and starts pending tasks."""
-    import json
+    """Supervisor thread that reaps finished processes, keeps leases and starts pending tasks."""
+    # Workers inherit a blocked SIGUSR1 (stack sampling) and unblock it once they handle it
+    signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGUSR1})
+    next_renew = next_lease_check = next_limit_check = next_snapshot = time.monotonic()
     
     while not supervisor_stop_event.is_set():
-        # 1. Reap finished processes
-        with active_processes_lock:
-            finished_ids = []
-            for task_id, proc in list(active_processes.items()):
-                exit_code = proc.poll()
-                if exit_code is not None:
-                    # Process finished
-                    proc.wait()  # Reap
-                    finished_ids.append(task_id)
-                    
-                    # Read output JSON
-                    with tasks_lock:
-                        if task_id in tasks_store:
-                            output_path = Path(tasks_store[task_id].get("output_path", ""))
-                            if output_path.exists():
-                                try:
-                                    with open(output_path, "r") as f:
-                                        output = json.load(f)
-                                    
-                                    # Clamp status to only valid values
-                                    status = output.get("status", "")
-                                    if status not in ("completed", "failed"):
-                                        tasks_store[task_id]["status"] = "failed"
-                                        tasks_store[task_id]["error"] = f"Worker returned invalid status: {status}"
-                                    else:
-                                        tasks_store[task_id]["status"] = status
-                                        if "result" in output:
-                                            tasks_store[task_id]["result"] = output["result"]
-                                        if "error" in output:
-                                            tasks_store[task_id]["error"] = output["error"]
-                                except Exception as e:
-                                    tasks_store[task_id]["status"] = "failed"
-                                    tasks_store[task_id]["error"] = f"Failed to parse output: {e}"
-                            else:
-                                # No output file, crashed
-                                tasks_store[task_id]["status"] = "failed"
-                                tasks_store[task_id]["error"] = f"Worker exited with code {exit_code} (no output)"
-            
-            # Remove finished processes
-            for task_id in finished_ids:
-                active_processes.pop(task_id, None)
-        
-        # 2. Start pending tasks (concurrency cap)
-        with active_processes_lock:
-            while len(active_processes) < MAX_CONCURRENT and len(pending_queue) > 0:
-                task_id = pending_queue.popleft()
-                proc = start_task_subprocess(task_id)
-                if proc:
-                    active_processes[task_id] = proc
+        try:
+            # 1. Reap finished processes
+            with active_processes_lock:
+                finished_ids = [task_id for task_id, proc in active_processes.items() if _poll_worker(task_id, proc)]
+                for task_id in finished_ids:
+                    _reap(task_id, active_processes.pop(task_id))
+                    maintenance_queue.put(task_id)
+                if time.monotonic() >= next_limit_check:
+                    next_limit_check = time.monotonic() + LIMIT_CHECK_INTERVAL
+                    _check_limits()
+
+            # 2. Leases: renew ours, re-queue tasks of lost nodes
+            if time.monotonic() >= next_renew:
+                next_renew = time.monotonic() + LEASE_RENEW_INTERVAL
+                with active_processes_lock:
+                    running = list(active_processes)
+                _kill_lost(backend.renew(NODE_ID, running))
+                _stop_cancelled(running)
+            if time.monotonic() >= next_lease_check:
+                next_lease_check = time.monotonic() + LEASE_CHECK_INTERVAL
+                requeued, failed = backend.requeue_expired()
+                for task_id in requeued:
+                    print(f"⚠️ Task {task_id[:8]} lease expired, re-queued")
+                for task_id in failed:
+                    print(f"✗ Task {task_id[:8]} lease expired too often, failed")
+                for task_id in backend.shed_expired():
+                    TASKS_FINISHED.inc(outcome="shed")
+                    print(f"⚠️ Task {task_id[:8]} shed, deadline passed before it could start")
+
+            # 3. Start pending tasks (concurrency cap per server process)
+            with active_processes_lock:
+                while len(active_processes) < MAX_CONCURRENT:
+                    task_data = backend.lease(NODE_ID)
+                    if task_data is None:
+                        break
+                    proc = start_task_subprocess(task_data)
+                    if proc:
+                        active_processes[task_data["task_id"]] = proc
+            QUEUE_DEPTH.set(backend.queue_depth())
+            if time.monotonic() >= next_snapshot:
+                next_snapshot = time.monotonic() + METRICS_SNAPSHOT_INTERVAL
+                metrics.write_snapshot(METRICS_SNAPSHOT)
+        except Exception as e:
+            print(f"⚠️ Supervisor pass failed: {e}")
         
         # Interruptible wait for shutdown
         supervisor_stop_event.wait(0.1)
 
 
+def _wait_worker(task_id: str, proc: subprocess.Popen) -> bool:
+    """True once the worker exited; reaps it with wait4 to keep its rusage."""
+    if proc.returncode is not None:
+        return True
+    try:
+        pid, wait_status, rusage = os.wait4(proc.pid, os.WNOHANG)
+    except ChildProcessError:
+        return proc.poll() is not None  # reaped elsewhere, no rusage
+    if pid == 0:
+        return False
+    proc.returncode = os.waitstatus_to_exitcode(wait_status)
+    worker_rusage[task_id] = limits.rusage_summary(rusage)
+    return True
+
+
+def _poll_worker(task_id: str, proc: subprocess.Popen) -> bool:
+    """True once the worker exited; stops it when it is over time or stopped sending heartbeats."""
+    if _wait_worker(task_id, proc):
+        return True
+    if task_id in stopping:
+        if time.monotonic() >= stopping[task_id][0]:
+            print(f"⚠️ Task {task_id[:8]} did not stop within {CANCEL_GRACE_SECONDS}s, killing worker")
+            kill_process_group(task_id, proc)
+        return False
+    if task_id in time_limits and time.monotonic() >= time_limits[task_id]:
+        _stop_worker(task_id, proc, "time budget exceeded")
+        return False
+    _check_heartbeat(task_id, proc)
+    return False
+
+
+def _check_limits() -> None:
+    """Kill workers over their process count or work directory quota. Caller holds active_processes_lock."""
+    for task_id, proc in active_processes.items():
+        if task_id in limit_violations or task_id in hung_tasks or task_id in lost_leases or proc.returncode is not None:
+            continue
+        violation = limits.check_running(worker_limits.get(task_id, {}), proc.pid, WORK_DIR / task_id)
+        if violation is None:
+            continue
+        limit_violations[task_id] = violation
+        LIMIT_VIOLATIONS.inc(limit=violation[0])
+        print(f"✗ Task {task_id[:8]} over its limit ({violation[1]}), killing worker")
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)  # reaped (with rusage) on the next pass
+        except ProcessLookupError:
+            pass
+
+
+def _stop_worker(task_id: str, proc: subprocess.Popen, reason: str) -> None:
+    """Ask a worker to wind down (SIGTERM to the worker only, its kernel keeps running);
+    it is killed with its process group after CANCEL_GRACE_SECONDS. Caller holds active_processes_lock."""
+    if task_id in stopping:
+        return
+    stopping[task_id] = (time.monotonic() + CANCEL_GRACE_SECONDS, reason)
+    print(f"✓ Task {task_id[:8]} stopping: {reason}")
+    try:
+        os.kill(proc.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        pass
+
+
+def _kill_lost(task_ids: list[str]) -> None:
+    """Kill workers whose lease could not be renewed: the task was re-queued (or ended) elsewhere."""
+    with active_processes_lock:
+        for task_id in task_ids:
+            proc = active_processes.get(task_id)
+            if proc is None or task_id in lost_leases:
+                continue
+            lost_leases.add(task_id)
+            print(f"✗ Task {task_id[:8]} lease lost to another node, killing worker")
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)  # reaped on the next pass, its result is dropped
+            except ProcessLookupError:
+                pass
+
+
+def _stop_cancelled(task_ids: list[str]) -> None:
+    """Stop workers of this process whose task was cancelled through another server process."""
+    for task_id in task_ids:
+        if task_id in stopping:
+            continue
+        info = backend.get(task_id)
+        if info is not None and info.get("cancel_requested"):
+            with active_processes_lock:
+                proc = active_processes.get(task_id)
+                if proc is not None:
+                    _stop_worker(task_id, proc, "cancelled")
+
+
+def _reap(task_id: str, proc: subprocess.Popen) -> None:
+    """Store the outcome of a finished worker. Caller holds active_processes_lock."""
+    import json
+
+    exit_code = proc.returncode  # reaped by _wait_worker
+
+    # The reader sees EOF once the worker is gone and has then stored the final result
+    channel, reader = worker_channels.pop(task_id, (None, None))
+    if reader is not None:
+        reader.join(timeout=5)
+        channel.close()
+    worker_heartbeats.pop(task_id, None)
+    time_limits.pop(task_id, None)
+    hung = task_id in hung_tasks
+    hung_tasks.discard(task_id)
+    _, stop_reason = stopping.pop(task_id, (None, None))
+    task_limits = worker_limits.pop(task_id, {})
+    rusage = worker_rusage.pop(task_id, None)
+    violation = limit_violations.pop(task_id, None)
+    lost_leases.discard(task_id)
+    counted = violation is not None  # in LIMIT_VIOLATIONS when killed or reported by the worker
+
+    def _finished(info):
+        nonlocal counted
+        final = info.pop("final", None)
+        output_path = Path(info.get("output_path", ""))
+        info["lease_owner"] = None
+        info["finished_at"] = time.time()
+        if final is not None:
+            _apply_output(info, final)
+        elif stop_reason is not None:
+            info["status"] = "failed"
+            info["error"] = f"Worker killed, {stop_reason}"
+        elif hung:
+            info["status"] = "failed"
+            info["error"] = f"Worker sent no heartbeat for {HEARTBEAT_TIMEOUT}s and was killed"
+        elif output_path.is_file():
+            # Worker without a channel result (e.g. the channel broke): spool output
+            try:
+                with open(output_path, "r") as f:
+                    _apply_output(info, json.load(f))
+            except Exception as e:
+                info["status"] = "failed"
+                info["error"] = f"Failed to parse output: {e}"
+        else:
+            # No result, crashed
+            info["status"] = "failed"
+            info["error"] = f"Worker exited with code {exit_code} (no output)"
+            if info.get("ipc_error"):
+                info["error"] += f", {info['ipc_error']}"
+        if info.pop("cancel_requested", False):
+            info["status"] = "cancelled"  # partial results, if any, stay in result / partial_results
+        info["rusage"] = rusage
+        exceeded = violation
+        if exceeded is None and info["status"] == "failed":
+            if final and final.get("error_type"):
+                error = f"{final['error_type']}: {final.get('error', '')}"
+            else:
+                error = limits.last_line(Path(info.get("stderr_path", "")))
+            exceeded = limits.check_exited(task_limits, exit_code, rusage, error)
+            if exceeded is None and info.get("limit_hits"):
+                # the task failed after its kernel ran into a limit (the worker went on)
+                hit = info["limit_hits"][-1]
+                exceeded, counted = (hit["reason"], hit["detail"]), True
+        if exceeded is not None:
+            info["status"] = "failed"
+            info["failure_reason"], detail = exceeded
+            info["error"] = f"Worker exceeded its resource limits: {detail}"
+
+    info = backend.mutate(task_id, _finished, owner=NODE_ID)
+    TASKS_RUNNING.dec()
+    if info is None:
+        print(f"⚠️ Task {task_id[:8]} finished after its lease was lost, result dropped")
+        return
+    if not counted and info.get("failure_reason"):
+        LIMIT_VIOLATIONS.inc(limit=info["failure_reason"])  # found after exit (a killed worker is counted when killed)
+    if info.get("spawned_at_us"):
+        _trace(task_id, [complete_event(
+            "worker_process", "server", info["spawned_at_us"], now_us(),
+            exit_code=exit_code,
+        )])
+    _record_finished(info)
+
+
+def _close_channels() -> None:
+    """Drop the channels and bookkeeping of killed workers. Caller holds active_processes_lock."""
+    for channel, _ in worker_channels.values():
+        channel.close()
+    worker_channels.clear()
+    worker_heartbeats.clear()
+    hung_tasks.clear()
+    stopping.clear()
+    time_limits.clear()
+    worker_limits.clear()
+    worker_rusage.clear()
+    limit_violations.clear()
+    lost_leases.clear()
+
+
+def _check_heartbeat(task_id: str, proc: subprocess.Popen) -> None:
+    """Kill a running worker that stopped sending heartbeats; it is reaped on the next pass."""
+    if task_id in hung_tasks:
+        return
+    silent = time.monotonic() - worker_heartbeats.get(task_id, time.monotonic())
+    if silent < HEARTBEAT_TIMEOUT:
+        return
+    hung_tasks.add(task_id)
+    print(f"⚠️ Task {task_id[:8]} silent for {silent:.0f}s, killing worker")
+    kill_process_group(task_id, proc)
+
+
+def _record_finished(task_info: dict) -> None:
+    """Outcome and run time of a reaped worker."""
+    outcome = task_info["status"]
+    TASKS_FINISHED.inc(outcome=outcome)
+    if task_info.get("spawned_at_us"):
+        TASK_DURATION.observe((now_us() - task_info["spawned_at_us"]) / 1e6, outcome=outcome)
+
+
+def _is_active(task_id: str) -> bool:
+    info = backend.get(task_id)
+    return info is not None and info["status"] in ("pending", "running")
+
+
+def maintenance_loop():
+    """Compress logs of finished tasks; keep spool, work and logs under the retention budget."""
+    next_retention = time.monotonic()
+    while not supervisor_stop_event.is_set():
+        try:
+            task_id = maintenance_queue.get(timeout=1)
+        except queue.Empty:
+            task_id = None
+
+        if task_id is not None:
+            task_sizes.pop(task_id, None)  # finished (again), its size changed
+            with storage_lock():
+                try:
+                    if not _is_active(task_id):
+                        saved = compress_task_logs(LOGS_DIR / task_id)
+                        print(f"✓ Task {task_id[:8]} logs compressed ({saved / 2**20:.1f} MB saved)")
+                except Exception as e:
+                    print(f"⚠️ Task {task_id[:8]} log compression failed: {e}")
+
+        if time.monotonic() >= next_retention:
+            next_retention = time.monotonic() + RETENTION_INTERVAL
+            try:
+                protected = set(backend.ids(("pending", "running")))
+                deleted = enforce_retention([SPOOL_DIR, WORK_DIR, LOGS_DIR], protected, task_sizes,
+                                            lock=storage_lock, is_active=_is_active)
+            except Exception as e:
+                print(f"⚠️ Retention pass failed: {e}")
+                deleted = []
+            if deleted:
+                backend.delete(deleted)
+                print(f"✓ Retention: removed data of {len(deleted)} old tasks")
+
+
 @app.on_event("startup")
 async def startup_event():
-    global supervisor_thread
+    global supervisor_thread, maintenance_thread
     SPOOL_DIR.mkdir(parents=True, exist_ok=True)
+    metrics_receiver.start()
     supervisor_stop_event.clear()
     supervisor_thread = threading.Thread(target=supervisor_loop, daemon=True)
     supervisor_thread.start()
+    maintenance_thread = threading.Thread(target=maintenance_loop, daemon=True)
+    maintenance_thread.start()
     print("✓ Agent server started")
 
 
@@ -212,128 +650,419 @@ async def shutdown_event():
     supervisor_stop_event.set()
     if supervisor_thread:
         supervisor_thread.join(timeout=2)
+    if maintenance_thread:
+        maintenance_thread.join(timeout=2)
     
     with active_processes_lock:
-        for proc in active_processes.values():
-            kill_process_group(proc)
+        for task_id, proc in active_processes.items():
+            kill_process_group(task_id, proc)
         active_processes.clear()
+        _close_channels()
+    metrics_receiver.stop()
+    METRICS_SNAPSHOT.unlink(missing_ok=True)
     print("✓ Agent server shutdown")
 
 
 class TaskRequest(BaseModel):
     task: str
+    profile: bool = False  # per-step memory / CPU profile, returned in /status
+    step_attempts: int = 1  # >1: best-of-K, concurrent attempts per parallel_safe step, the first validated one wins
+    limits: Optional[ResourceLimits] = None  # worker resource limits, at most the server defaults
+    deadline_seconds: Optional[float] = None  # must start within this many seconds, else it is shed
+    budget: Optional[TaskBudget] = None  # limits of a run; exhausted -> partial result
+    reuse: bool = True  # False: always run, never attach to an identical task or reuse its result
+    idempotency_key: Optional[str] = None  # or the Idempotency-Key header
 
 
 class TaskResponse(BaseModel):
     task_id: str
     status: str
     message: str
+    eta_seconds: Optional[float] = None  # estimated wait until a worker starts the task
 
 
 class TaskStatus(BaseModel):
     task_id: str
-    status: str  # "pending", "running", "completed", "failed"
+    status: str  # "pending", "running", "completed", "failed", "cancelled"
     result: Optional[str] = None
     error: Optional[str] = None
+    stopped: Optional[str] = None  # why the run ended early (budget exhausted, cancelled)
+    usage: Optional[dict] = None  # seconds, tokens and cost of the last run
+    failure_reason: Optional[str] = None  # resource limit the worker exceeded (memory_limit, disk_quota, ...)
+    rusage: Optional[dict] = None  # CPU, peak memory and I/O of the last worker (wait4)
+    profile: Optional[dict] = None
+    progress: Optional[dict] = None  # last progress event of the worker
+    partial_results: Optional[list[dict]] = None  # results of finished steps so far
+
+
+def read_task_profile(task_id: str) -> Optional[dict]:
+    """Profile summary written by a profiled worker (spool profile.json), None if there is none."""
+    import json
+
+    try:
+        with open(SPOOL_DIR / task_id / "profile.json", "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _estimate_wait(queue_depth: int) -> tuple[float, float]:
+    """Estimated wait of a task queued now behind `queue_depth` tasks, and the throughput (tasks/s) used.
+
+    Throughput is counted over the last THROUGHPUT_WINDOW seconds from the shared backend,
+    and capacity is MAX_CONCURRENT per node holding leases (at least this one), so both
+    cover all server processes. Idle nodes are not seen, which errs on the long side.
+    """
+    running = backend.running_by_node()
+    running.setdefault(NODE_ID, 0)
+    capacity = MAX_CONCURRENT * len(running)
+    window = min(THROUGHPUT_WINDOW, max(1.0, time.time() - server_started_at))
+    finished = backend.finished_since(time.time() - window)
+    if finished >= MIN_THROUGHPUT_SAMPLES:
+        rate = finished / window
+    else:
+        rate = capacity / DEFAULT_TASK_SECONDS
+    free = max(0, capacity - sum(running.values()))
+    ahead = max(0, queue_depth - free)  # the rest starts on free slots
+    return ahead / rate, rate
+
+
+def _reject(reason: str, retry_after: float, eta: float) -> JSONResponse:
+    print(f"⚠️ Task rejected: {reason}")
+    return JSONResponse(
+        status_code=429,
+        content=TaskResponse(task_id="", status="rejected", message=reason, eta_seconds=round(eta, 1)).model_dump(),
+        headers={"Retry-After": str(max(1, math.ceil(retry_after)))},
+    )
+
+
+def _dedup_keys(request: TaskRequest, idempotency_key: Optional[str]) -> list:
+    """Keys of a submission for backend.find: the idempotency key, then the content hash."""
+    import json
+
+    now = time.time()
+    keys = []
+    if idempotency_key:
+        keys.append((f"idempotency:{idempotency_key}",
+                     lambda info: now - info["queued_at_us"] / 1e6 <= IDEMPOTENCY_TTL))
+
+    # everything that changes how the task runs; whitespace inside the task can be significant
+    content = json.dumps({
+        "task": request.task.strip(),
+        "budget": request.budget.model_dump(exclude_none=True) if request.budget else None,
+        "limits": limits.effective(request.limits.model_dump() if request.limits else None),
+        "step_attempts": max(1, min(request.step_attempts, MAX_STEP_ATTEMPTS)),
+        "profile": request.profile,
+    }, sort_keys=True, ensure_ascii=False)
+
+    def _reusable(info):
+        if not request.reuse:
+            return False
+        if info["status"] in ("pending", "running"):
+            return not info.get("cancel_requested")  # winding down, its result will be partial
+        return (info["status"] == "completed" and not info.get("stopped")
+                and now - (info.get("finished_at") or 0) <= RESULT_REUSE_TTL)
+
+    keys.append((f"content:{hashlib.sha256(content.encode()).hexdigest()}", _reusable))
+    return keys
+
+
+def _existing_task(task_id: str, info: dict) -> TaskResponse:
+    in_flight = info["status"] in ("pending", "running")
+    DEDUP_HITS.inc(kind="attached" if in_flight else "reused")
+    print(f"✓ Submission answered by task {task_id[:8]} ({info['status']})")
+    return TaskResponse(
+        task_id=task_id,
+        status=info["status"],
+        message="Attached to an identical task in flight" if in_flight else "Result of an identical task reused",
+    )
 
 
 @app.post("/run", response_model=TaskResponse)
-async def run_task(request: TaskRequest):
+def run_task(request: TaskRequest, idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")):
+    # Duplicates cost nothing: answer them before admission control
+    keys = _dedup_keys(request, idempotency_key or request.idempotency_key)
+    found = backend.find(keys)
+    if found is not None:
+        return _existing_task(*found)
+
+    # Admission control: refuse work the queue cannot absorb instead of growing it without bound
+    depth = backend.queue_depth()
+    eta, rate = _estimate_wait(depth)
+    if depth >= MAX_QUEUE_DEPTH:
+        return _reject(f"Queue full ({depth} tasks waiting)", (depth - MAX_QUEUE_DEPTH + 1) / rate, eta)
+    if eta > MAX_QUEUE_WAIT:
+        return _reject(f"Estimated wait {eta:.0f}s exceeds {MAX_QUEUE_WAIT:.0f}s", eta - MAX_QUEUE_WAIT, eta)
+    if request.deadline_seconds is not None and eta > request.deadline_seconds:
+        return _reject(f"Estimated wait {eta:.0f}s exceeds the deadline", eta - request.deadline_seconds, eta)
+
     task_id = str(uuid.uuid4())
-    
-    with tasks_lock:
-        tasks_store[task_id] = {
+    queued_at_us = now_us()
+    # atomic with the lookup, so concurrent identical submissions create one task
+    task_id, task_info, created = backend.create_deduplicated(task_id, {
+            "task_id": task_id,
             "status": "pending",
             "task": request.task,
             "result": None,
             "error": None,
-        }
-    
-    # Enqueue for supervisor to start (synchronized)
-    with active_processes_lock:
-        pending_queue.append(task_id)
+            "profile": request.profile,
+            "step_attempts": max(1, min(request.step_attempts, MAX_STEP_ATTEMPTS)),
+            "limits": limits.effective(request.limits.model_dump() if request.limits else None),
+            "queued_at_us": queued_at_us,
+            "deadline_us": queued_at_us + int(request.deadline_seconds * 1e6) if request.deadline_seconds is not None else None,
+            "budget": request.budget.model_dump(exclude_none=True) if request.budget else None,
+    }, keys)
+    if not created:
+        return _existing_task(task_id, task_info)
+    QUEUE_DEPTH.inc()
     print(f"✓ Task {task_id[:8]} queued")
     
     return TaskResponse(
         task_id=task_id,
         status="pending",
-        message="Task submitted"
+        message="Task submitted",
+        eta_seconds=round(eta, 1),
     )
 
 
 @app.get("/status/{task_id}", response_model=TaskStatus)
-async def get_status(task_id: str):
-    with tasks_lock:
-        if task_id not in tasks_store:
-            return TaskStatus(task_id=task_id, status="not_found", error="Task not found")
-        task_info = tasks_store[task_id]
-        return TaskStatus(
-            task_id=task_id,
-            status=task_info["status"],
-            result=task_info.get("result"),
-            error=task_info.get("error")
-        )
+def get_status(task_id: str):
+    task_info = backend.get(task_id)
+    if task_info is None:
+        return TaskStatus(task_id=task_id, status="not_found", error="Task not found")
+    status = TaskStatus(
+        task_id=task_id,
+        status=task_info["status"],
+        result=task_info.get("result"),
+        error=task_info.get("error"),
+        progress=task_info.get("progress"),
+        partial_results=task_info.get("partial_results"),
+        stopped=task_info.get("stopped"),
+        usage=task_info.get("usage"),
+        failure_reason=task_info.get("failure_reason"),
+        rusage=task_info.get("rusage"),
+    )
+    if task_info.get("profile", False):
+        status.profile = read_task_profile(task_id)
+    return status
 
 
 @app.get("/health")
 async def health():
-    with tasks_lock:
-        running_count = len([t for t in tasks_store.values() if t["status"] == "running"])
-    
-    with active_processes_lock:
-        process_count = len(active_processes)
-        pending_count = len(pending_queue)
-    
+    # O(1): counts come from the metric gauges, not a scan of the task records
     return {
         "status": "ok",
-        "active_tasks": running_count,
-        "active_processes": process_count,
-        "pending": pending_count
+        "active_tasks": int(TASKS_RUNNING.get()),
+        "active_processes": len(active_processes),
+        "pending": int(QUEUE_DEPTH.get()),
     }
 
 
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus text exposition of server and worker-reported metrics, summed over the server processes."""
+    return PlainTextResponse(metrics.render(metrics.read_snapshots(METRICS_SNAPSHOT)),
+                             media_type="text/plain; version=0.0.4")
+
+
 @app.get("/tasks")
-async def list_tasks():
-    with tasks_lock:
-        return {
-            "tasks": [
-                {
-                    "task_id": tid,
-                    "status": info["status"],
-                    "task_preview": info["task"][:100] + "..." if len(info["task"]) > 100 else info["task"]
-                }
-                for tid, info in tasks_store.items()
-            ]
-        }
+def list_tasks():
+    return {
+        "tasks": [
+            {
+                "task_id": tid,
+                "status": info["status"],
+                "task_preview": info["task"][:100] + "..." if len(info["task"]) > 100 else info["task"]
+            }
+            for tid, info in backend.items()
+        ]
+    }
+
+
+@app.get("/tasks/{task_id}/logs")
+def task_logs(task_id: str, file: Optional[str] = None, offset: int = 0, length: int = LOG_READ_MAX_BYTES):
+    """Without `file`: list the task's log files. With `file`: read `length` bytes from `offset`."""
+    log_dir = LOGS_DIR / task_id
+    if not log_dir.is_dir() or log_dir.resolve().parent != LOGS_DIR.resolve():
+        return {"task_id": task_id, "status": "not_found", "message": "No logs for this task"}
+    if file is None:
+        return {"task_id": task_id, "files": list_log_files(log_dir)}
+    try:
+        data, size = read_log_range(log_dir, file, offset, length)
+    except (FileNotFoundError, ValueError) as e:
+        return {"task_id": task_id, "status": "not_found", "message": f"Log file not found: {e}"}
+    return {
+        "task_id": task_id,
+        "file": file,
+        "offset": offset,
+        "length": len(data),
+        "size": size,
+        "content": data.decode("utf-8", errors="replace"),
+    }
+
+
+@app.get("/tasks/{task_id}/trace")
+def task_trace(task_id: str):
+    """Task timeline in trace event format, open in Perfetto or chrome://tracing."""
+    task_spool = SPOOL_DIR / task_id
+    if not task_spool.is_dir() or task_spool.resolve().parent != SPOOL_DIR.resolve():
+        return {"task_id": task_id, "status": "not_found", "message": "No trace for this task"}
+    return JSONResponse(
+        load_trace(task_spool),
+        headers={"Content-Disposition": f'attachment; filename="trace_{task_id}.json"'},
+    )
+
+
+def _worker_pid(task_id: str) -> Optional[int]:
+    """PID of the task's running worker if it is on this host."""
+    with active_processes_lock:
+        proc = active_processes.get(task_id)
+    pid = proc.pid if proc is not None and proc.returncode is None else None  # reaped by the supervisor only
+    if pid is None:
+        # run by another server process: reachable if it is on this host
+        info = backend.get(task_id)
+        if info is not None and info["status"] == "running" and info.get("worker_pid") \
+                and (info.get("lease_owner") or "").rsplit(":", 1)[0] == socket.gethostname():
+            pid = info["worker_pid"]
+    return pid
+
+
+@app.get("/tasks/{task_id}/profile")
+async def task_profile(task_id: str, seconds: float = 5):
+    """Sample the stacks of a running task's worker and kernel, return collapsed stacks (flamegraph input)."""
+    import json
+
+    seconds = max(0.1, min(seconds, MAX_PROFILE_SECONDS))
+    pid = await asyncio.to_thread(_worker_pid, task_id)  # the backend and the process lock may block
+    if pid is None:
+        return {"task_id": task_id, "status": "not_running", "message": "Task has no running worker on this host"}
+
+    request_id = uuid.uuid4().hex
+    output_dir = SPOOL_DIR / task_id / "profiles"
+    request_path = SPOOL_DIR / task_id / PROFILE_REQUEST_FILE
+    tmp = request_path.with_name(request_path.name + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"id": request_id, "seconds": seconds, "output_dir": str(output_dir)}, f)
+    os.replace(tmp, request_path)
+    try:
+        os.kill(pid, signal.SIGUSR1)
+    except ProcessLookupError:
+        return {"task_id": task_id, "status": "not_running", "message": "Task has no running worker on this host"}
+
+    # the worker always answers; the kernel only if it is alive and gets to run its handler
+    deadline = time.monotonic() + seconds + 5
+    outputs = [output_dir / f"{request_id}.worker.folded", output_dir / f"{request_id}.kernel.folded"]
+    while time.monotonic() < deadline and not all(path.exists() for path in outputs):
+        await asyncio.sleep(0.2)
+    if not outputs[0].exists():
+        return {"task_id": task_id, "status": "failed", "message": "Worker did not return a profile"}
+
+    folded = "".join(path.read_text(encoding="utf-8") for path in outputs if path.exists())
+    return PlainTextResponse(
+        folded,
+        headers={"Content-Disposition": f'attachment; filename="profile_{task_id}_{request_id[:8]}.folded"'},
+    )
+
+
+@app.post("/resume/{task_id}", response_model=TaskResponse)
+def resume_task(task_id: str):
+    """Re-run a failed task from its last checkpointed step."""
+    import json
+
+    task_spool = SPOOL_DIR / task_id
+    if not (task_spool / "checkpoint" / "state.json").exists():
+        return TaskResponse(task_id=task_id, status="not_found", message="No checkpoint for this task")
+
+    if backend.get(task_id) is None:
+        # server was restarted (memory backend): recover the task from its spool
+        try:
+            with open(task_spool / "input.json", "r") as f:
+                data = json.load(f)
+        except Exception as e:
+            return TaskResponse(task_id=task_id, status="not_found", message=f"Cannot read task input: {e}")
+        backend.create(task_id, {"task_id": task_id, "status": "failed", "task": data["task"], "result": None,
+                                 "error": None, "profile": data.get("profile", False)})
+
+    requeued = []
+
+    def _requeue(info):
+        if info["status"] != "failed":
+            return False
+        info.update(status="pending", resume=True, queued_at_us=now_us(), error=None, attempts=0, deadline_us=None,
+                    cancel_requested=False, stopped=None)
+        requeued.append(task_id)
+
+    task_info = backend.mutate(task_id, _requeue)
+    if task_info is None:
+        return TaskResponse(task_id=task_id, status="not_found", message="Task not found")
+    if not requeued:
+        message = ("Task is still active" if task_info["status"] in ("pending", "running")
+                   else "Only failed tasks can be resumed")
+        return TaskResponse(task_id=task_id, status=task_info["status"], message=message)
+    QUEUE_DEPTH.inc()
+    print(f"✓ Task {task_id[:8]} queued for resume")
+
+    return TaskResponse(
+        task_id=task_id,
+        status="pending",
+        message="Task resumed from last checkpoint"
+    )
+
+
+@app.post("/cancel/{task_id}", response_model=TaskResponse)
+def cancel_task(task_id: str):
+    """Cancel one task: a pending task is dropped, a running one winds down and keeps its partial results."""
+    was = []
+
+    def _cancel(info):
+        was.append(info["status"])
+        if info["status"] == "pending":
+            info.update(status="cancelled", error="Cancelled before start")
+        elif info["status"] == "running":
+            info["cancel_requested"] = True
+        else:
+            return False
+
+    task_info = backend.mutate(task_id, _cancel)
+    if task_info is None:
+        return TaskResponse(task_id=task_id, status="not_found", message="Task not found")
+    if was[-1] == "pending":
+        print(f"✓ Task {task_id[:8]} cancelled before start")
+        return TaskResponse(task_id=task_id, status="cancelled", message="Task cancelled before start")
+    if was[-1] != "running":
+        return TaskResponse(task_id=task_id, status=task_info["status"], message="Task already finished")
+
+    with active_processes_lock:
+        proc = active_processes.get(task_id)
+        if proc is not None:
+            _stop_worker(task_id, proc, "cancelled")
+    message = ("Task is stopping, partial results follow in /status" if proc is not None
+               else "Cancellation requested from the server process running the task")
+    return TaskResponse(task_id=task_id, status="cancelling", message=message)
 
 
 @app.get("/reset")
-async def reset():
+def reset():
     killed_count = 0
     
-    # Clear task store
-    with tasks_lock:
-        cleared_count = len(tasks_store)
-        tasks_store.clear()
+    # Clear task records and the pending queue (of all nodes with a shared backend)
+    cleared_count, pending_count = backend.clear()
+    QUEUE_DEPTH.set(0)
     
-    # Clear pending queue and kill active processes (synchronized)
+    # Kill this process's workers (synchronized)
     with active_processes_lock:
-        pending_count = len(pending_queue)
-        pending_queue.clear()
         
         for task_id, proc in list(active_processes.items()):
             try:
-                kill_process_group(proc)
+                kill_process_group(task_id, proc)
                 killed_count += 1
                 print(f"✓ Killed {task_id[:8]}")
             except Exception as e:
                 print(f"✗ Kill failed {task_id[:8]}: {e}")
         active_processes.clear()
+        _close_channels()
+        TASKS_RUNNING.set(0)
     
-    # Clear main process globals
-    keys_to_remove = [k for k in PERSISTENT_GLOBALS.keys() if k != "__builtins__"]
-    for key in keys_to_remove:
-        del PERSISTENT_GLOBALS[key]
     gc.collect()
     
     return {
@@ -0,0 +1,534 @@
+"""
+Task queue and state shared by server processes.
+
+A backend stores the task records (the dicts `/status` reads) and the queue of pending
+tasks. Server processes take work with `lease`: the oldest pending task becomes "running",
+owned by the leasing node until `lease_expires`. Nodes renew the leases of the workers they
+run; when a node dies its leases expire and `requeue_expired` puts the tasks back in the
+queue (resumed from their checkpoint) on any other node.
+
+- "memory": process-local, one server process only (the previous behaviour).
+- "sqlite": one database file (WAL) on storage shared by all server processes and
+  containers, e.g. the spool volume. No outside services.
+
+Selected with AGENT_STATE_BACKEND, the database path with AGENT_STATE_DB.
+"""
+import copy
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from pathlib import Path
+from typing import Callable, Iterable
+
+STATE_BACKEND = os.environ.get("AGENT_STATE_BACKEND", "memory")
+STATE_DB = os.environ.get("AGENT_STATE_DB")  # default: <spool>/tasks.db
+LEASE_SECONDS = 60  # a task whose node did not renew its lease for this long is re-queued
+MAX_LEASE_ATTEMPTS = 3  # runs per task before an expired lease fails it
+
+NODE_ID = f"{socket.gethostname()}:{os.getpid()}"  # one server process
+
+
+class TaskBackend(ABC):
+    """Interface of the task stores. Records returned are copies."""
+
+    @abstractmethod
+    def create(self, task_id: str, record: dict) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def get(self, task_id: str) -> dict | None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def find(self, keys: list[tuple[str, Callable[[dict], bool]]]) -> tuple[str, dict] | None:
+        """The task last bound to one of `keys` (in order) whose record the key's predicate accepts."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def create_deduplicated(self, task_id: str, record: dict,
+                            keys: list[tuple[str, Callable[[dict], bool]]]) -> tuple[str, dict, bool]:
+        """Atomic `find` or `create`: (task_id, record, created). A created task is bound to all `keys`."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def mutate(self, task_id: str, fn: Callable[[dict], bool | None], owner: str | None = None) -> dict | None:
+        """Apply `fn` to a copy of the record and store it atomically; returns the new record.
+
+        `fn` returning False discards the edit (the record is returned unchanged). Returns None
+        when the task does not exist or, with `owner`, is no longer leased by that node.
+        A record that becomes "pending" enters the queue.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def lease(self, owner: str, lease_seconds: float = LEASE_SECONDS) -> dict | None:
+        """Take the oldest pending task: it becomes "running" and leased by `owner`."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def renew(self, owner: str, task_ids: Iterable[str], lease_seconds: float = LEASE_SECONDS) -> list[str]:
+        """Extend `owner`'s leases; returns the ids it no longer holds (expired and taken over, or finished)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def requeue_expired(self, max_attempts: int = MAX_LEASE_ATTEMPTS) -> tuple[list[str], list[str]]:
+        """Re-queue running tasks with an expired lease; returns (re-queued, failed) ids."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ids(self, statuses: Iterable[str] | None = None) -> list[str]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def items(self) -> list[tuple[str, dict]]:
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, task_ids: Iterable[str]) -> None:
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self) -> tuple[int, int]:
+        """Drop all tasks; returns (tasks, of which pending)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def queue_depth(self) -> int:
+        raise NotImplementedError
+
+    @abstractmethod
+    def running_by_node(self) -> dict[str, int]:
+        """Running (leased) tasks per owning node."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def finished_since(self, ts: float) -> int:
+        """Number of worker runs that ended after `ts` (throughput)."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def shed_expired(self) -> list[str]:
+        """Fail pending tasks whose start deadline has passed; returns their ids."""
+        raise NotImplementedError
+
+
+def _shed(record: dict) -> bool:
+    """Fail a pending task that can no longer start before its deadline."""
+    deadline = record.get("deadline_us")
+    if deadline is None or deadline > time.time_ns() // 1000:
+        return False
+    record["status"] = "failed"
+    record["error"] = "Shed: the task could not start before its deadline"
+    record["shed"] = True
+    return True
+
+
+def _take_lease(record: dict, owner: str, lease_seconds: float) -> None:
+    record["status"] = "running"
+    record["lease_owner"] = owner
+    record["lease_expires"] = time.time() + lease_seconds
+    record["attempts"] = record.get("attempts", 0) + 1
+
+
+def _expire_lease(record: dict, max_attempts: int) -> bool:
+    """Re-queue (True) or fail (False) a task whose node stopped renewing its lease."""
+    record["lease_owner"] = None
+    record["lease_expires"] = None
+    if record.get("attempts", 0) >= max_attempts:
+        record["status"] = "failed"
+        record["error"] = f"Lease expired {record.get('attempts', 0)} times (server node lost)"
+        return False
+    record["status"] = "pending"
+    record["resume"] = True  # continue from the checkpoint the lost worker left in the spool
+    record["deadline_us"] = None  # a start deadline, the task did start
+    record["queued_at_us"] = time.time_ns() // 1000
+    return True
+
+
+class MemoryBackend(TaskBackend):
+    def __init__(self):
+        self._tasks: dict[str, dict] = {}
+        self._queue: deque[str] = deque()  # may hold ids that are no longer pending, skipped by lease
+        self._pending = 0
+        self._finished: deque[float] = deque()  # finished_at of worker runs, oldest first
+        self._keys: dict[str, str] = {}  # dedup key -> task_id
+        self._lock = threading.Lock()
+
+    def _set(self, task_id: str, old: dict | None, new: dict) -> None:
+        was_pending = old is not None and old["status"] == "pending"
+        if new["status"] == "pending" and not was_pending:
+            self._queue.append(task_id)
+        self._pending += (new["status"] == "pending") - was_pending
+        if new.get("finished_at") and new.get("finished_at") != (old or {}).get("finished_at"):
+            self._finished.append(new["finished_at"])
+        self._tasks[task_id] = new
+
+    def create(self, task_id: str, record: dict) -> None:
+        with self._lock:
+            self._set(task_id, self._tasks.get(task_id), copy.deepcopy(record))
+
+    def get(self, task_id: str) -> dict | None:
+        with self._lock:
+            record = self._tasks.get(task_id)
+            return copy.deepcopy(record) if record is not None else None
+
+    def _find(self, keys):
+        for key, accept in keys:
+            task_id = self._keys.get(key)
+            record = self._tasks.get(task_id) if task_id else None
+            if record is not None and accept(record):
+                return task_id, copy.deepcopy(record)
+        return None
+
+    def find(self, keys):
+        with self._lock:
+            return self._find(keys)
+
+    def create_deduplicated(self, task_id, record, keys):
+        with self._lock:
+            found = self._find(keys)
+            if found is not None:
+                return (*found, False)
+            self._set(task_id, None, copy.deepcopy(record))
+            for key, _ in keys:
+                self._keys[key] = task_id
+            return task_id, copy.deepcopy(record), True
+
+    def mutate(self, task_id, fn, owner=None):
+        with self._lock:
+            old = self._tasks.get(task_id)
+            if old is None or (owner is not None and old.get("lease_owner") != owner):
+                return None
+            new = copy.deepcopy(old)
+            if fn(new) is False:
+                return copy.deepcopy(old)
+            self._set(task_id, old, new)
+            return copy.deepcopy(new)
+
+    def lease(self, owner, lease_seconds=LEASE_SECONDS):
+        with self._lock:
+            while self._queue:
+                task_id = self._queue.popleft()
+                old = self._tasks.get(task_id)
+                if old is None or old["status"] != "pending":
+                    continue
+                new = copy.deepcopy(old)
+                if _shed(new):
+                    self._set(task_id, old, new)
+                    continue
+                _take_lease(new, owner, lease_seconds)
+                self._set(task_id, old, new)
+                return copy.deepcopy(new)
+        return None
+
+    def renew(self, owner, task_ids, lease_seconds=LEASE_SECONDS):
+        expires = time.time() + lease_seconds
+        lost = []
+        with self._lock:
+            for task_id in task_ids:
+                record = self._tasks.get(task_id)
+                if record is not None and record["status"] == "running" and record.get("lease_owner") == owner:
+                    record["lease_expires"] = expires
+                else:
+                    lost.append(task_id)
+        return lost
+
+    def requeue_expired(self, max_attempts=MAX_LEASE_ATTEMPTS):
+        requeued, failed = [], []
+        now = time.time()
+        with self._lock:
+            for task_id, old in list(self._tasks.items()):
+                if old["status"] != "running" or (old.get("lease_expires") or now) >= now:
+                    continue
+                new = copy.deepcopy(old)
+                (requeued if _expire_lease(new, max_attempts) else failed).append(task_id)
+                self._set(task_id, old, new)
+        return requeued, failed
+
+    def ids(self, statuses=None):
+        with self._lock:
+            return [tid for tid, record in self._tasks.items() if statuses is None or record["status"] in statuses]
+
+    def items(self):
+        with self._lock:
+            return [(tid, copy.deepcopy(record)) for tid, record in self._tasks.items()]
+
+    def delete(self, task_ids):
+        with self._lock:
+            task_ids = set(task_ids)
+            for task_id in task_ids:
+                record = self._tasks.pop(task_id, None)
+                if record is not None and record["status"] == "pending":
+                    self._pending -= 1
+            for key in [key for key, task_id in self._keys.items() if task_id in task_ids]:
+                del self._keys[key]
+
+    def clear(self):
+        with self._lock:
+            counts = (len(self._tasks), self._pending)
+            self._tasks.clear()
+            self._queue.clear()
+            self._keys.clear()
+            self._pending = 0
+            return counts
+
+    def queue_depth(self):
+        return self._pending
+
+    def running_by_node(self):
+        with self._lock:
+            counts: dict[str, int] = {}
+            for record in self._tasks.values():
+                if record["status"] == "running" and record.get("lease_owner"):
+                    counts[record["lease_owner"]] = counts.get(record["lease_owner"], 0) + 1
+            return counts
+
+    def finished_since(self, ts):
+        with self._lock:
+            while self._finished and self._finished[0] < ts - 24 * 3600:
+                self._finished.popleft()  # older than any useful window
+            return sum(1 for finished_at in reversed(self._finished) if finished_at >= ts)
+
+    def shed_expired(self):
+        shed = []
+        with self._lock:
+            for task_id in list(self._queue):
+                old = self._tasks.get(task_id)
+                if old is None or old["status"] != "pending":
+                    continue
+                new = copy.deepcopy(old)
+                if _shed(new):
+                    self._set(task_id, old, new)
+                    shed.append(task_id)
+        return shed
+
+
+class SqliteBackend(TaskBackend):
+    """Records as JSON in one table; status, queue order and lease are columns for the queries.
+
+    Writes run in BEGIN IMMEDIATE transactions, so a lease is taken by exactly one process.
+    One connection per thread.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            " task_id TEXT PRIMARY KEY, status TEXT NOT NULL, queued_at INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT, lease_expires REAL, finished_at REAL, data TEXT NOT NULL)"
+        )
+        try:
+            conn.execute("ALTER TABLE tasks ADD COLUMN finished_at REAL")  # databases of older versions
+        except sqlite3.OperationalError:
+            pass
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_queue ON tasks (status, queued_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS tasks_finished ON tasks (finished_at)")
+        conn.execute("CREATE TABLE IF NOT EXISTS task_keys (key TEXT PRIMARY KEY, task_id TEXT NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA busy_timeout=30000")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _write(self, conn: sqlite3.Connection, task_id: str, record: dict) -> None:
+        conn.execute(
+            "INSERT OR REPLACE INTO tasks (task_id, status, queued_at, lease_owner, lease_expires, finished_at, data)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (task_id, record["status"], record.get("queued_at_us") or 0, record.get("lease_owner"),
+             record.get("lease_expires"), record.get("finished_at"), json.dumps(record, ensure_ascii=False)),
+        )
+
+    def _transaction(self, fn):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        return result
+
+    def create(self, task_id, record):
+        self._transaction(lambda conn: self._write(conn, task_id, record))
+
+    @staticmethod
+    def _load(row) -> dict:
+        record = json.loads(row[0])
+        record["lease_expires"] = row[1]  # renewed in the column only
+        return record
+
+    def get(self, task_id):
+        row = self._conn().execute("SELECT data, lease_expires FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+        return self._load(row) if row else None
+
+    def _find(self, conn, keys):
+        for key, accept in keys:
+            row = conn.execute(
+                "SELECT t.task_id, t.data, t.lease_expires FROM task_keys k JOIN tasks t ON t.task_id = k.task_id"
+                " WHERE k.key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                record = self._load(row[1:])
+                if accept(record):
+                    return row[0], record
+        return None
+
+    def find(self, keys):
+        return self._find(self._conn(), keys)
+
+    def create_deduplicated(self, task_id, record, keys):
+        def _create(conn):
+            found = self._find(conn, keys)
+            if found is not None:
+                return (*found, False)
+            self._write(conn, task_id, record)
+            conn.executemany("INSERT OR REPLACE INTO task_keys (key, task_id) VALUES (?, ?)",
+                             [(key, task_id) for key, _ in keys])
+            return task_id, record, True
+
+        return self._transaction(_create)
+
+    def mutate(self, task_id, fn, owner=None):
+        def _mutate(conn):
+            row = conn.execute("SELECT data, lease_expires FROM tasks WHERE task_id = ?", (task_id,)).fetchone()
+            if row is None:
+                return None
+            record = self._load(row)
+            if owner is not None and record.get("lease_owner") != owner:
+                return None
+            if fn(record) is False:
+                return self._load(row)
+            self._write(conn, task_id, record)
+            return record
+
+        return self._transaction(_mutate)
+
+    def lease(self, owner, lease_seconds=LEASE_SECONDS):
+        def _lease(conn):
+            while True:
+                row = conn.execute(
+                    "SELECT task_id, data FROM tasks WHERE status = 'pending' ORDER BY queued_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                record = json.loads(row[1])
+                if _shed(record):
+                    self._write(conn, row[0], record)
+                    continue
+                _take_lease(record, owner, lease_seconds)
+                self._write(conn, row[0], record)
+                return record
+
+        return self._transaction(_lease)
+
+    def renew(self, owner, task_ids, lease_seconds=LEASE_SECONDS):
+        task_ids = list(task_ids)
+        if not task_ids:
+            return []
+        expires = time.time() + lease_seconds
+
+        def _renew(conn):
+            # the column is authoritative for expiry, see _load
+            return [
+                task_id for task_id in task_ids
+                if conn.execute(
+                    "UPDATE tasks SET lease_expires = ? WHERE task_id = ? AND lease_owner = ? AND status = 'running'",
+                    (expires, task_id, owner),
+                ).rowcount == 0
+            ]
+
+        return self._transaction(_renew)
+
+    def requeue_expired(self, max_attempts=MAX_LEASE_ATTEMPTS):
+        def _requeue(conn):
+            requeued, failed = [], []
+            rows = conn.execute(
+                "SELECT task_id, data FROM tasks WHERE status = 'running' AND lease_expires < ?", (time.time(),)
+            ).fetchall()
+            for task_id, data in rows:
+                record = json.loads(data)
+                (requeued if _expire_lease(record, max_attempts) else failed).append(task_id)
+                self._write(conn, task_id, record)
+            return requeued, failed
+
+        return self._transaction(_requeue)
+
+    def ids(self, statuses=None):
+        if statuses is None:
+            rows = self._conn().execute("SELECT task_id FROM tasks").fetchall()
+        else:
+            statuses = list(statuses)
+            rows = self._conn().execute(
+                f"SELECT task_id FROM tasks WHERE status IN ({','.join('?' * len(statuses))})", statuses
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def items(self):
+        rows = self._conn().execute("SELECT task_id, data, lease_expires FROM tasks").fetchall()
+        return [(row[0], self._load(row[1:])) for row in rows]
+
+    def delete(self, task_ids):
+        task_ids = list(task_ids)
+        def _delete(conn):
+            conn.executemany("DELETE FROM tasks WHERE task_id = ?", [(t,) for t in task_ids])
+            conn.executemany("DELETE FROM task_keys WHERE task_id = ?", [(t,) for t in task_ids])
+
+        self._transaction(_delete)
+
+    def clear(self):
+        def _clear(conn):
+            counts = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(status = 'pending'), 0) FROM tasks"
+            ).fetchone()
+            conn.execute("DELETE FROM tasks")
+            conn.execute("DELETE FROM task_keys")
+            return counts
+
+        return tuple(self._transaction(_clear))
+
+    def queue_depth(self):
+        return self._conn().execute("SELECT COUNT(*) FROM tasks WHERE status = 'pending'").fetchone()[0]
+
+    def running_by_node(self):
+        return dict(self._conn().execute(
+            "SELECT lease_owner, COUNT(*) FROM tasks WHERE status = 'running' AND lease_owner IS NOT NULL"
+            " GROUP BY lease_owner"
+        ).fetchall())
+
+    def finished_since(self, ts):
+        return self._conn().execute("SELECT COUNT(*) FROM tasks WHERE finished_at >= ?", (ts,)).fetchone()[0]
+
+    def shed_expired(self):
+        def _shed_pending(conn):
+            shed = []
+            # the queue is bounded by admission control, so scanning it is cheap
+            for task_id, data in conn.execute("SELECT task_id, data FROM tasks WHERE status = 'pending'").fetchall():
+                record = json.loads(data)
+                if _shed(record):
+                    self._write(conn, task_id, record)
+                    shed.append(task_id)
+            return shed
+
+        return self._transaction(_shed_pending)
+
+
+def make_backend(default_db: Path) -> TaskBackend:
+    if STATE_BACKEND == "sqlite":
+        return SqliteBackend(Path(STATE_DB) if STATE_DB else default_db)
+    if STATE_BACKEND != "memory":
+        print(f"⚠️ Unknown AGENT_STATE_BACKEND {STATE_BACKEND!r}, using memory")
+    return MemoryBackend()
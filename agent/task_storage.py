@@ -0,0 +1,209 @@
+"""
+Task data on disk: compressed logs with random access, and retention.
+
+Finished task logs are compressed file by file into `<file>.gz`, written as a series of
+independent gzip members of LOG_CHUNK_SIZE uncompressed bytes each. `index.json` in the
+log directory keeps, per file, the uncompressed size and where every member starts, so
+a byte range is served by decompressing only the members it touches. A resumed task
+appends to the plain file again; it reads as the continuation of the compressed part
+and is appended as new members on the next compression.
+
+Retention keeps spool, work and log data of all tasks under RETENTION_MAX_BYTES by
+deleting whole finished tasks, oldest first.
+"""
+import gzip
+import json
+import os
+import shutil
+import zlib
+from contextlib import nullcontext
+from pathlib import Path
+
+LOG_CHUNK_SIZE = 1024 * 1024  # uncompressed bytes per gzip member
+LOG_READ_MAX_BYTES = 1024 * 1024  # largest range served by one read
+INDEX_FILE = "index.json"
+
+RETENTION_MAX_BYTES = 20 * 1024 ** 3  # spool + work + logs of all tasks
+RETENTION_INTERVAL = 600  # seconds between retention passes
+
+
+def _load_index(log_dir: Path) -> dict:
+    try:
+        with (log_dir / INDEX_FILE).open("r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}}
+
+
+def _save_index(log_dir: Path, index: dict) -> None:
+    tmp = log_dir / (INDEX_FILE + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        json.dump(index, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, log_dir / INDEX_FILE)
+
+
+def _compress_file(source: Path, target: Path, entry: dict) -> None:
+    """Append `source` to `target` as gzip members, recording them in `entry`."""
+    chunks = entry.setdefault("chunks", [])  # [uncompressed offset, compressed offset]
+    size = entry.get("size", 0)
+    compressed_size = entry.get("compressed_size", 0)
+    with source.open("rb") as src, target.open("ab") as dst:
+        while True:
+            data = src.read(LOG_CHUNK_SIZE)
+            if not data:
+                break
+            member = gzip.compress(data, compresslevel=6)
+            dst.write(member)
+            chunks.append([size, compressed_size])
+            size += len(data)
+            compressed_size += len(member)
+        dst.flush()
+        os.fsync(dst.fileno())
+    entry["size"] = size
+    entry["compressed_size"] = compressed_size
+
+
+def compress_task_logs(log_dir: Path) -> int:
+    """Compress the plain files of a task log directory, returns bytes saved."""
+    log_dir = Path(log_dir)
+    if not log_dir.is_dir():
+        return 0
+    index = _load_index(log_dir)
+    saved = 0
+    for path in sorted(log_dir.rglob("*")):
+        if not path.is_file() or path.suffix in (".gz", ".tmp") or path.name == INDEX_FILE:
+            continue
+        rel = path.relative_to(log_dir).as_posix()
+        entry = index["files"].setdefault(rel, {})
+        before = entry.get("compressed_size", 0)
+        plain_size = path.stat().st_size
+        _compress_file(path, path.with_name(path.name + ".gz"), entry)
+        # index first: a crash in between leaves data counted in both places, never lost
+        _save_index(log_dir, index)
+        path.unlink()
+        saved += plain_size - (entry["compressed_size"] - before)
+    return saved
+
+
+def _resolve(log_dir: Path, rel: str) -> Path:
+    path = (log_dir / rel).resolve()
+    if log_dir.resolve() not in path.parents:
+        raise ValueError(f"Invalid log file: {rel}")
+    return path
+
+
+def list_log_files(log_dir: Path) -> dict[str, dict]:
+    """{relative path: {"size", "compressed_size"}} of a task log directory."""
+    log_dir = Path(log_dir)
+    files = {
+        rel: {"size": entry["size"], "compressed_size": entry["compressed_size"]}
+        for rel, entry in _load_index(log_dir).get("files", {}).items()
+    }
+    if log_dir.is_dir():
+        for path in log_dir.rglob("*"):
+            if not path.is_file() or path.suffix in (".gz", ".tmp") or path.name == INDEX_FILE:
+                continue
+            rel = path.relative_to(log_dir).as_posix()
+            info = files.setdefault(rel, {"size": 0, "compressed_size": 0})
+            info["size"] += path.stat().st_size  # plain tail of a resumed task
+    return dict(sorted(files.items()))
+
+
+def read_log_range(log_dir: Path, rel: str, offset: int = 0, length: int = LOG_READ_MAX_BYTES) -> tuple[bytes, int]:
+    """`length` bytes of a log file from `offset`, and the file's total size.
+
+    Raises FileNotFoundError for unknown files, ValueError for paths outside `log_dir`.
+    """
+    log_dir = Path(log_dir)
+    plain = _resolve(log_dir, rel)
+    entry = _load_index(log_dir).get("files", {}).get(rel)
+    packed_size = entry["size"] if entry else 0  # uncompressed bytes stored in the .gz
+    plain_size = plain.stat().st_size if plain.is_file() else 0
+    if entry is None and not plain.is_file():
+        raise FileNotFoundError(rel)
+
+    total = packed_size + plain_size
+    offset = max(0, min(offset, total))
+    end = min(total, offset + max(0, min(length, LOG_READ_MAX_BYTES)))
+    parts = []
+
+    if offset < packed_size:
+        chunks = entry["chunks"]
+        with plain.with_name(plain.name + ".gz").open("rb") as f:
+            for i, (chunk_start, compressed_start) in enumerate(chunks):
+                chunk_end = chunks[i + 1][0] if i + 1 < len(chunks) else packed_size
+                if chunk_end <= offset:
+                    continue
+                if chunk_start >= end:
+                    break
+                compressed_end = chunks[i + 1][1] if i + 1 < len(chunks) else entry["compressed_size"]
+                f.seek(compressed_start)
+                data = zlib.decompressobj(wbits=31).decompress(f.read(compressed_end - compressed_start))
+                parts.append(data[max(0, offset - chunk_start): end - chunk_start])
+
+    if end > packed_size:
+        with plain.open("rb") as f:
+            f.seek(max(0, offset - packed_size))
+            parts.append(f.read(end - max(offset, packed_size)))
+
+    return b"".join(parts), total
+
+
+def dir_size(path: Path) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def enforce_retention(roots: list[Path], protected: set[str], sizes: dict[str, int],
+                      max_bytes: int = RETENTION_MAX_BYTES, lock=nullcontext,
+                      is_active=lambda task_id: False) -> list[str]:
+    """Delete whole tasks (their entry under every root), oldest first, until under `max_bytes`.
+
+    `protected` task ids (pending / running) are never deleted. `sizes` caches the size of
+    finished tasks between passes (the caller drops an entry when a task finishes again).
+    The size walk runs unlocked; each deletion holds `lock()` and skips a task that
+    `is_active` again since `protected` was taken. Returns the deleted task ids.
+    """
+    tasks: dict[str, float] = {}  # task id -> last modification
+    for root in roots:
+        if not root.is_dir():
+            continue
+        for entry in os.scandir(root):
+            if entry.is_dir(follow_symlinks=False):
+                tasks[entry.name] = max(tasks.get(entry.name, 0.0), entry.stat(follow_symlinks=False).st_mtime)
+
+    for task_id in list(sizes):
+        if task_id not in tasks:
+            del sizes[task_id]  # removed by someone else
+
+    total = 0
+    for task_id in tasks:
+        if task_id in protected or task_id not in sizes:
+            size = sum(dir_size(root / task_id) for root in roots if (root / task_id).is_dir())
+            if task_id in protected:
+                sizes.pop(task_id, None)  # runs again, its size changes
+                total += size
+                continue
+            sizes[task_id] = size
+        total += sizes[task_id]
+
+    deleted = []
+    for task_id in sorted(tasks, key=tasks.get):
+        if total <= max_bytes:
+            break
+        if task_id in protected:
+            continue
+        with lock():
+            if is_active(task_id):
+                continue
+            for root in roots:
+                shutil.rmtree(root / task_id, ignore_errors=True)
+        total -= sizes.pop(task_id, 0)
+        deleted.append(task_id)
+    return deleted
@@ -0,0 +1,100 @@
+"""
+Task timeline in Chrome trace event format (Perfetto, chrome://tracing).
+
+Server and worker append complete ("X") events as JSON lines to their own file in the
+task spool (`trace.server.jsonl`, `trace.worker.jsonl`); `load_trace` merges them into
+one trace. Timestamps are wall-clock microseconds so both processes share a timeline.
+Without a trace file `span` is a no-op.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+SERVER_TRACE_FILE = "trace.server.jsonl"
+WORKER_TRACE_FILE = "trace.worker.jsonl"
+
+_trace_file = None
+_trace_lock = threading.Lock()
+
+
+def now_us() -> int:
+    return time.time_ns() // 1000
+
+
+def open_trace(path: Path, process_name: str) -> None:
+    """Start writing this process's events to `path` (appends, a resumed task keeps its history)."""
+    global _trace_file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.close()
+        _trace_file = path.open("a", encoding="utf-8", buffering=1)
+    write_event({"name": "process_name", "ph": "M", "pid": os.getpid(), "args": {"name": process_name}})
+
+
+def write_event(event: dict) -> None:
+    if _trace_file is None:
+        return
+    line = json.dumps(event, ensure_ascii=False, default=str) + "\n"
+    with _trace_lock:
+        if _trace_file is not None:
+            _trace_file.write(line)
+
+
+def complete_event(name: str, cat: str, start_us: int, end_us: int, **args) -> dict:
+    return {
+        "name": name, "cat": cat, "ph": "X",
+        "ts": start_us, "dur": max(0, end_us - start_us),
+        "pid": os.getpid(), "tid": threading.get_native_id(),
+        "args": args,
+    }
+
+
+@contextmanager
+def span(name: str, cat: str, **args):
+    """Record the enclosed block as one complete event; yields `args` so results can be added."""
+    if _trace_file is None:
+        yield args
+        return
+    start = now_us()
+    try:
+        yield args
+    finally:
+        write_event(complete_event(name, cat, start, now_us(), **args))
+
+
+def span_per_iteration(name: str, cat: str, count: int, **args):
+    """range(count) where every iteration of the consuming loop is recorded as a span.
+
+    `continue`, `break` and `return` inside the loop all end the current span.
+    """
+    for i in range(count):
+        with span(name, cat, iteration=i, **args):
+            yield i
+
+
+def append_events(path: Path, events: list[dict]) -> None:
+    """Append events to a trace file without opening it as this process's trace (server side)."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("a", encoding="utf-8") as f:
+        f.write("".join(json.dumps(event, ensure_ascii=False, default=str) + "\n" for event in events))
+
+
+def load_trace(task_spool: Path) -> dict:
+    """Merged trace of a task: {"traceEvents": [...]}."""
+    events = []
+    for name in (SERVER_TRACE_FILE, WORKER_TRACE_FILE):
+        path = task_spool / name
+        if not path.exists():
+            continue
+        with path.open("r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    events.append(json.loads(line))
+                except ValueError:
+                    continue  # line torn by a killed worker
+    events.sort(key=lambda event: event.get("ts", 0))
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
@@ -1,18 +1,26 @@
 import os
 import json
 import ast
+import time
+from contextlib import contextmanager
 from typing import Literal, List
 from openai import OpenAI
 from pydantic import BaseModel
 from dotenv import load_dotenv
 
+from .trace import span
+from . import budget, ipc, metrics
+
 load_dotenv()
 
 LLM_MODEL_PLAN = "openai/gpt-4.1"
 LLM_MODEL_DECISION = "openai/gpt-4.1"
 LLM_MODEL_REPLAN = "openai/gpt-4.1"
+LLM_MODEL_SUMMARY = "openai/gpt-4.1"
 
 LLM_MODEL_AGENT = "openai/gpt-oss-120b"
+LLM_MODEL_AGENT_FAST = "openai/gpt-oss-20b"  # first tier of the agent turn cascade (routing.py)
+LLM_CALL_MAX_SECONDS = 3 * 600 + 60  # client timeout (600s) times tries (3), heartbeats go on meanwhile
 
 # "openai/gpt-4.1"
 # "moonshotai/kimi-k2-thinking"
@@ -23,65 +31,114 @@ LLM_MODEL_AGENT = "openai/gpt-oss-120b"
 # "google/gemini-3-flash-preview"
 
 
-def llm_structured(prompt: str, response_model: type[BaseModel], model: str | None = None) -> BaseModel:
+def llm_structured(prompt: str, response_model: type[BaseModel], model: str | None = None, role: str = "plan") -> BaseModel:
     client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY"))
     schema = response_model.model_json_schema()
     req = json.dumps(schema, ensure_ascii=False)
     full = f"{prompt}\n\nReturn only JSON matching this: {req}"
-    resp = client.chat.completions.create(
-        model=model or LLM_MODEL_PLAN,
-        messages=[{"role": "user", "content": full}],
-        temperature=0,
-        response_format={
-            "type": "json_schema",
-            "json_schema": {
-                "name": "response_schema",
-                "strict": False,
-                "schema": schema
-            }
-        },
-        max_tokens=5_000,
-    )
+    with span("llm_structured", "llm", model=model or LLM_MODEL_PLAN, response_model=response_model.__name__) as args, \
+            _llm_metrics(model or LLM_MODEL_PLAN, role) as usage, ipc.bounded(LLM_CALL_MAX_SECONDS):
+        resp = client.chat.completions.create(
+            model=model or LLM_MODEL_PLAN,
+            messages=[{"role": "user", "content": full}],
+            temperature=0,
+            response_format={
+                "type": "json_schema",
+                "json_schema": {
+                    "name": "response_schema",
+                    "strict": False,
+                    "schema": schema
+                }
+            },
+            max_tokens=5_000,
+            extra_body={"usage": {"include": True}},  # OpenRouter reports the cost of the call
+        )
+        args["usage"] = usage["usage"] = _usage(resp)
     content = resp.choices[0].message.content
     return response_model.model_validate_json(content)
 
 
+def _usage(resp) -> dict | None:
+    usage = getattr(resp, "usage", None)
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "cost": getattr(usage, "cost", None),
+    }
+
 
-def llm(messages: list, model: str | None = None) -> tuple[str, str]:
+@contextmanager
+def _llm_metrics(model: str, role: str):
+    """Report latency, token usage (set `usage` in the yielded dict) and failures of an LLM call."""
+    state = {"usage": None}
+    start = time.monotonic()
+    try:
+        yield state
+    except Exception:
+        metrics.report("agent_llm_errors_total", "inc", model=model, role=role)
+        raise
+    metrics.report("agent_llm_call_seconds", "observe", time.monotonic() - start, model=model, role=role)
+    usage = state["usage"] or {}
+    for kind in ("prompt", "completion"):
+        metrics.report("agent_llm_tokens_total", "inc", usage.get(f"{kind}_tokens") or 0, model=model, role=role, kind=kind)
+    budget.record_usage((usage.get("prompt_tokens") or 0) + (usage.get("completion_tokens") or 0), usage.get("cost"))
+
+
+
+def llm(messages: list, model: str | None = None, role: str = "agent", temperature: float = 0,
+        reasoning_effort: str = "xhigh") -> tuple[str, str]:
     client = OpenAI(base_url="https://openrouter.ai/api/v1", api_key=os.getenv("OPENROUTER_API_KEY"))
     
-    resp = client.chat.completions.create(
-        model=model or LLM_MODEL_AGENT,
-        messages=messages,
-        temperature=0,
-        max_tokens=10_000,
-        # stop=['```\n'],
-        extra_body={
-            "reasoning": {
-                "effort": "xhigh",  #  "minimal", "low", "medium", "high", "xhigh"
-                "provider": {
-                    "ignore": ["Parasail"],
-                    "sort": "throughput",  # latency
-                },
+    with span("llm", "llm", model=model or LLM_MODEL_AGENT, effort=reasoning_effort, messages=len(messages)) as args, \
+            _llm_metrics(model or LLM_MODEL_AGENT, role) as usage, ipc.bounded(LLM_CALL_MAX_SECONDS):
+        resp = client.chat.completions.create(
+            model=model or LLM_MODEL_AGENT,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=10_000,
+            # stop=['```\n'],
+            extra_body={
+                "usage": {"include": True},
+                "reasoning": {
+                    "effort": reasoning_effort,  #  "minimal", "low", "medium", "high", "xhigh"
+                    "provider": {
+                        "ignore": ["Parasail"],
+                        "sort": "throughput",  # latency
+                    },
+                }
             }
-        }
-    )
+        )
+        args["usage"] = usage["usage"] = _usage(resp)
     
     message = resp.choices[0].message
     content = message.content
 
-    # Keep only first code block (bash/python) if present, otherwise keep all text
-    # first_block_start = content.find("```")
-    # if first_block_start != -1:
-    #     first_block_end = content.find("```", first_block_start + 3)
-    #     if first_block_end != -1:
-    #         content = content[:first_block_end + 3]
+    blocks = parse_response_blocks(content)
+
+    reasoning = ''
+    reasoning_details = getattr(message, 'reasoning_details', None)
+    if reasoning_details:
+        reasoning_parts = []
+        for detail in reasoning_details:
+            if detail.get('type') == 'reasoning.text':
+                reasoning_parts.append(detail.get('text', ''))
+            elif detail.get('type') == 'reasoning.summary':
+                reasoning_parts.append(detail.get('summary', ''))
+        reasoning = '\n\n'.join(reasoning_parts)
+    
+    return content, blocks, reasoning.strip()
+
+
+class ResponseBlock(BaseModel):
+    block_id: int
+    block_type: Literal["python", "bash", "text"]
+    block_text: str
 
-    class ResponseBlock(BaseModel):
-        block_id: int
-        block_type: Literal["python", "bash", "text"]
-        block_text: str
 
+def parse_response_blocks(content: str) -> list[ResponseBlock]:
+    """Split a model response into ordered text / python / bash blocks (fence markers removed)."""
     blocks: list[ResponseBlock] = []
 
     # Parse content into ordered blocks, removing ``` fences but preserving sequence.
@@ -127,18 +184,7 @@ def llm(messages: list, model: str | None = None) -> tuple[str, str]:
         blocks.append(ResponseBlock(block_id=block_idx, block_type=block_type, block_text=code_part))
         block_idx += 1
 
-    reasoning = ''
-    reasoning_details = getattr(message, 'reasoning_details', None)
-    if reasoning_details:
-        reasoning_parts = []
-        for detail in reasoning_details:
-            if detail.get('type') == 'reasoning.text':
-                reasoning_parts.append(detail.get('text', ''))
-            elif detail.get('type') == 'reasoning.summary':
-                reasoning_parts.append(detail.get('summary', ''))
-        reasoning = '\n\n'.join(reasoning_parts)
-    
-    return content, blocks, reasoning.strip()
+    return blocks
 
 
 def check_assigned_variables(code: str) -> bool:
@@ -0,0 +1,228 @@
+"""
+Output variable validation.
+
+Dtype strings from the plan (`list[tuple[int, str]]`, `pandas.DataFrame` ...) are compiled once into
+checker functions. Containers are checked on a bounded sample of elements and up to a fixed depth,
+so validating a multi-million element output costs about the same as validating a small one.
+Runs in the kernel process (see `check_output_variables`).
+"""
+import builtins
+import itertools
+import types
+import typing
+from collections.abc import Mapping, Sequence
+from functools import lru_cache
+
+from typeguard import check_type
+
+from .executor import PERSISTENT_GLOBALS
+
+VALIDATION_SAMPLE_SIZE = 64  # elements checked per container (half from the head, half from the tail)
+VALIDATION_MAX_DEPTH = 4  # nested containers deeper than this are only checked for their own type
+
+# module names the plan may spell out in full while the agent imported them under an alias
+_MODULE_ALIASES = {"pandas": "pd", "numpy": "np"}
+# typing names a dtype string may use without importing them: the public aliases and special
+# forms (List, Optional, Any ...), not modules typing happens to import (collections, re, sys)
+_TYPING_NAMES = frozenset(
+    name for name in typing.__all__
+    if name[0].isupper() and not isinstance(getattr(typing, name, None), types.FunctionType)
+)
+
+
+class DtypeMismatch(Exception):
+    pass
+
+
+class _DtypeScope(Mapping):
+    """Read-only view used to resolve names in a dtype string, no copy of the namespace."""
+
+    def __init__(self, namespace: dict):
+        self.namespace = namespace
+
+    def __getitem__(self, name):
+        if name in self.namespace:
+            return self.namespace[name]
+        alias = _MODULE_ALIASES.get(name)
+        if alias and alias in self.namespace:
+            return self.namespace[alias]
+        if name == "typing":
+            return typing
+        if name in _TYPING_NAMES:
+            return getattr(typing, name)
+        raise KeyError(name)
+
+    def __iter__(self):
+        return iter(self.namespace)
+
+    def __len__(self):
+        return len(self.namespace)
+
+
+@lru_cache(maxsize=None)
+def _compile_expression(dtype_str: str) -> types.CodeType:
+    return compile(dtype_str, "<dtype>", "eval")
+
+
+_checker_cache: dict = {}
+
+
+def compile_dtype(dtype_str: str, namespace: dict):
+    """Checker function for `dtype_str`, cached per dtype string and the objects its names resolve to."""
+    code = _compile_expression(dtype_str)
+    scope = _DtypeScope(namespace)
+    resolved = []
+    for name in code.co_names:
+        try:
+            resolved.append(id(scope[name]))
+        except KeyError:
+            resolved.append(None)
+    key = (dtype_str, tuple(resolved))
+    checker = _checker_cache.get(key)
+    if checker is None:
+        dtype = eval(code, {"__builtins__": builtins}, scope)
+        checker = _build_checker(dtype, depth=0)
+        _checker_cache[key] = checker
+    return checker
+
+
+def _sample(seq, size: int):
+    """(index, element) pairs from the head and the tail of a sized sequence."""
+    n = len(seq)
+    if n <= size:
+        return enumerate(seq)
+    half = size // 2
+    return itertools.chain(
+        ((i, seq[i]) for i in range(half)),
+        ((i, seq[i]) for i in range(n - half, n)),
+    )
+
+
+def _build_checker(dtype, depth: int):
+    if dtype is typing.Any or dtype is object:
+        return lambda value, path: None
+
+    origin = typing.get_origin(dtype)
+    args = typing.get_args(dtype)
+
+    if origin is typing.Union or origin is types.UnionType:
+        options = [_build_checker(arg, depth) for arg in args]
+
+        def check_union(value, path):
+            for option in options:
+                try:
+                    option(value, path)
+                    return
+                except DtypeMismatch:
+                    continue
+            raise DtypeMismatch(f"{path} is {type(value).__name__}, expected {dtype}")
+        return check_union
+
+    if origin is typing.Literal:
+        def check_literal(value, path):
+            if value not in args:
+                raise DtypeMismatch(f"{path} is {value!r}, expected one of {args}")
+        return check_literal
+
+    if origin is None:
+        if isinstance(dtype, type):
+            return _instance_checker(dtype)
+        # anything exotic (Callable, TypeVar, third-party generics ...) goes to typeguard
+        def check_fallback(value, path):
+            try:
+                check_type(value, dtype)
+            except Exception as e:
+                raise DtypeMismatch(f"{path}: {e}")
+        return check_fallback
+
+    check_container = _instance_checker(origin)
+    too_deep = depth >= VALIDATION_MAX_DEPTH
+
+    if origin is tuple:
+        if len(args) == 2 and args[1] is Ellipsis:
+            item = _build_checker(args[0], depth + 1)
+
+            def check_var_tuple(value, path):
+                check_container(value, path)
+                if not too_deep:
+                    for i, element in _sample(value, VALIDATION_SAMPLE_SIZE):
+                        item(element, f"{path}[{i}]")
+            return check_var_tuple
+
+        items = [_build_checker(arg, depth + 1) for arg in args]
+
+        def check_fixed_tuple(value, path):
+            check_container(value, path)
+            if len(value) != len(items):
+                raise DtypeMismatch(f"{path} has {len(value)} elements, expected {len(items)}")
+            if not too_deep:
+                for i, (element, item) in enumerate(zip(value, items)):
+                    item(element, f"{path}[{i}]")
+        return check_fixed_tuple
+
+    if isinstance(origin, type) and issubclass(origin, Mapping):
+        key_check = _build_checker(args[0], depth + 1) if args else None
+        value_check = _build_checker(args[1], depth + 1) if len(args) > 1 else None
+
+        def check_mapping(value, path):
+            check_container(value, path)
+            if too_deep or key_check is None:
+                return
+            for key, element in itertools.islice(value.items(), VALIDATION_SAMPLE_SIZE):
+                key_check(key, f"{path} key {key!r}")
+                if value_check is not None:
+                    value_check(element, f"{path}[{key!r}]")
+        return check_mapping
+
+    item = _build_checker(args[0], depth + 1) if args else None
+
+    def check_collection(value, path):
+        check_container(value, path)
+        if too_deep or item is None:
+            return
+        if isinstance(value, Sequence):
+            elements = _sample(value, VALIDATION_SAMPLE_SIZE)
+        else:  # sets and other iterables: no indexing, take the first elements
+            elements = enumerate(itertools.islice(value, VALIDATION_SAMPLE_SIZE))
+        for i, element in elements:
+            item(element, f"{path}[{i}]")
+    return check_collection
+
+
+def _instance_checker(cls: type):
+    # PEP 484 numeric tower, same as typeguard: int is accepted for float, int/float for complex
+    if cls is float:
+        accepted = (float, int)
+    elif cls is complex:
+        accepted = (complex, float, int)
+    else:
+        accepted = cls
+
+    def check_instance(value, path):
+        if not isinstance(value, accepted):
+            raise DtypeMismatch(f"{path} is {type(value).__name__}, expected {cls.__name__}")
+    return check_instance
+
+
+def check_output_variables(output_variables) -> str:
+    """Runs in the kernel process. Returns error message, empty if all output variables are valid."""
+    error_msg = ""
+    for var in output_variables:
+        name = var.variable_name
+        dtype_str = var.variable_data_type
+        value = PERSISTENT_GLOBALS.get(name, None)
+        if value is None:
+            error_msg += f'Missing variable: {name}\n'
+            continue
+        if dtype_str == 'object':
+            continue
+        try:
+            compile_dtype(dtype_str, PERSISTENT_GLOBALS)(value, name)
+        except Exception as e:
+            detail = f" ({e})" if isinstance(e, DtypeMismatch) else ""
+            error_msg += (f'Error: {name} is {type(value).__name__} but expected literal python type: {dtype_str}{detail}\n'
+                            f'make sure that the variable {dtype_str} class exists verbatim in current python environment.\n'
+                            f'name of the class should be verbatim {dtype_str}, so re-import it if needed\n'
+                            f'examples of different imports: import pandas as pd VS import pandas; import numpy as np VS import numpy; etc\n'
+                            )
+    return error_msg
@@ -0,0 +1,84 @@
+"""
+Compact summaries of task variables for the step prompt.
+
+Type, len/shape, a few sample elements and, for DataFrames, columns with dtypes, so the
+agent does not spend its first iterations printing its inputs. Runs in the kernel process
+(see `summarize_variables`). Summaries are not cached: an object mutated in place keeps its
+identity (and often its len), and a summary only looks at a few elements anyway.
+"""
+import itertools
+import reprlib
+
+from .executor import PERSISTENT_GLOBALS
+
+VARIABLE_SUMMARY_CHARS = 800  # per variable
+VARIABLE_SUMMARIES_TOTAL_CHARS = 4000  # all input variables of a step
+SUMMARY_SAMPLE_ITEMS = 3
+SUMMARY_MAX_COLUMNS = 30
+
+_repr = reprlib.Repr()
+_repr.maxlist = _repr.maxtuple = _repr.maxset = _repr.maxfrozenset = _repr.maxdict = SUMMARY_SAMPLE_ITEMS
+_repr.maxstring = _repr.maxother = 120
+_repr.maxlevel = 3
+
+def _type_name(value) -> str:
+    cls = type(value)
+    return cls.__name__ if cls.__module__ == "builtins" else f"{cls.__module__.split('.')[0]}.{cls.__name__}"
+
+
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[: limit - 4] + " ..."
+
+
+def _summarize(value) -> str:
+    type_name = _type_name(value)
+
+    columns = getattr(value, "columns", None)
+    dtypes = getattr(value, "dtypes", None)
+    if columns is not None and dtypes is not None and hasattr(value, "head"):  # pandas DataFrame
+        shown = [f"{col}: {dtype}" for col, dtype in list(dtypes.items())[:SUMMARY_MAX_COLUMNS]]
+        more = f", ... ({len(columns) - SUMMARY_MAX_COLUMNS} more)" if len(columns) > SUMMARY_MAX_COLUMNS else ""
+        head = value.head(SUMMARY_SAMPLE_ITEMS).to_string(max_cols=SUMMARY_MAX_COLUMNS, max_colwidth=40)
+        return f"{type_name}, shape {value.shape}\n  columns: {', '.join(shown)}{more}\n  head:\n{head}"
+
+    shape = getattr(value, "shape", None)
+    if isinstance(shape, tuple):  # numpy arrays, pandas Series
+        dtype = getattr(value, "dtype", "?")
+        head = value[:SUMMARY_SAMPLE_ITEMS] if len(shape) else value
+        sample = head.tolist() if hasattr(head, "tolist") else head
+        return f"{type_name}, shape {shape}, dtype {dtype}\n  first items: {_repr.repr(sample)}"
+
+    if isinstance(value, (str, bytes)):
+        return f"{type_name}, len {len(value)}: {_repr.repr(value)}"
+
+    if isinstance(value, dict):
+        items = list(itertools.islice(value.items(), SUMMARY_SAMPLE_ITEMS))
+        sample = ", ".join(f"{_repr.repr(k)}: {_repr.repr(v)}" for k, v in items)
+        return f"dict, len {len(value)}\n  first items: {{{sample}{', ...' if len(value) > len(items) else ''}}}"
+
+    if isinstance(value, (list, tuple, set, frozenset)):
+        items = list(itertools.islice(value, SUMMARY_SAMPLE_ITEMS))
+        element_types = sorted({_type_name(item) for item in items})
+        return (f"{type_name}, len {len(value)}, element types: {', '.join(element_types) or '-'}\n"
+                f"  first items: {_repr.repr(items)}")
+
+    return f"{type_name}: {_repr.repr(value)}"
+
+
+def summarize_variables(names: list[str], max_chars: int = VARIABLE_SUMMARY_CHARS,
+                        total_chars: int = VARIABLE_SUMMARIES_TOTAL_CHARS) -> dict[str, str]:
+    """Runs in the kernel process. {name: summary} for the variables that exist."""
+    summaries = {}
+    budget = total_chars
+    for name in names:
+        if name not in PERSISTENT_GLOBALS or budget <= 0:
+            continue
+        value = PERSISTENT_GLOBALS[name]
+        try:
+            summary = _clip(_summarize(value), max_chars)
+        except Exception as e:
+            summary = f"{_type_name(value)} (no summary: {type(e).__name__})"
+        summary = _clip(summary, budget)
+        summaries[name] = summary
+        budget -= len(summary)
+    return summaries
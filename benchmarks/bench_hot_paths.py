@@ -0,0 +1,163 @@
+"""
+Microbenchmarks: pure hot paths of the agent loop on scaled synthetic inputs.
+
+Plans of 10 to 1,000 steps, model responses of 1 KB to 1 MB. No network, no kernel process.
+Results are saved to benchmarks/results/<commit>.json (machine-specific, not committed);
+`--compare` prints the ratio against an earlier run and flags regressions.
+
+    python -m benchmarks.bench_hot_paths
+    python -m benchmarks.bench_hot_paths --compare benchmarks/results/<commit>.json
+"""
+import argparse
+import io
+import json
+import platform
+import subprocess
+import time
+import timeit
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from agent.executor import PERSISTENT_GLOBALS
+from agent.log import _format_plan
+from agent.plan import Plan, PlanStep, StepVariable, check_plan, format_completed_steps, format_remaining_steps
+from agent.prompt_agent import build_step_user_first_msg_prompt
+from agent.utils import check_assigned_variables, parse_response_blocks
+from agent.validate import check_output_variables
+
+STEP_COUNTS = (10, 100, 1_000)
+RESPONSE_SIZES = (1_000, 32_000, 1_000_000)  # bytes
+ELEMENTS_PER_STEP = 1_000  # output validation: container of steps * this many elements
+REPEAT = 5
+MIN_RUN_SECONDS = 0.05  # each repeat loops the call for at least this long
+REGRESSION_RATIO = 1.2
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+
+def _variable(name: str, dtype: str) -> StepVariable:
+    return StepVariable(variable_name=name, variable_description=f"description of {name}", variable_data_type=dtype)
+
+
+def make_plan(steps: int) -> Plan:
+    """Chain of steps, each consuming the previous step's output."""
+    return Plan(steps=[
+        PlanStep(
+            step_description=f"Step {i}: load the records, aggregate them by key and store the totals " * 2,
+            input_variables=[_variable(f"totals_{i - 1}", "dict[str, int]")] if i else [],
+            output_variables=[_variable(f"totals_{i}", "dict[str, int]"), _variable(f"report_{i}", "str")],
+        )
+        for i in range(steps)
+    ])
+
+
+def make_response(size: int) -> str:
+    """Model response of about `size` bytes: text, python and bash blocks in turn."""
+    chunk = (
+        "Let me look at the data first.\n"
+        "```python\nimport json\nrows = [r for r in data if r['value'] > 0]\nprint(len(rows))\n```\n"
+        "Now check the files.\n"
+        "```bash\nls -la /tmp | head -20\n```\n"
+    )
+    return chunk * max(1, size // len(chunk))
+
+
+def make_code(size: int) -> str:
+    """Python block of about `size` bytes, assigning final_answer at the end."""
+    line = "value_{0} = compute(items[{0}], key='k{0}')\n"
+    lines, total, i = [], 0, 0
+    while total < size:
+        lines.append(line.format(i))
+        total += len(lines[-1])
+        i += 1
+    lines.append("step_status = 'completed'\nfinal_answer = 'done'\n")
+    return "".join(lines)
+
+
+def _silent(func, *args):
+    with redirect_stdout(io.StringIO()):  # check_plan prints its warnings
+        return func(*args)
+
+
+def cases() -> list[tuple[str, object, callable, tuple]]:
+    """(benchmark, size, function, args)."""
+    rows = []
+    for size in RESPONSE_SIZES:
+        rows.append(("parse_response_blocks", size, parse_response_blocks, (make_response(size),)))
+        rows.append(("check_assigned_variables", size, check_assigned_variables, (make_code(size),)))
+    for steps in STEP_COUNTS:
+        plan = make_plan(steps)
+        completed = [(step, f"Result of step {i}: " + "ok " * 50) for i, step in enumerate(plan.steps)]
+        rows.append(("check_plan", steps, _silent, (check_plan, plan)))
+        rows.append(("format_completed_steps", steps, format_completed_steps, (completed,)))
+        rows.append(("format_remaining_steps", steps, format_remaining_steps, (plan.steps,)))
+        rows.append(("build_step_user_first_msg_prompt", steps, build_step_user_first_msg_prompt,
+                     ("Aggregate the records by key.", plan.steps[-1], completed[:-1])))
+        rows.append(("_format_plan", steps, _format_plan, (plan,)))
+
+        name = f"bench_totals_{steps}"
+        PERSISTENT_GLOBALS[name] = {f"key_{i}": i for i in range(steps * ELEMENTS_PER_STEP)}
+        rows.append(("check_output_variables", steps, check_output_variables, ([_variable(name, "dict[str, int]")],)))
+    return rows
+
+
+def _timeit(func, *args) -> float:
+    """Best seconds per call over REPEAT runs."""
+    timer = timeit.Timer(lambda: func(*args))
+    number = 1
+    while timer.timeit(number) < MIN_RUN_SECONDS and number < 1_000_000:
+        number *= 10
+    return min(timer.repeat(REPEAT, number)) / number
+
+
+def _commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--filter", default="", help="only benchmarks whose name contains this")
+    parser.add_argument("--compare", type=Path, help="results file of an earlier run")
+    parser.add_argument("--output", type=Path, help="results file (default benchmarks/results/<commit>.json)")
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with args.compare.open("r", encoding="utf-8") as f:
+            baseline = json.load(f)["results"]
+
+    results: dict[str, dict[str, float]] = {}
+    regressions = []
+    print(f"best of {REPEAT}, time per call")
+    for name, size, func, call_args in cases():
+        if args.filter not in name:
+            continue
+        seconds = _timeit(func, *call_args)
+        results.setdefault(name, {})[str(size)] = seconds
+        line = f"  {name:<34} {size:>10,} {seconds * 1000:12.4f} ms"
+        previous = baseline.get(name, {}).get(str(size))
+        if previous:
+            ratio = seconds / previous
+            line += f"   x{ratio:.2f}"
+            if ratio > REGRESSION_RATIO:
+                line += "  ⚠️ regression"
+                regressions.append(f"{name}[{size}]")
+        print(line)
+
+    commit = _commit()
+    output = args.output or RESULTS_DIR / f"{commit}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with output.open("w", encoding="utf-8") as f:
+        json.dump({"commit": commit, "date": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                   "machine": platform.machine(), "results": results}, f, indent=2)
+    print(f"✓ Results saved to {output}")
+    if regressions:
+        print(f"⚠️ {len(regressions)} regressions over x{REGRESSION_RATIO}: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    main()
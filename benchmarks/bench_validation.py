@@ -0,0 +1,73 @@
+"""
+Microbenchmark: output variable validation at step finalization.
+
+Compares the previous approach (copy of the namespace + eval + typeguard on the full value)
+with agent.validate on multi-million element outputs. No network, no kernel process.
+
+    python -m benchmarks.bench_validation
+"""
+import time
+
+from typeguard import check_type, CollectionCheckStrategy
+
+from agent.executor import PERSISTENT_GLOBALS
+from agent.plan import StepVariable
+from agent.validate import check_output_variables
+
+N = 2_000_000
+REPEAT = 3
+
+
+def _legacy_check(output_variables, strategy) -> str:
+    """Validation as run_step did it before agent.validate (plus a configurable typeguard strategy)."""
+    error_msg = ""
+    for var in output_variables:
+        value = PERSISTENT_GLOBALS.get(var.variable_name, None)
+        if value is None:
+            error_msg += f"Missing variable: {var.variable_name}\n"
+            continue
+        try:
+            glbs = dict(PERSISTENT_GLOBALS)
+            dtype = eval(var.variable_data_type, glbs)
+            check_type(value, dtype, collection_check_strategy=strategy)
+        except Exception as e:
+            error_msg += f"Error: {var.variable_name}: {e}\n"
+    return error_msg
+
+
+def _timeit(func, *args) -> float:
+    best = float("inf")
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    PERSISTENT_GLOBALS.update({
+        "pairs": [(i, str(i)) for i in range(N)],
+        "index": {str(i): [i] for i in range(N)},
+        "ids": set(range(N)),
+        # a large namespace: the legacy path copies it for every output variable
+        **{f"tmp_{i}": i for i in range(10_000)},
+    })
+    output_variables = [
+        StepVariable(variable_name="pairs", variable_description="", variable_data_type="list[tuple[int, str]]"),
+        StepVariable(variable_name="index", variable_description="", variable_data_type="dict[str, list[int]]"),
+        StepVariable(variable_name="ids", variable_description="", variable_data_type="set[int]"),
+    ]
+
+    print(f"{N:,} elements per output variable, best of {REPEAT}")
+    rows = [
+        ("legacy, typeguard all items", _legacy_check, output_variables, CollectionCheckStrategy.ALL_ITEMS),
+        ("legacy, typeguard first item", _legacy_check, output_variables, CollectionCheckStrategy.FIRST_ITEM),
+        ("agent.validate (sampled)", check_output_variables, output_variables),
+    ]
+    for label, func, *args in rows:
+        assert not func(*args), f"{label}: unexpected validation error"
+        print(f"  {label:<32} {_timeit(func, *args) * 1000:10.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -37,8 +37,14 @@ def clear_directories():
     print("All directories cleared successfully!")
 
 
-def run_task(task: str) -> dict:
-    response = requests.post(f"{BASE_URL}/run", json={"task": task})
+def run_task(task: str, max_attempts: int = 5) -> dict:
+    for _ in range(max_attempts):
+        response = requests.post(f"{BASE_URL}/run", json={"task": task})
+        if response.status_code != 429:  # server busy: retry when it says so
+            break
+        retry_after = int(response.headers.get("Retry-After", "30"))
+        print(f"Server busy: {response.json()['message']}, retrying in {retry_after}s")
+        time.sleep(retry_after)
     response.raise_for_status()
     return response.json()
 
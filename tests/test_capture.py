@@ -0,0 +1,45 @@
+from agent.capture import BoundedCapture
+
+
+def test_short_output_is_kept_whole():
+    capture = BoundedCapture(head_chars=10, tail_chars=10)
+    capture.write("hello\n")
+    capture.write("world\n")
+    assert capture.getvalue() == "hello\nworld\n"
+    assert capture.stats() == {
+        "total_chars": 12, "total_lines": 2, "elided_chars": 0, "truncated": False, "spill_path": None,
+    }
+
+
+def test_long_output_keeps_head_and_tail():
+    capture = BoundedCapture(head_chars=10, tail_chars=10)
+    for i in range(100):
+        capture.write(f"line {i:03d}\n")  # 9 chars each
+
+    value = capture.getvalue()
+    assert value.startswith("line 000\nl")
+    assert value.endswith("\nline 099\n")
+    assert "[... 880 characters elided (100 lines in total) ...]" in value
+    stats = capture.stats()
+    assert (stats["total_chars"], stats["total_lines"], stats["elided_chars"], stats["truncated"]) == (900, 100, 880, True)
+
+
+def test_single_huge_chunk_keeps_only_its_ends():
+    capture = BoundedCapture(head_chars=4, tail_chars=4)
+    capture.write("a" * 4 + "b" * 1_000_000 + "c" * 4)
+    assert capture.getvalue().startswith("aaaa\n[... 1000000 characters elided")
+    assert capture.getvalue().endswith("...]\ncccc")
+    assert capture._tail_len == 4
+
+
+def test_spill_file_holds_full_output(tmp_path):
+    spill = tmp_path / "out" / "stdout.txt"
+    capture = BoundedCapture(spill_path=spill, head_chars=5, tail_chars=5)
+    assert capture.stats()["spill_path"] is None
+    text = "".join(f"{i}\n" for i in range(1000))
+    capture.write(text)
+    capture.close()
+
+    assert spill.read_text() == text
+    assert capture.stats()["spill_path"] == str(spill)
+    assert f"full output: {spill}" in capture.getvalue()
@@ -0,0 +1,55 @@
+import socket
+import threading
+
+import pytest
+
+from agent import ipc
+from agent.ipc import Channel, FrameTooLarge, channel_pair
+
+
+@pytest.fixture
+def channels():
+    server, worker_sock = channel_pair()
+    worker = Channel(worker_sock)
+    yield server, worker
+    server.close()
+    worker.close()
+
+
+def test_messages_round_trip(channels):
+    server, worker = channels
+    worker.send({"type": "progress", "phase": "step", "step": 1, "text": "ünïcode"})
+    worker.send({"type": "result", "status": "completed", "result": None})
+    assert server.recv() == {"type": "progress", "phase": "step", "step": 1, "text": "ünïcode"}
+    assert server.recv() == {"type": "result", "status": "completed", "result": None}
+
+
+def test_closed_peer_ends_recv(channels):
+    server, worker = channels
+    worker.send({"type": "heartbeat"})
+    worker.sock.shutdown(socket.SHUT_WR)
+    assert server.recv() == {"type": "heartbeat"}
+    assert server.recv() is None
+
+
+def test_oversized_frame_is_skipped(channels, monkeypatch):
+    monkeypatch.setattr(ipc, "MAX_FRAME_BYTES", 1024)
+    server, worker = channels
+    # the frame is larger than the socket buffer, so it is sent while the server drains it
+    sender = threading.Thread(target=lambda: (
+        worker.send({"type": "partial", "result": "x" * 1_000_000}),
+        worker.send({"type": "result", "status": "completed"}),
+    ))
+    sender.start()
+    with pytest.raises(FrameTooLarge):
+        server.recv()
+    assert server.recv() == {"type": "result", "status": "completed"}
+    sender.join(timeout=5)
+    assert not sender.is_alive()
+
+
+def test_frame_cut_off_mid_body_ends_recv(channels):
+    server, worker = channels
+    worker.sock.sendall(ipc._HEADER.pack(100) + b'{"type": ')
+    worker.sock.shutdown(socket.SHUT_WR)
+    assert server.recv() is None
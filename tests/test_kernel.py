@@ -0,0 +1,82 @@
+import signal
+import time
+
+import pytest
+
+from agent.executor import PERSISTENT_GLOBALS
+from agent.kernel import KernelError, KernelTimeout, PythonKernel
+
+
+# run inside the kernel process
+
+def _set(name, value):
+    PERSISTENT_GLOBALS[name] = value
+
+
+def _get(name):
+    return PERSISTENT_GLOBALS.get(name)
+
+
+def _sleep_then_set(seconds, name, value):
+    time.sleep(seconds)
+    PERSISTENT_GLOBALS[name] = value
+
+
+def _interrupted_after_return(value):
+    """Returns `value`, then the kernel's `finally` is hit by a KeyboardInterrupt (a late SIGINT)."""
+    setitimer = signal.setitimer
+
+    def late_interrupt(*args):
+        signal.setitimer = setitimer
+        setitimer(*args)
+        raise KeyboardInterrupt
+
+    signal.setitimer = late_interrupt
+    return value
+
+
+@pytest.fixture
+def kernel():
+    kernel = PythonKernel()
+    kernel.start()
+    yield kernel
+    kernel.stop()
+
+
+def test_call_returns_result_and_keeps_namespace(kernel):
+    kernel.call(_set, "x", [1, 2, 3])
+    assert kernel.call(_get, "x") == [1, 2, 3]
+    with pytest.raises(KernelError, match="ZeroDivisionError"):
+        kernel.call(divmod, 1, 0)
+    assert kernel.call(_get, "x") == [1, 2, 3]
+
+
+def test_timeout_interrupts_and_keeps_variables(kernel):
+    kernel.call(_set, "x", 42)
+    started = time.monotonic()
+    with pytest.raises(KernelTimeout) as exc_info:
+        kernel.call(_sleep_then_set, 30, "y", 1, timeout=0.5)
+    assert time.monotonic() - started < 5
+    assert not exc_info.value.restarted
+    assert "KeyboardInterrupt" in str(exc_info.value)
+    assert kernel.restarts == 0
+    assert kernel.call(_get, "x") == 42
+    assert kernel.call(_get, "y") is None
+
+
+def test_uninterruptible_call_restarts_kernel(kernel, monkeypatch):
+    monkeypatch.setattr("agent.kernel.INTERRUPT_GRACE", 0.5)
+    kernel.call(_set, "x", 42)
+    kernel.call(signal.signal, signal.SIGINT, signal.SIG_IGN)
+    with pytest.raises(KernelTimeout) as exc_info:
+        kernel.call(time.sleep, 30, timeout=0.5)
+    assert exc_info.value.restarted
+    assert kernel.restarts == 1
+    assert kernel.call(_get, "x") is None
+
+
+def test_interrupt_after_the_call_returned_still_replies(kernel):
+    kernel.call(_set, "x", 42)
+    assert kernel.call(_interrupted_after_return, "done", timeout=10) == "done"
+    assert kernel.restarts == 0
+    assert kernel.call(_get, "x") == 42
@@ -0,0 +1,98 @@
+import time
+
+import pytest
+
+from agent.task_backend import MemoryBackend, SqliteBackend
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def backend(request, tmp_path):
+    if request.param == "memory":
+        return MemoryBackend()
+    return SqliteBackend(tmp_path / "tasks.db")
+
+
+def _pending(n: int = 0) -> dict:
+    return {"status": "pending", "queued_at_us": time.time_ns() // 1000 + n}
+
+
+def test_lease_takes_oldest_pending_once(backend):
+    backend.create("a", _pending(0))
+    backend.create("b", _pending(1))
+    assert backend.queue_depth() == 2
+
+    first = backend.lease("node-1")
+    second = backend.lease("node-2")
+    assert (first["status"], first["lease_owner"], first["attempts"]) == ("running", "node-1", 1)
+    assert backend.get("a")["lease_owner"] == "node-1"
+    assert backend.get("b")["lease_owner"] == "node-2"
+    assert backend.lease("node-1") is None
+    assert backend.queue_depth() == 0
+    assert backend.running_by_node() == {"node-1": 1, "node-2": 1}
+
+
+def test_renew_extends_own_leases_and_reports_lost(backend):
+    backend.create("a", _pending())
+    backend.create("b", _pending(1))
+    backend.lease("node-1", lease_seconds=5)
+    backend.lease("node-2", lease_seconds=5)
+
+    assert backend.renew("node-1", ["a", "b", "missing"], lease_seconds=600) == ["b", "missing"]
+    assert backend.get("a")["lease_expires"] > time.time() + 300
+    assert backend.get("b")["lease_expires"] < time.time() + 300
+
+    backend.mutate("a", lambda r: r.update(status="completed"))
+    assert backend.renew("node-1", ["a"]) == ["a"]
+
+
+def test_expired_lease_is_requeued_then_failed(backend):
+    backend.create("a", _pending())
+    backend.lease("node-1", lease_seconds=-1)
+
+    assert backend.requeue_expired(max_attempts=2) == (["a"], [])
+    record = backend.get("a")
+    assert (record["status"], record["lease_owner"], record["resume"]) == ("pending", None, True)
+    assert backend.renew("node-1", ["a"]) == ["a"]  # taken away from the lost node
+
+    assert backend.lease("node-2", lease_seconds=-1)["attempts"] == 2
+    assert backend.requeue_expired(max_attempts=2) == ([], ["a"])
+    assert backend.get("a")["status"] == "failed"
+    assert backend.lease("node-3") is None
+
+
+def test_running_lease_is_not_requeued(backend):
+    backend.create("a", _pending())
+    backend.lease("node-1", lease_seconds=60)
+    assert backend.requeue_expired() == ([], [])
+    assert backend.get("a")["status"] == "running"
+
+
+def test_mutate_with_owner_is_fenced(backend):
+    backend.create("a", _pending())
+    backend.lease("node-1")
+    assert backend.mutate("a", lambda r: r.update(result="x"), owner="node-2") is None
+    assert backend.mutate("a", lambda r: r.update(result="x"), owner="node-1")["result"] == "x"
+    assert backend.mutate("a", lambda r: False)["result"] == "x"
+
+
+def test_create_deduplicated_reuses_accepted_task(backend):
+    keys = [("key-1", lambda r: r["status"] != "failed")]
+    assert backend.create_deduplicated("a", _pending(), keys)[::2] == ("a", True)
+
+    task_id, record, created = backend.create_deduplicated("b", _pending(), keys)
+    assert (task_id, record["status"], created) == ("a", "pending", False)
+    assert backend.get("b") is None
+    assert backend.find(keys)[0] == "a"
+
+    backend.mutate("a", lambda r: r.update(status="failed"))
+    assert backend.find(keys) is None
+    assert backend.create_deduplicated("c", _pending(), keys)[::2] == ("c", True)
+    assert backend.find(keys)[0] == "c"
+
+
+def test_deleted_task_releases_its_keys(backend):
+    keys = [("key-1", lambda r: True)]
+    backend.create_deduplicated("a", _pending(), keys)
+    backend.delete(["a"])
+    assert backend.find(keys) is None
+    assert backend.queue_depth() == 0
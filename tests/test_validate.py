@@ -0,0 +1,66 @@
+import pytest
+
+from agent.executor import PERSISTENT_GLOBALS
+from agent.plan import StepVariable
+from agent.validate import check_output_variables
+
+
+@pytest.fixture
+def kernel_globals():
+    names = []
+
+    def _set(**values):
+        names.extend(values)
+        PERSISTENT_GLOBALS.update(values)
+
+    yield _set
+    for name in names:
+        PERSISTENT_GLOBALS.pop(name, None)
+
+
+def _variable(name: str, dtype: str) -> StepVariable:
+    return StepVariable(variable_name=name, variable_description="", variable_data_type=dtype)
+
+
+@pytest.mark.parametrize("dtype, value", [
+    ("str", "report"),
+    ("dict[str, int]", {f"k{i}": i for i in range(10_000)}),
+    ("list[tuple[int, str]]", [(i, str(i)) for i in range(10_000)]),
+    ("dict[str, list[int]]", {"a": [1, 2], "b": []}),
+    ("float", 3),
+    ("Optional[list[int]]", [1]),
+    ("typing.Union[int, str]", "x"),
+    ("tuple[int, ...]", (1, 2, 3)),
+])
+def test_matching_values_pass(kernel_globals, dtype, value):
+    kernel_globals(out=value)
+    assert check_output_variables([_variable("out", dtype)]) == ""
+
+
+@pytest.mark.parametrize("dtype, value, detail", [
+    ("str", 1, "out is int, expected str"),
+    ("dict[str, int]", {"a": 1, "b": "2"}, "out['b'] is str, expected int"),
+    ("list[tuple[int, str]]", [(1, "a")] * 100 + [(1, 2)], "out[100][1] is int, expected str"),
+    ("list[tuple[int, str]]", [(1, "a", 2)], "out[0] has 3 elements, expected 2"),
+    ("dict[str, list[int]]", {"a": [1, "x"]}, "out['a'][1] is str, expected int"),
+])
+def test_mismatches_name_the_element(kernel_globals, dtype, value, detail):
+    kernel_globals(out=value)
+    error = check_output_variables([_variable("out", dtype)])
+    assert error.startswith(f"Error: out is {type(value).__name__} but expected literal python type: {dtype} ({detail})")
+
+
+def test_missing_variable(kernel_globals):
+    assert check_output_variables([_variable("not_set_anywhere", "int")]) == "Missing variable: not_set_anywhere\n"
+
+
+def test_only_typing_aliases_resolve_without_import(kernel_globals):
+    kernel_globals(out=[1])
+    assert check_output_variables([_variable("out", "List[int]")]) == ""
+    assert check_output_variables([_variable("out", "re.Pattern")]).startswith("Error: out is list")
+
+
+def test_module_alias_resolves_full_name(kernel_globals):
+    pd = pytest.importorskip("pandas")
+    kernel_globals(pd=pd, out=pd.DataFrame({"a": [1]}))
+    assert check_output_variables([_variable("out", "pandas.DataFrame")]) == ""